@@ -0,0 +1,166 @@
+"""
+Admission control for chat-completion calls.
+
+At most LLM_MAX_CONCURRENCY chat calls run at once per worker. Requests beyond that wait
+in a bounded queue (LLM_MAX_QUEUE) served strictly by priority class:
+
+    doctor_interactive > patient_interactive > doctor_batch > patient_batch
+
+Within a class, users are served round-robin, so one user's burst cannot starve the
+others in the same class. A request that cannot get a slot within its class's queue
+timeout (LLM_QUEUE_TIMEOUT_S, or LLM_BATCH_QUEUE_TIMEOUT_S for batch work) or finds the
+queue full is rejected with AdmissionRejected. It carries a Retry-After estimate based
+on the recent chat-call duration.
+
+    async with scheduler.slot(uid, priority_class("doctor", "interactive")):
+        await asyncio.to_thread(call_chat_completion, ...)
+"""
+
+import math
+import time
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Optional
+
+from observability import Counter, Gauge, Histogram
+
+PRIORITY_CLASSES = ("doctor_interactive", "patient_interactive", "doctor_batch", "patient_batch")
+_RANK = {name: rank for rank, name in enumerate(PRIORITY_CLASSES)}
+
+QUEUE_DEPTH = Gauge("smartemr_llm_queue_depth", "Chat calls waiting for a slot", ["priority"])
+IN_FLIGHT = Gauge("smartemr_llm_in_flight", "Chat calls currently running")
+QUEUE_WAIT_SECONDS = Histogram(
+    "smartemr_llm_queue_wait_seconds", "Time chat calls waited for a slot", ["priority"],
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+)
+REJECTED = Counter("smartemr_llm_rejected_total", "Chat calls refused by admission control", ["priority", "reason"])
+
+
+def priority_class(role: Optional[str], mode: str = "interactive") -> str:
+    role = "doctor" if role == "doctor" else "patient"
+    mode = "batch" if mode == "batch" else "interactive"
+    return f"{role}_{mode}"
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ("future", "user", "priority", "enqueued")
+
+    def __init__(self, future: asyncio.Future, user: str, priority: str):
+        self.future = future
+        self.user = user
+        self.priority = priority
+        self.enqueued = time.perf_counter()
+
+
+class LLMScheduler:
+    def __init__(self, max_concurrent: int, max_queue: int, queue_timeout_s: float, batch_queue_timeout_s: float):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.timeouts = {p: batch_queue_timeout_s if p.endswith("_batch") else queue_timeout_s
+                         for p in PRIORITY_CLASSES}
+        self.active = 0
+        self.depth = 0
+        # priority -> user -> that user's waiters; OrderedDict order is the round-robin turn
+        self._queues: Dict[str, "OrderedDict[str, Deque[_Waiter]]"] = {p: OrderedDict() for p in PRIORITY_CLASSES}
+        self._call_seconds = 1.0  # moving average of slot hold time, for Retry-After
+
+    def retry_after(self) -> int:
+        per_slot = (self.depth + 1) / max(1, self.max_concurrent)
+        return max(1, math.ceil(per_slot * self._call_seconds))
+
+    def _enqueue(self, waiter: _Waiter) -> None:
+        self._queues[waiter.priority].setdefault(waiter.user, deque()).append(waiter)
+        self.depth += 1
+        QUEUE_DEPTH.inc(priority=waiter.priority)
+
+    def _remove(self, waiter: _Waiter) -> None:
+        users = self._queues[waiter.priority]
+        waiters = users.get(waiter.user)
+        if waiters is None or waiter not in waiters:
+            return
+        waiters.remove(waiter)
+        if not waiters:
+            del users[waiter.user]
+        self.depth -= 1
+        QUEUE_DEPTH.dec(priority=waiter.priority)
+
+    def _pop_next(self) -> Optional[_Waiter]:
+        for priority in PRIORITY_CLASSES:
+            users = self._queues[priority]
+            if not users:
+                continue
+            user, waiters = next(iter(users.items()))
+            waiter = waiters.popleft()
+            if waiters:
+                users.move_to_end(user)  # this user's next request waits for everyone else's turn
+            else:
+                del users[user]
+            self.depth -= 1
+            QUEUE_DEPTH.dec(priority=priority)
+            return waiter
+        return None
+
+    def _grant(self) -> None:
+        self.active += 1
+        IN_FLIGHT.inc()
+
+    def release(self) -> None:
+        self.active -= 1
+        IN_FLIGHT.dec()
+        while self.active < self.max_concurrent:
+            waiter = self._pop_next()
+            if waiter is None:
+                return
+            if not waiter.future.done():
+                self._grant()
+                waiter.future.set_result(None)
+
+    async def acquire(self, user: str, priority: str) -> float:
+        """Wait for a slot; returns the seconds spent queued."""
+        if priority not in _RANK:
+            raise ValueError(f"unknown priority class {priority!r}")
+        if self.active < self.max_concurrent and self.depth == 0:
+            self._grant()
+            QUEUE_WAIT_SECONDS.observe(0.0, priority=priority)
+            return 0.0
+        if self.depth >= self.max_queue:
+            REJECTED.inc(priority=priority, reason="queue_full")
+            raise AdmissionRejected("queue_full", self.retry_after())
+
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), user, priority)
+        self._enqueue(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.timeouts[priority])
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.future.done():  # the slot was handed over just as we gave up
+                if isinstance(e, asyncio.CancelledError):
+                    self.release()
+                    raise
+            else:
+                waiter.future.cancel()
+                self._remove(waiter)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                REJECTED.inc(priority=priority, reason="queue_timeout")
+                raise AdmissionRejected("queue_timeout", self.retry_after()) from None
+        waited = time.perf_counter() - waiter.enqueued
+        QUEUE_WAIT_SECONDS.observe(waited, priority=priority)
+        return waited
+
+    @asynccontextmanager
+    async def slot(self, user: str, priority: str):
+        waited = await self.acquire(user, priority)
+        start = time.perf_counter()
+        try:
+            yield waited
+        finally:
+            self._call_seconds = 0.8 * self._call_seconds + 0.2 * (time.perf_counter() - start)
+            self.release()
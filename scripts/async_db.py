@@ -0,0 +1,188 @@
+"""
+Awaitable database sessions for the FastAPI handlers.
+
+Handlers are coroutines, so a synchronous Session used directly inside them blocks the
+event loop for every query and a worker serves one request at a time. AsyncSession
+has the interface of sqlalchemy.ext.asyncio.AsyncSession (exec/execute/get/commit/
+refresh/run_sync, ...), but wraps the ordinary synchronous session and runs each call
+on a small dedicated pool of database threads; pysqlite releases the GIL while SQLite
+works, so queries of concurrent requests overlap and the loop keeps serving others.
+
+- Results are buffered on the database thread before they come back, as AsyncSession
+  does, so iterating them never touches the database from the loop.
+- Sessions do not expire objects on commit: attribute access after commit must not
+  issue a query from the loop.
+- A connection is only held across awaits by a transaction that writes. After a call
+  that only read, the transaction is ended on the same database thread and the
+  connection goes back to the pool, so the pool only has to cover concurrent writers,
+  not every open request.
+- Helpers written against the synchronous Session (first argument `session`) run as a
+  whole on a database thread with run_sync(), one hop instead of one per query.
+- Calls on one session are awaited one after another, never concurrently; the
+  connection moves between pool threads (engines use check_same_thread=False).
+
+    async with AsyncSession(shards.session()) as session:
+        patient = (await session.exec(select(Patient).where(Patient.id == 1))).first()
+        await session.run_sync(save_report_document, patient.id, ...)
+"""
+
+import asyncio
+import threading
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import FrozenResult
+from sqlalchemy.orm import Session
+from sqlmodel.sql.expression import SelectOfScalar
+
+from observability import Histogram
+
+DB_WAIT_SECONDS = Histogram("smartemr_db_call_seconds", "Wall time of database calls awaited by handlers",
+                            ["call"])
+
+_executor: Optional[ThreadPoolExecutor] = None
+_threads = 8
+_lock = threading.Lock()
+
+
+def configure(threads: int) -> None:
+    """Size of the database thread pool; takes effect for a pool created afterwards."""
+    global _threads
+    _threads = max(1, threads)
+
+
+def executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=_threads, thread_name_prefix="smartemr-db")
+    return _executor
+
+
+def shutdown() -> None:
+    global _executor
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+
+
+async def run(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """Run a blocking database call on the database thread pool, in the caller's context (trace id)."""
+    loop = asyncio.get_running_loop()
+    call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+    return await loop.run_in_executor(executor(), call)
+
+
+_WROTE = "async_db.wrote"
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _mark_dml(state) -> None:
+    if state.is_insert or state.is_update or state.is_delete:
+        state.session.info[_WROTE] = True
+
+
+@event.listens_for(Session, "after_flush")
+def _mark_flush(session, flush_context) -> None:
+    session.info[_WROTE] = True
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _clear_mark(session, transaction) -> None:
+    if transaction.parent is None:
+        session.info.pop(_WROTE, None)
+
+
+def _release_if_read_only(session) -> None:
+    """End a transaction that has only read, returning its connection to the pool.
+
+    Objects stay loaded (no expiry on commit); the next statement begins a new one.
+    """
+    if (session.in_transaction() and not session.info.get(_WROTE)
+            and not (session.new or session.dirty or session.deleted)):
+        session.commit()
+
+
+def _buffered(result):
+    if not getattr(result._metadata, "returns_rows", True):
+        return result  # DML, core or ORM bulk: nothing to fetch, rowcount is already known
+    return result.freeze()
+
+
+class AsyncSession:
+    def __init__(self, sync_session):
+        self.sync_session = sync_session
+        sync_session.expire_on_commit = False
+
+    def __getattr__(self, name):
+        # attributes of the wrapped session that do no I/O (shard, new, dirty, ...)
+        return getattr(self.sync_session, name)
+
+    def __setattr__(self, name, value):
+        if name == "sync_session":
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.sync_session, name, value)
+
+    async def _call(self, call: str, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        def call_and_release():
+            result = fn(*args, **kwargs)
+            _release_if_read_only(self.sync_session)
+            return result
+        with DB_WAIT_SECONDS.time(call=call):
+            return await run(call_and_release)
+
+    def add(self, instance) -> None:
+        self.sync_session.add(instance)
+
+    def add_all(self, instances) -> None:
+        self.sync_session.add_all(instances)
+
+    async def execute(self, statement, params=None, **kwargs):
+        result = await self._call("execute", lambda: _buffered(self.sync_session.execute(statement, params, **kwargs)))
+        return result() if isinstance(result, FrozenResult) else result
+
+    async def exec(self, statement, **kwargs):
+        """sqlmodel's Session.exec: scalars for a select() of one entity or column."""
+        result = await self.execute(statement, **kwargs)
+        return result.scalars() if isinstance(statement, SelectOfScalar) else result
+
+    async def scalar(self, statement, params=None, **kwargs):
+        return (await self.execute(statement, params, **kwargs)).scalar()
+
+    async def get(self, entity, ident, **kwargs):
+        return await self._call("get", self.sync_session.get, entity, ident, **kwargs)
+
+    async def flush(self) -> None:
+        await self._call("flush", self.sync_session.flush)
+
+    async def commit(self) -> None:
+        await self._call("commit", self.sync_session.commit)
+
+    async def rollback(self) -> None:
+        await self._call("rollback", self.sync_session.rollback)
+
+    async def refresh(self, instance) -> None:
+        await self._call("refresh", self.sync_session.refresh, instance)
+
+    async def delete(self, instance) -> None:
+        await self._call("delete", self.sync_session.delete, instance)
+
+    async def run_sync(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """fn(sync_session, *args, **kwargs) on a database thread."""
+        return await self._call(getattr(fn, "__name__", "run_sync"), fn, self.sync_session, *args, **kwargs)
+
+    async def close(self) -> None:
+        """Release the connection; the session stays usable and reconnects on the next query."""
+        await self._call("close", self.sync_session.close)
+
+    async def __aenter__(self) -> "AsyncSession":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
@@ -0,0 +1,24 @@
+"""
+Import smartemr-backend.py from scripts and tools.
+
+The file name is hyphenated, so it cannot be imported by name; load_backend() loads it
+once as the module `smartemr_backend` and returns the same module on later calls.
+"""
+
+import os
+import sys
+import importlib.util
+
+BACKEND_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "smartemr-backend.py")
+BACKEND_MODULE = "smartemr_backend"
+
+
+def load_backend():
+    """Import smartemr-backend.py (hyphenated, so not importable by name) as `smartemr_backend`."""
+    if BACKEND_MODULE in sys.modules:
+        return sys.modules[BACKEND_MODULE]
+    spec = importlib.util.spec_from_file_location(BACKEND_MODULE, BACKEND_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[BACKEND_MODULE] = module
+    spec.loader.exec_module(module)
+    return module
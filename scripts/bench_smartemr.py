@@ -0,0 +1,826 @@
+"""
+SmartEMR backend benchmarks
+
+Runs fully offline against local stand-ins for OpenAI and Firebase (local_standins.py)
+and a throwaway SQLite database, then prints one JSON document so results can be
+stored and compared across commits.
+
+Measures:
+1. chunk_text on small and large documents
+2. extract_text_from_upload for plain text and text PDFs
+3. retrieve_relevant_chunks against documents with 10 / 1k / 100k chunks
+4. Vector search variants (float32 scan, int8, int8 + full-precision rescore, reduced
+   dimensions): latency, bytes per vector and recall@k against the float32 scan
+5. End-to-end upload_report and /documents/qa latency and throughput with concurrent clients
+6. Prompt context size: naive "---" join of the top-k chunks vs token-budgeted packing
+7. Streaming NDJSON export of a patient with thousands of documents, plain and gzip:
+   rows/s, MB/s and peak Python heap while streaming; first patient-timeline page
+   latency for a short and a long history
+8. Ingest-time vitals extraction on short and long reports, and the structured-question matcher
+9. OCR of phone photos of reports: tesseract on the raw image vs the normalised one
+   (latency and character accuracy), preprocessing alone, and cached re-OCR; needs the
+   tesseract binary for the OCR runs, real scans can be given with --ocr-fixtures
+10. LLM admission control under a patient-portal burst: doctor vs patient latency
+    with priority scheduling and with a single FIFO class
+11. Sharded storage: document+chunk write throughput of concurrent doctors spread over
+    1..N per-doctor SQLite shards (directory id allocation included)
+12. Patient-portal load: timeline, report search and vitals requests from 1..64 concurrent
+    clients against one worker, throughput per concurrency with and without simulated
+    database latency (--db-latency-ms, slept on the database thread per statement)
+13. Cold start: backend import time and time until the lifespan startup completes,
+    plus the slowest imports from `python -X importtime`
+
+Usage:
+    python bench_smartemr.py --output bench.json
+    python bench_smartemr.py --quick                  # small sizes, suitable for CI
+    python bench_smartemr.py --latency-ms 80          # simulate upstream API latency
+    python bench_smartemr.py --db-latency-ms 5        # simulate a remote/cold database in the portal load run
+    python bench_smartemr.py --ocr-fixtures scans/    # page.jpg + page.txt ground truth pairs
+    python bench_smartemr.py --vectors uploads/vectors/<space>/gen-000000/vectors.f32 --dim 1536  # recall on real embeddings
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import asyncio
+import difflib
+import argparse
+import platform
+import tempfile
+import subprocess
+import statistics
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+
+import local_standins
+from backend_loader import load_backend
+
+SAMPLE_REPORT = """PATIENT: Jane Doe
+LABORATORY RESULTS - Date: 2025-01-15
+- Fasting Glucose: 145 mg/dL (HIGH) [Normal: 70-100]
+- HbA1c: 8.2% (HIGH) [Target: <7.0%]
+- LDL: 145 mg/dL (HIGH) [Target: <100]
+VITAL SIGNS:
+- Blood Pressure: 150/90 mmHg (HYPERTENSIVE)
+- Heart Rate: 72 bpm
+CLINICAL IMPRESSION:
+Type 2 Diabetes Mellitus with poor glycemic control. Hypertension. Dyslipidemia.
+"""
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline SmartEMR backend benchmarks")
+    parser.add_argument("--quick", action="store_true", help="small sizes and dimensions for CI")
+    parser.add_argument("--sizes", default=None, help="comma-separated chunk counts for retrieval")
+    parser.add_argument("--dim", type=int, default=None, help="embedding dimension of stand-in vectors")
+    parser.add_argument("--repeat", type=int, default=None, help="timed repetitions per micro-benchmark")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent clients for end-to-end runs")
+    parser.add_argument("--requests", type=int, default=None, help="upload+qa rounds per client")
+    parser.add_argument("--export-documents", type=int, default=None, help="documents of the exported patient")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="simulated upstream API latency")
+    parser.add_argument("--db-latency-ms", type=float, default=2.0,
+                        help="simulated per-statement database latency for the portal load run")
+    parser.add_argument("--provider", default="openai", choices=["openai", "local"],
+                        help="embedding provider (openai uses the local stand-in)")
+    parser.add_argument("--vectors", default=None,
+                        help="real embeddings for the vector search recall runs: .npy, or raw float32 "
+                             "rows of --dim values (e.g. a vector store's vectors.f32)")
+    parser.add_argument("--ocr-fixtures", default=None,
+                        help="directory of scanned report images, each with a .txt of its true text")
+    parser.add_argument("--output", default=None, help="also write the JSON results to this file")
+    args = parser.parse_args(argv)
+    args.sizes = [int(s) for s in (args.sizes or ("10,1000" if args.quick else "10,1000,100000")).split(",")]
+    args.dim = args.dim or (256 if args.quick else local_standins.EMBEDDING_DIM)
+    args.repeat = args.repeat or (5 if args.quick else 20)
+    args.requests = args.requests or (3 if args.quick else 10)
+    args.export_documents = args.export_documents or (1000 if args.quick else 5000)
+    return args
+
+
+def summarize(name: str, samples_ms: List[float], **params) -> Dict[str, Any]:
+    ordered = sorted(samples_ms)
+    total_s = sum(ordered) / 1000.0
+    return {
+        "name": name,
+        "params": params,
+        "n": len(ordered),
+        "mean_ms": statistics.fmean(ordered),
+        "p50_ms": ordered[len(ordered) // 2],
+        "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        "max_ms": ordered[-1],
+        "ops_per_sec": len(ordered) / total_s if total_s else None,
+    }
+
+
+def time_calls(fn: Callable[[], Any], repeat: int) -> List[float]:
+    fn()  # warm-up
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000.0)
+    return samples
+
+
+def make_text_pdf(text: str) -> bytes:
+    """Build a minimal single-page PDF with an extractable text layer."""
+    lines = text.splitlines() or [""]
+    escaped = [line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") for line in lines]
+    stream = "BT /F1 10 Tf 40 800 Td 12 TL " + " ".join(f"({line}) '" for line in escaped) + " ET"
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] "
+        "/Resources << /Font << /F1 5 0 R >> >> /Contents 4 0 R >>",
+        f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream",
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for i, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(f"{i} 0 obj\n{body}\nendobj\n".encode("latin-1"))
+    xref = out.tell()
+    out.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode())
+    for offset in offsets:
+        out.write(f"{offset:010d} 00000 n \n".encode())
+    out.write(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+    return out.getvalue()
+
+
+def bench_chunk_text(backend, repeat: int) -> List[Dict[str, Any]]:
+    results = []
+    for label, copies in (("10KB", 25), ("1MB", 2500)):
+        text = SAMPLE_REPORT * copies
+        samples = time_calls(lambda: backend.chunk_text(text), repeat)
+        results.append(summarize("chunk_text", samples, size=label, chars=len(text)))
+    return results
+
+
+def bench_extract(backend, repeat: int) -> List[Dict[str, Any]]:
+    from fastapi import UploadFile
+    from starlette.datastructures import Headers
+
+    payloads = {
+        "text/plain": (SAMPLE_REPORT * 40).encode("utf-8"),
+        "application/pdf": make_text_pdf(SAMPLE_REPORT),
+    }
+    results = []
+    for content_type, data in payloads.items():
+        def extract():
+            upload = UploadFile(io.BytesIO(data), filename="bench", headers=Headers({"content-type": content_type}))
+            return backend.extract_text_from_upload(upload)
+        samples = time_calls(extract, repeat)
+        results.append(summarize("extract_text_from_upload", samples, content_type=content_type, bytes=len(data)))
+    return results
+
+
+def seed_document_chunks(backend, n_chunks: int, dim: int, batch: int = 2000) -> int:
+    """Insert a document with `n_chunks` random unit-vector chunks; returns its id."""
+    rng = np.random.default_rng(n_chunks)
+    with backend.Session(backend.engine) as session:
+        doc = backend.Document(uuid=f"bench-{n_chunks}", filename=f"bench-{n_chunks}.txt", content_text="")
+        session.add(doc)
+        session.commit()
+        session.refresh(doc)
+        doc_id = doc.id
+    for start in range(0, n_chunks, batch):
+        count = min(batch, n_chunks - start)
+        vectors = rng.standard_normal((count, dim)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        rows = [
+            {
+                "document_id": doc_id,
+                "chunk_index": start + i,
+                "text": SAMPLE_REPORT,
+                "embedding_json": json.dumps(np.round(vec, 6).tolist()),
+                "embedding_model": backend.embedding_provider.key,
+            }
+            for i, vec in enumerate(vectors)
+        ]
+        with backend.Session(backend.engine) as session:
+            session.execute(backend.insert(backend.DocumentChunk), rows)
+            session.commit()
+    return doc_id
+
+
+def bench_retrieve(backend, sizes: List[int], dim: int, repeat: int) -> List[Dict[str, Any]]:
+    results = []
+    for n_chunks in sizes:
+        start = time.perf_counter()
+        doc_id = seed_document_chunks(backend, n_chunks, dim)
+        seed_s = time.perf_counter() - start
+        reps = repeat if n_chunks <= 10000 else max(3, repeat // 5)
+        samples = time_calls(
+            lambda: backend.retrieve_relevant_chunks(doc_id, "What is the HbA1c level?", top_k=6), reps
+        )
+        results.append(summarize("retrieve_relevant_chunks", samples, chunks=n_chunks, dim=dim,
+                                 seed_seconds=round(seed_s, 3)))
+    return results
+
+
+def bench_context_packing(backend, repeat: int) -> List[Dict[str, Any]]:
+    from context_packing import count_tokens, pack_context
+
+    chunks = backend.chunk_text(SAMPLE_REPORT * 60)
+    results = []
+    for top_k in (6, 20, 50):
+        # retrieval of a focused question tends to return neighbouring chunks
+        scored = [(i, chunks[i], 1.0 - i / top_k) for i in range(min(top_k, len(chunks)))]
+        naive_tokens = count_tokens("\n\n---\n\n".join(c for _, c, _ in scored))
+        packed = pack_context(scored, backend.CONTEXT_TOKEN_BUDGET)
+        samples = time_calls(lambda: pack_context(scored, backend.CONTEXT_TOKEN_BUDGET), repeat)
+        results.append(summarize("pack_context", samples, top_k=top_k, budget=backend.CONTEXT_TOKEN_BUDGET,
+                                 naive_tokens=naive_tokens, packed_tokens=packed.tokens,
+                                 packed_chunks=len(packed.chunk_indexes)))
+    return results
+
+
+def bench_vitals_extraction(repeat: int) -> List[Dict[str, Any]]:
+    from vitals_extraction import extract_vitals, match_question
+
+    results = []
+    for copies in (1, 100):
+        text = SAMPLE_REPORT * copies
+        samples = time_calls(lambda: extract_vitals(text), repeat)
+        results.append(summarize("extract_vitals", samples, chars=len(text), readings=len(extract_vitals(text))))
+    questions = ["What is the blood pressure reading?", "HbA1c?", "Is the blood pressure controlled?"]
+    samples = time_calls(lambda: [match_question(q) for q in questions], repeat)
+    results.append(summarize("match_question", samples, questions=len(questions)))
+    return results
+
+
+def photograph_page(text: str, seed: int) -> bytes:
+    """A report page as a phone would photograph it: 12 MP colour JPEG, sideways, EXIF-rotated, noisy."""
+    from PIL import Image, ImageDraw, ImageFont, ImageFilter
+
+    page = Image.new("L", (2480, 3508), 255)  # A4 at 300 DPI
+    draw = ImageDraw.Draw(page)
+    font = ImageFont.load_default(size=44)
+    for i, line in enumerate(text.splitlines()):
+        draw.text((180, 220 + i * 72), line, fill=0, font=font)
+    photo = page.resize((3024, 4032), Image.BICUBIC).filter(ImageFilter.GaussianBlur(1.2))
+    noise = np.random.default_rng(seed).normal(0, 12, (4032, 3024))
+    pixels = np.clip(np.asarray(photo, dtype=np.float32) + noise, 0, 255).astype(np.uint8)
+    photo = Image.fromarray(pixels).convert("RGB").transpose(Image.ROTATE_90)  # sensor landscape
+    exif = photo.getexif()
+    exif[0x0112] = 6  # viewers rotate 90 degrees clockwise
+    out = io.BytesIO()
+    photo.save(out, "JPEG", quality=90, exif=exif)
+    return out.getvalue()
+
+
+def load_ocr_fixtures(directory: str = None) -> List[tuple]:
+    """(name, image bytes, true text) for a fixture directory, or synthetic photographed reports."""
+    if directory:
+        fixtures = []
+        for name in sorted(os.listdir(directory)):
+            stem, ext = os.path.splitext(name)
+            truth = os.path.join(directory, stem + ".txt")
+            if ext.lower() in (".jpg", ".jpeg", ".png", ".tif", ".tiff") and os.path.exists(truth):
+                with open(os.path.join(directory, name), "rb") as img, open(truth, encoding="utf-8") as txt:
+                    fixtures.append((name, img.read(), txt.read()))
+        return fixtures
+    pages = [SAMPLE_REPORT, SAMPLE_REPORT.replace("Jane Doe", "John Roe").replace("145", "162")]
+    return [(f"synthetic-{i}.jpg", photograph_page(text, i), text) for i, text in enumerate(pages)]
+
+
+def char_accuracy(text: str, truth: str) -> float:
+    a, b = " ".join(text.split()), " ".join(truth.split())
+    return difflib.SequenceMatcher(None, a, b, autojunk=False).ratio()
+
+
+def bench_ocr(backend, repeat: int, fixtures_dir: str = None) -> List[Dict[str, Any]]:
+    import pytesseract
+    from PIL import Image
+    import ocr_pipeline
+
+    fixtures = load_ocr_fixtures(fixtures_dir)
+    results = []
+    samples = []
+    for _, content, _ in fixtures:
+        samples += time_calls(lambda: ocr_pipeline.preprocess(content, backend.OCR_TARGET_DPI), repeat)
+    results.append(summarize("ocr_preprocess", samples, images=len(fixtures), target_dpi=backend.OCR_TARGET_DPI))
+    try:
+        pytesseract.get_tesseract_version()
+    except Exception as e:
+        results.append({"name": "ocr", "params": {}, "skipped": f"tesseract unavailable: {e}"})
+        return results
+
+    variants = {
+        "raw": lambda content: pytesseract.image_to_string(Image.open(io.BytesIO(content))),
+        "preprocessed": lambda content: pytesseract.image_to_string(ocr_pipeline.preprocess(
+            content, backend.OCR_TARGET_DPI, backend.OCR_DETECT_ORIENTATION)),
+    }
+    for variant, ocr in variants.items():
+        samples, accuracy = [], []
+        for _, content, truth in fixtures:
+            start = time.perf_counter()
+            text = ocr(content)
+            samples.append((time.perf_counter() - start) * 1000.0)
+            accuracy.append(char_accuracy(text, truth))
+        result = summarize("ocr_image", samples, variant=variant, images=len(fixtures))
+        result["char_accuracy"] = statistics.fmean(accuracy)
+        results.append(result)
+
+    for _, content, _ in fixtures:
+        backend.ocr_image_bytes(content)  # fill the cache
+    samples = []
+    for _, content, _ in fixtures:
+        samples += time_calls(lambda: backend.ocr_image_bytes(content), repeat)
+    results.append(summarize("ocr_image", samples, variant="cached", images=len(fixtures)))
+    return results
+
+
+def clustered_vectors(rng: "np.random.Generator", n: int, dim: int) -> "np.ndarray":
+    """Unit vectors drawn around n/50 random centres, so nearest neighbours are meaningful."""
+    centres = rng.standard_normal((max(8, n // 50), dim))
+    vectors = centres[rng.integers(len(centres), size=n)] + 0.6 * rng.standard_normal((n, dim))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def load_vectors(path: str, dim: int) -> "np.ndarray":
+    vectors = np.load(path) if path.endswith(".npy") else np.fromfile(path, dtype=np.float32).reshape(-1, dim)
+    vectors = vectors[np.linalg.norm(vectors, axis=1) > 0]
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def bench_vector_search(backend, sizes: List[int], dim: int, repeat: int, vectors_path: str = None,
+                        top_k: int = 6, n_queries: int = 50) -> List[Dict[str, Any]]:
+    """Compare search variants against an exact float32 scan.
+
+    Reduced dimensions are simulated by truncating and re-normalising (what the
+    embeddings API `dimensions` parameter does). Synthetic vectors spread information
+    evenly across dimensions, unlike text-embedding-3 models, so their reduced-dim
+    recall is a pessimistic bound; pass --vectors with real embeddings to choose
+    a dimension.
+    """
+    from vector_store import quantize_int8, quantized_scores
+
+    results = []
+    shortlist = max(backend.RESCORE_CANDIDATES, top_k)
+    real = load_vectors(vectors_path, dim) if vectors_path else None
+    if real is not None:
+        sizes, dim = [len(real)], real.shape[1]
+    for n in sizes:
+        rng = np.random.default_rng(n + 1)
+        corpus = real if real is not None else clustered_vectors(rng, n, dim)
+        queries = corpus[rng.integers(n, size=n_queries)] + 0.3 * rng.standard_normal((n_queries, dim)).astype(np.float32)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+        truth = [set(np.argsort(-(corpus @ q))[:top_k]) for q in queries]
+        q8, scales = quantize_int8(corpus)
+
+        def topk(scores):
+            return np.argsort(-scores, kind="stable")[:top_k]
+
+        def int8_rescore(q):
+            approx = quantized_scores(q8, scales, q)
+            candidates = np.argpartition(-approx, shortlist - 1)[:shortlist] if n > shortlist else np.arange(n)
+            return candidates[topk(corpus[candidates] @ q)]
+
+        variants = [
+            ("float32", dim, dim * 4, lambda q: topk(corpus @ q)),
+            ("int8", dim, dim + 4, lambda q: topk(quantized_scores(q8, scales, q))),
+            ("int8_rescore", dim, dim + 4, int8_rescore),
+        ]
+        for reduced in (dim // 2, dim // 4):
+            small = corpus[:, :reduced] / np.linalg.norm(corpus[:, :reduced], axis=1, keepdims=True)
+            variants.append((f"float32_dim{reduced}", reduced, reduced * 4,
+                             lambda q, small=small, reduced=reduced: topk(small @ q[:reduced])))
+
+        for name, used_dim, nbytes, search in variants:
+            recall = statistics.fmean(len(truth[i] & set(search(q).tolist())) / top_k
+                                      for i, q in enumerate(queries))
+            samples = time_calls(lambda: search(queries[0]), repeat)
+            results.append(summarize("vector_search", samples, variant=name, vectors=n, dim=used_dim,
+                                     bytes_per_vector=nbytes, recall_at_k=round(recall, 4), k=top_k))
+    return results
+
+
+async def bench_admission(call_ms: float = 50.0, concurrency: int = 4, doctors: int = 4,
+                          patients: int = 40, rounds: int = 5) -> List[Dict[str, Any]]:
+    """Simulated chat calls through admission.LLMScheduler while patients burst."""
+    from admission import AdmissionRejected, LLMScheduler
+
+    results = []
+    for mode in ("priority", "fifo"):
+        scheduler = LLMScheduler(concurrency, max_queue=patients * 2, queue_timeout_s=30.0, batch_queue_timeout_s=30.0)
+        latencies: Dict[str, List[float]] = {"doctor": [], "patient": []}
+        rejected = 0
+
+        async def user(role: str, uid: str, think_ms: float):
+            nonlocal rejected
+            priority = f"{role}_interactive" if mode == "priority" else "patient_interactive"
+            for _ in range(rounds):
+                start = time.perf_counter()
+                try:
+                    async with scheduler.slot(uid, priority):
+                        await asyncio.sleep(call_ms / 1000.0)
+                    latencies[role].append((time.perf_counter() - start) * 1000.0)
+                except AdmissionRejected:
+                    rejected += 1
+                await asyncio.sleep(think_ms / 1000.0)
+
+        await asyncio.gather(
+            *(user("doctor", f"doctor-{i}", call_ms) for i in range(doctors)),
+            *(user("patient", f"patient-{i}", 0.0) for i in range(patients)),
+        )
+        for role, samples in latencies.items():
+            results.append(summarize("llm_admission", samples, mode=mode, role=role, concurrency=concurrency,
+                                     call_ms=call_ms, rejected=rejected))
+    return results
+
+
+def _shard_writer(root: str, shard_map: Dict[str, str], writer: int, documents: int, chunks: int,
+                  barrier, results) -> None:
+    """Child process: commit `documents` documents with `chunks` chunk rows each as one doctor."""
+    import sharding
+    backend = sys.modules[local_standins.BACKEND_MODULE]
+    router = sharding.ShardRouter(backend.create_engine(f"sqlite:///{root}/directory.db"), os.path.join(root, "shards"),
+                                  shard_map, backend.DIRECTORY_TABLES, prepare=backend.prepare_shard)
+    backend.shards = router  # reserve_directory_entries routes through it
+    uid = f"doctor-{writer}"
+    router.engine_for(router.shard_for_doctor(uid))  # schema check is not part of the timing
+    text = (SAMPLE_REPORT * 3)[:1000]
+    barrier.wait()
+    start = time.perf_counter()
+    for n in range(documents):
+        with router.session(router.shard_for_doctor(uid)) as session:
+            report_id = f"REP-BENCH-{writer}-{n}"
+            doc_id = backend.reserve_directory_entries(session, backend.DocumentShard, report_id=report_id)
+            session.add(backend.Document(id=doc_id, uuid=report_id, owner_uid=uid, filename="bench.txt",
+                                         content_text=text * chunks, report_id=report_id))
+            session.execute(backend.insert(backend.DocumentChunk), [
+                {"document_id": doc_id, "chunk_index": i, "text": text, "embedding_json": "[]"}
+                for i in range(chunks)
+            ])
+            session.commit()
+    results.put(time.perf_counter() - start)
+
+
+def bench_shard_writes(backend, tmp_dir: str, shard_counts: List[int], writers: int,
+                       documents: int, chunks: int = 20) -> List[Dict[str, Any]]:
+    """Documents/s committed by `writers` processes (one doctor each, like uvicorn workers) over 1..N shards.
+
+    Processes rather than threads: each shard has its own writer lock, but one
+    interpreter's threads would serialise on the GIL first.
+    """
+    import multiprocessing
+    import sharding
+
+    ctx = multiprocessing.get_context("fork")
+    results = []
+    for count in shard_counts:
+        root = os.path.join(tmp_dir, f"shards-{count}")
+        os.makedirs(root)
+        directory = backend.create_engine(f"sqlite:///{root}/directory.db")
+        backend.SQLModel.metadata.create_all(directory, tables=backend.database_tables(directory=True))
+        directory.dispose()
+        shard_map = {f"doctor-{w}": f"shard-{w % count}" for w in range(writers)}
+        router = sharding.ShardRouter(directory, os.path.join(root, "shards"), shard_map,
+                                      backend.DIRECTORY_TABLES, prepare=backend.prepare_shard)
+        for shard in set(shard_map.values()):
+            router.engine_for(shard)  # create the files before the writers race to
+        router.dispose()
+
+        barrier, queue = ctx.Barrier(writers), ctx.Queue()
+        procs = [ctx.Process(target=_shard_writer, args=(root, shard_map, w, documents, chunks, barrier, queue))
+                 for w in range(writers)]
+        for proc in procs:
+            proc.start()
+        elapsed = max(queue.get() for _ in procs)
+        for proc in procs:
+            proc.join()
+        total = writers * documents
+        results.append({
+            "name": "sharded_writes",
+            "params": {"shards": count, "writers": writers, "chunks_per_document": chunks,
+                       "cpus": os.cpu_count()},
+            "n": total,
+            "documents_per_sec": total / elapsed,
+            "chunk_rows_per_sec": total * chunks / elapsed,
+        })
+    return results
+
+
+async def bench_end_to_end(backend, clients: int, rounds: int) -> List[Dict[str, Any]]:
+    import httpx
+
+    upload_ms: List[float] = []
+    qa_ms: List[float] = []
+
+    async def run_client(i: int, http: "httpx.AsyncClient"):
+        headers = {"Authorization": f"Bearer bench-doctor-{i}"}
+        await http.post("/auth/register", json={"name": f"Dr. Bench {i}", "role": "doctor"}, headers=headers)
+        resp = await http.post("/doctor/patients/create", json={"name": f"Bench Patient {i}"}, headers=headers)
+        patient_id = resp.json()["patient_id"]
+        for r in range(rounds):
+            body = f"{SAMPLE_REPORT}\nVisit {r} for client {i}\n".encode("utf-8") * 20
+            start = time.perf_counter()
+            resp = await http.post(
+                f"/doctor/patients/{patient_id}/upload_report",
+                files={"file": (f"report-{i}-{r}.txt", body, "text/plain")},
+                headers=headers,
+            )
+            upload_ms.append((time.perf_counter() - start) * 1000.0)
+            resp.raise_for_status()
+            document_id = resp.json()["document_id"]
+
+            start = time.perf_counter()
+            resp = await http.post("/documents/qa", json={
+                "document_id": document_id,
+                "question": "What is the blood pressure reading?",
+                "top_k": 4,
+            }, headers=headers)
+            qa_ms.append((time.perf_counter() - start) * 1000.0)
+            resp.raise_for_status()
+
+    transport = httpx.ASGITransport(app=backend.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as http:
+        start = time.perf_counter()
+        await asyncio.gather(*(run_client(i, http) for i in range(clients)))
+        wall_s = time.perf_counter() - start
+
+    results = []
+    for name, samples in (("upload_report", upload_ms), ("documents_qa", qa_ms)):
+        summary = summarize(name, samples, clients=clients, rounds_per_client=rounds)
+        summary["throughput_rps"] = len(samples) / wall_s
+        results.append(summary)
+    return results
+
+
+def seed_export_patient(backend, documents: int, vitals_per_visit: int = 10) -> int:
+    """Insert a patient with `documents` reports, documents, visits and vitals directly."""
+    from sqlmodel import Session, insert
+
+    with Session(backend.engine) as session:
+        patient = backend.Patient(name="Export Bench Patient", owner_doctor_uid="bench-export")
+        session.add(patient)
+        session.commit()
+        session.refresh(patient)
+        now = backend.datetime.datetime.utcnow()
+        for start in range(0, documents, 500):
+            ids = range(start, min(documents, start + 500))
+            visit_ids = session.execute(insert(backend.Visit).returning(backend.Visit.id, sort_by_parameter_order=True), [dict(
+                patient_id=patient.id, doctor_uid="bench-export", visit_date=now - backend.datetime.timedelta(hours=i),
+                notes=f"Report {i}") for i in ids]).scalars().all()
+            session.execute(insert(backend.Report), [dict(
+                report_id=f"REP-BENCH-{i:06d}", patient_id=patient.id, doctor_uid="bench-export",
+                filename=f"report-{i}.txt", file_path="", visit_id=v, created_at=now) for i, v in zip(ids, visit_ids)])
+            session.execute(insert(backend.Document), [dict(
+                uuid=f"bench-{i}", owner_uid="bench-export", filename=f"report-{i}.txt", created_at=now,
+                content_text=SAMPLE_REPORT * 8, report_id=f"REP-BENCH-{i:06d}", patient_id=patient.id) for i in ids])
+        visit_ids = session.exec(backend.select(backend.Visit.id).where(backend.Visit.patient_id == patient.id)).all()
+        for start in range(0, len(visit_ids), 500):
+            session.execute(insert(backend.Vital), [dict(
+                visit_id=v, name="heart_rate", value=60.0 + k, unit="bpm", recorded_at=now)
+                for v in visit_ids[start:start + 500] for k in range(vitals_per_visit)])
+        session.commit()
+        return patient.id
+
+
+async def bench_export(backend, documents: int) -> List[Dict[str, Any]]:
+    import httpx
+    import tracemalloc
+
+    headers = {"Authorization": "Bearer bench-export"}
+    transport = httpx.ASGITransport(app=backend.app)
+    results = []
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as http:
+        await http.post("/auth/register", json={"name": "Dr. Export", "role": "doctor"}, headers=headers)
+        patient_id = seed_export_patient(backend, documents)
+
+        async def stream(compress: bool):
+            received = lines = 0
+            async with http.stream("GET", f"/patients/{patient_id}/export", params={"compress": compress},
+                                   headers=headers) as resp:
+                resp.raise_for_status()
+                async for chunk in resp.aiter_raw():
+                    received += len(chunk)
+                    lines += 0 if compress else chunk.count(b"\n")
+            return received, lines
+
+        for compress in (False, True):
+            start = time.perf_counter()
+            received, lines = await stream(compress)
+            elapsed_s = time.perf_counter() - start
+            # Separate pass over the response generator itself: tracing slows the export several
+            # times over, and httpx's ASGI transport buffers whole response bodies.
+            tracemalloc.start()
+            for _ in backend.ndjson_export.encode_pages(backend.export_pages(patient_id, None, 0, (0,)), compress):
+                pass
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            summary = summarize("export_stream", [elapsed_s * 1000.0], documents=documents, gzip=compress,
+                                page_rows=backend.EXPORT_PAGE_ROWS)
+            summary.update(bytes=received, mb_per_s=received / elapsed_s / 1e6, peak_heap_mb=peak / 1e6)
+            if lines:
+                summary["rows_per_s"] = lines / elapsed_s
+            results.append(summary)
+    return results
+
+
+async def bench_portal_load(backend, concurrencies: List[int], requests: int,
+                            db_latency_ms: float) -> List[Dict[str, Any]]:
+    """Requests/s of one worker serving a patient-portal mix as concurrent clients grow.
+
+    With db_latency_ms, every statement sleeps that long on its database thread first,
+    standing in for a database whose reads wait on the disk or the network.
+    """
+    import httpx
+    from sqlalchemy import event
+
+    headers = {"Authorization": "Bearer bench-export"}
+    transport = httpx.ASGITransport(app=backend.app)
+    results = []
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as http:
+        await http.post("/auth/register", json={"name": "Dr. Export", "role": "doctor"}, headers=headers)
+        patient_id = seed_export_patient(backend, 200)
+        paths = [
+            (f"/patients/{patient_id}/timeline", {"limit": 20, "vitals_limit": 5}),
+            (f"/patients/{patient_id}/vitals", {"name": "heart_rate", "buckets": 50}),
+            ("/patient/reports/search/REP-BENCH-000007", {}),
+        ]
+
+        def slow_statement(*_):
+            time.sleep(db_latency_ms / 1000.0)
+
+        for latency_ms in sorted({0.0, db_latency_ms}):
+            if latency_ms:
+                event.listen(backend.engine, "before_cursor_execute", slow_statement)
+            try:
+                for concurrency in concurrencies:
+                    samples: List[float] = []
+                    pending = iter(range(requests))
+
+                    async def client():
+                        for i in pending:
+                            path, params = paths[i % len(paths)]
+                            start = time.perf_counter()
+                            resp = await http.get(path, params=params, headers=headers)
+                            samples.append((time.perf_counter() - start) * 1000.0)
+                            resp.raise_for_status()
+
+                    start = time.perf_counter()
+                    await asyncio.gather(*(client() for _ in range(concurrency)))
+                    wall_s = time.perf_counter() - start
+                    summary = summarize("portal_load", samples, clients=concurrency, db_latency_ms=latency_ms,
+                                        db_threads=backend.DB_THREADS)
+                    summary["throughput_rps"] = len(samples) / wall_s
+                    results.append(summary)
+            finally:
+                if latency_ms:
+                    event.remove(backend.engine, "before_cursor_execute", slow_statement)
+    return results
+
+
+async def bench_timeline(backend, histories: List[int], repeat: int) -> List[Dict[str, Any]]:
+    """First timeline page (50 visits with vitals and reports) for short and long histories."""
+    import httpx
+
+    headers = {"Authorization": "Bearer bench-export"}
+    transport = httpx.ASGITransport(app=backend.app)
+    results = []
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as http:
+        await http.post("/auth/register", json={"name": "Dr. Export", "role": "doctor"}, headers=headers)
+        for documents in histories:
+            patient_id = seed_export_patient(backend, documents)
+            samples = []
+            for _ in range(repeat + 1):
+                start = time.perf_counter()
+                resp = await http.get(f"/patients/{patient_id}/timeline", params={"limit": 50}, headers=headers)
+                samples.append((time.perf_counter() - start) * 1000.0)
+                resp.raise_for_status()
+            results.append(summarize("patient_timeline", samples[1:], visits=documents, limit=50))
+    return results
+
+
+STARTUP_SNIPPET = """
+import json, time, asyncio, importlib.util
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location("smartemr_backend", {path!r})
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+imported = time.perf_counter()
+
+async def startup():
+    async with module.lifespan(module.app):
+        pass
+
+asyncio.run(startup())
+ready = time.perf_counter()
+print(json.dumps({{"import_ms": (imported - start) * 1000.0, "ready_ms": (ready - start) * 1000.0}}))
+"""
+
+
+def parse_importtime(stderr: str, top: int = 10) -> List[Dict[str, Any]]:
+    """Return the top-level imports with the largest cumulative time."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, self_us, cumulative_us, name = (part.strip() for part in line.replace("import time:", "|").split("|"))
+        if not name.startswith(" ") and "." not in name:
+            rows.append({"module": name, "cumulative_ms": int(cumulative_us) / 1000.0})
+    return sorted(rows, key=lambda r: r["cumulative_ms"], reverse=True)[:top]
+
+
+def bench_startup(repeat: int, tmp_dir: str) -> List[Dict[str, Any]]:
+    """Time fresh interpreter startups importing the backend and running its lifespan."""
+    env = dict(os.environ, USE_AUTH="false", STARTUP_WARMUP="false",
+               DATABASE_URL=f"sqlite:///{tmp_dir}/startup.db")
+    code = STARTUP_SNIPPET.format(path=local_standins.BACKEND_PATH)
+    cwd = os.path.dirname(local_standins.BACKEND_PATH)
+    subprocess.run([sys.executable, "-c", code], env=env, cwd=cwd, check=True, capture_output=True)  # create schema
+
+    process_ms, import_ms, ready_ms = [], [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = subprocess.run([sys.executable, "-c", code], env=env, cwd=cwd, check=True,
+                             capture_output=True, text=True)
+        process_ms.append((time.perf_counter() - start) * 1000.0)
+        timings = json.loads(out.stdout.strip().splitlines()[-1])
+        import_ms.append(timings["import_ms"])
+        ready_ms.append(timings["ready_ms"])
+
+    traced = subprocess.run([sys.executable, "-X", "importtime", "-c", code], env=env, cwd=cwd,
+                            check=True, capture_output=True, text=True)
+    results = [
+        summarize("startup_import", import_ms),
+        summarize("startup_ready", ready_ms),
+        summarize("startup_process", process_ms),
+    ]
+    results[0]["top_imports"] = parse_importtime(traced.stderr)
+    return results
+
+
+def git_revision() -> str:
+    try:
+        out = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main(argv=None) -> Dict[str, Any]:
+    args = parse_args(argv)
+
+    tmp_dir = tempfile.mkdtemp(prefix="smartemr-bench-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{tmp_dir}/bench.db"
+    os.environ["UPLOAD_DIR"] = os.path.join(tmp_dir, "uploads")
+    os.environ["USE_AUTH"] = "true"  # exercised through the Firebase stand-in
+    os.environ["EMBEDDING_PROVIDER"] = args.provider
+    os.environ["EMBEDDING_DIM"] = str(args.dim)
+    local_standins.install(latency_ms=args.latency_ms, embedding_dim=args.dim)
+    backend = load_backend()
+    backend.ensure_db()
+
+    results: List[Dict[str, Any]] = []
+    results += bench_chunk_text(backend, args.repeat)
+    results += bench_extract(backend, args.repeat)
+    results += bench_retrieve(backend, args.sizes, args.dim, args.repeat)
+    results += bench_vector_search(backend, [n for n in args.sizes if n >= 1000], args.dim, args.repeat,
+                                   args.vectors)
+    results += bench_context_packing(backend, args.repeat)
+    results += asyncio.run(bench_export(backend, args.export_documents))
+    results += asyncio.run(bench_timeline(backend, [100, args.export_documents], args.repeat))
+    results += bench_vitals_extraction(args.repeat)
+    results += bench_ocr(backend, max(2, args.repeat // 4), args.ocr_fixtures)
+    results += asyncio.run(bench_end_to_end(backend, args.clients, args.requests))
+    results += bench_shard_writes(backend, tmp_dir, [1, 2, 4, 8], writers=8,
+                                  documents=20 if args.quick else 100)
+    results += asyncio.run(bench_admission(rounds=args.requests))
+    results += asyncio.run(bench_portal_load(backend, [1, 4, 16, 64], 100 if args.quick else 600,
+                                             args.db_latency_ms))
+    results += bench_startup(max(3, args.repeat // 2), tmp_dir)
+
+    report = {
+        "suite": "smartemr-backend",
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "quick": args.quick,
+            "embedding_provider": backend.embedding_provider.key,
+            "embedding_dim": args.dim,
+            "latency_ms": args.latency_ms,
+            "clients": args.clients,
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    return report
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
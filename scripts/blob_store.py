@@ -0,0 +1,147 @@
+"""
+Content-addressed file store for uploaded reports.
+
+Blobs live at {root}/{sha[:2]}/{sha}[.zst], keyed by the sha256 of the original
+bytes, so a byte-identical re-upload resolves to the file already on disk.
+Text-like payloads are zstd-compressed when the `zstandard` package is available.
+
+Files are never deleted while being referenced: the caller keeps refcounts and
+removes unreferenced files with remove_if_idle(). put() refreshes the mtime of a
+blob it resolves to, so a file whose mtime is recent may be about to gain a reference.
+"""
+
+import os
+import re
+import hashlib
+import tempfile
+from typing import BinaryIO, Iterator, NamedTuple, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:  # compression is optional
+    zstandard = None
+
+COPY_BUFFER_SIZE = 1024 * 1024
+ZSTD_LEVEL = 10
+ZSTD_SUFFIX = ".zst"
+
+TEXT_LIKE_TYPES = ("application/json", "application/xml", "application/text", "application/rtf")
+TEXT_LIKE_EXTENSIONS = (".txt", ".csv", ".json", ".xml", ".html", ".htm", ".md", ".rtf", ".hl7")
+
+
+class StoredBlob(NamedTuple):
+    digest: str
+    path: str
+    size: int
+    stored_size: int
+    compression: Optional[str]
+    existed: bool
+
+
+def is_text_like(content_type: Optional[str], filename: Optional[str]) -> bool:
+    if content_type and (content_type.startswith("text/") or content_type in TEXT_LIKE_TYPES):
+        return True
+    return bool(filename) and filename.lower().endswith(TEXT_LIKE_EXTENSIONS)
+
+
+def blob_path(root: str, digest: str, compressed: bool) -> str:
+    return os.path.join(root, digest[:2], digest + (ZSTD_SUFFIX if compressed else ""))
+
+
+def find_blob(root: str, digest: str) -> Optional[str]:
+    for compressed in (True, False):
+        path = blob_path(root, digest, compressed)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def put(root: str, src: BinaryIO, compress: bool = False) -> StoredBlob:
+    """Stream `src` into the store, hashing as it goes. Existing blobs are not rewritten."""
+    os.makedirs(root, exist_ok=True)
+    hasher = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=root, prefix=".incoming-")
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            while True:
+                block = src.read(COPY_BUFFER_SIZE)
+                if not block:
+                    break
+                hasher.update(block)
+                tmp.write(block)
+                size += len(block)
+        digest = hasher.hexdigest()
+
+        existing = find_blob(root, digest)
+        if existing:
+            os.utime(existing)  # see remove_if_idle()
+            return StoredBlob(digest, existing, size, os.path.getsize(existing),
+                              "zstd" if existing.endswith(ZSTD_SUFFIX) else None, True)
+
+        compressed = compress and zstandard is not None
+        final_path = blob_path(root, digest, compressed)
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        if compressed:
+            packed_path = tmp_path + ZSTD_SUFFIX
+            with open(tmp_path, "rb") as raw, open(packed_path, "wb") as packed:
+                zstandard.ZstdCompressor(level=ZSTD_LEVEL).copy_stream(raw, packed, size=size)
+            os.remove(tmp_path)
+            tmp_path = packed_path
+        os.replace(tmp_path, final_path)  # atomic publish
+        return StoredBlob(digest, final_path, size, os.path.getsize(final_path),
+                          "zstd" if compressed else None, False)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def read(path: str) -> bytes:
+    """Return the original bytes of a stored blob (or of a legacy, uncompressed upload)."""
+    with open(path, "rb") as f:
+        if not path.endswith(ZSTD_SUFFIX):
+            return f.read()
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read compressed blobs")
+        with zstandard.ZstdDecompressor().stream_reader(f) as reader:
+            return reader.read()
+
+
+def delete(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+_BLOB_NAME = re.compile(r"^([0-9a-f]{64})(?:" + re.escape(ZSTD_SUFFIX) + r")?$")
+
+
+def iter_blobs(root: str) -> Iterator[Tuple[str, str]]:
+    """(digest, path) of every blob file under `root`."""
+    if not os.path.isdir(root):
+        return
+    for prefix in os.listdir(root):
+        directory = os.path.join(root, prefix)
+        if len(prefix) != 2 or not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            match = _BLOB_NAME.match(name)
+            if match and match.group(1).startswith(prefix):
+                yield match.group(1), os.path.join(directory, name)
+
+
+def is_idle(path: str, cutoff: float) -> bool:
+    """True if `path` was last stored (or resolved by put()) before `cutoff` (epoch seconds)."""
+    try:
+        return os.path.getmtime(path) < cutoff
+    except FileNotFoundError:
+        return False
+
+
+def remove_if_idle(path: str, cutoff: float) -> bool:
+    """Delete an unreferenced blob unless put() resolved to it since `cutoff`."""
+    if not is_idle(path, cutoff):
+        return False
+    delete(path)
+    return True
@@ -0,0 +1,16 @@
+"""Run the test suite offline: local stand-ins for OpenAI/Firebase and a throwaway database."""
+import os
+import tempfile
+
+import local_standins
+from backend_loader import load_backend
+
+_tmp_dir = tempfile.mkdtemp(prefix="smartemr-test-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_tmp_dir}/smartemr.db")
+os.environ.setdefault("UPLOAD_DIR", os.path.join(_tmp_dir, "uploads"))
+os.environ.setdefault("PROFILE_DIR", os.path.join(_tmp_dir, "profiles"))
+os.environ.setdefault("PROFILE_HEADER_ENABLED", "true")
+os.environ["USE_AUTH"] = "false"
+
+local_standins.install()
+load_backend()
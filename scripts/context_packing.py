@@ -0,0 +1,111 @@
+"""
+Token-budgeted prompt context built from retrieved chunks.
+
+chunk_text() overlaps neighbouring chunks by ~200 characters, so when retrieval returns
+chunks i and i+1 their raw concatenation repeats text. pack_context() merges runs of
+consecutive chunk_index values into one passage, dropping the shared overlap, and adds
+chunks greedily by retrieval score while the rendered context stays within the token
+budget. Passages are emitted in document order.
+
+Tokens are counted with tiktoken when it is installed and its encoding is available,
+otherwise estimated at 4 characters per token.
+"""
+
+import threading
+from typing import Dict, List, NamedTuple, Sequence, Tuple
+
+SEPARATOR = "\n\n---\n\n"
+MIN_OVERLAP = 16  # shorter suffix/prefix matches are treated as coincidence
+MAX_OVERLAP = 400
+
+_encoding = None
+_encoding_lock = threading.Lock()
+_encoding_loaded = False
+
+
+def _get_encoding(model: str):
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        with _encoding_lock:
+            if not _encoding_loaded:
+                try:
+                    import tiktoken
+                    try:
+                        _encoding = tiktoken.encoding_for_model(model)
+                    except KeyError:
+                        _encoding = tiktoken.get_encoding("cl100k_base")
+                except Exception:  # not installed, or the BPE file cannot be fetched offline
+                    _encoding = None
+                _encoding_loaded = True
+    return _encoding
+
+
+def count_tokens(text: str, model: str = "gpt-4o-mini") -> int:
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def merge_overlapping(a: str, b: str) -> str:
+    """Join consecutive chunks, keeping the text they share only once."""
+    for k in range(min(len(a), len(b), MAX_OVERLAP), MIN_OVERLAP - 1, -1):
+        if a.endswith(b[:k]):
+            return a + b[k:]
+    return a + "\n" + b
+
+
+def render(chunks: Dict[int, str]) -> Tuple[str, List[List[int]]]:
+    """Merge runs of consecutive chunk indexes; returns the context and the runs."""
+    runs: List[List[int]] = []
+    for idx in sorted(chunks):
+        if runs and runs[-1][-1] == idx - 1:
+            runs[-1].append(idx)
+        else:
+            runs.append([idx])
+    passages = []
+    for run in runs:
+        text = chunks[run[0]]
+        for idx in run[1:]:
+            text = merge_overlapping(text, chunks[idx])
+        passages.append(text)
+    return SEPARATOR.join(passages), runs
+
+
+class PackedContext(NamedTuple):
+    text: str
+    tokens: int
+    chunk_indexes: List[int]
+    passages: int
+    dropped: int  # retrieved chunks left out to stay within the budget
+
+
+def pack_context(scored_chunks: Sequence[Tuple[int, str, float]], budget: int,
+                 model: str = "gpt-4o-mini") -> PackedContext:
+    """Greedily pack (chunk_index, text, score) chunks by score within `budget` tokens."""
+    selected: Dict[int, str] = {}
+    text, tokens, runs = "", 0, []
+    for idx, chunk, _ in sorted(scored_chunks, key=lambda c: c[2], reverse=True):
+        trial = dict(selected)
+        trial[idx] = chunk
+        trial_text, trial_runs = render(trial)
+        trial_tokens = count_tokens(trial_text, model)
+        if trial_tokens <= budget:
+            selected, text, tokens, runs = trial, trial_text, trial_tokens, trial_runs
+    if not selected and scored_chunks:
+        # even the best chunk alone is over budget: keep a truncated prefix of it
+        idx, chunk, _ = max(scored_chunks, key=lambda c: c[2])
+        text = _truncate(chunk, budget, model)
+        selected, tokens, runs = {idx: text}, count_tokens(text, model), [[idx]]
+    return PackedContext(text, tokens, sorted(selected), len(runs), len(scored_chunks) - len(selected))
+
+
+def _truncate(text: str, budget: int, model: str) -> str:
+    lo, hi = 0, len(text)
+    while lo < hi:  # longest prefix within budget
+        mid = (lo + hi + 1) // 2
+        if count_tokens(text[:mid], model) <= budget:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo]
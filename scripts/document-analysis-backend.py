@@ -17,12 +17,14 @@ Usage:
 
 import os
 import io
+import asyncio
 import json
 import math
 import uuid
 import numpy as np
 from typing import List, Optional
 from datetime import datetime
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, APIRouter, UploadFile, File, HTTPException, Depends
 from fastapi.responses import JSONResponse
@@ -36,8 +38,22 @@ import PyPDF2
 from PIL import Image
 import pytesseract
 
+import async_db
+import llm_calls
+from context_packing import count_tokens
+from llm_calls import parse_llm_json
+from observability import STAGE_SECONDS, PROMPT_TOKENS, FALLBACKS, configure_logging, instrument_app
+from profiling import install_profiler
+
+logger = configure_logging(os.getenv("LOG_LEVEL", "INFO"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    async_db.shutdown()
+
 # Initialize FastAPI app
-app = FastAPI(title="SmartEMR Document Analysis API", version="1.0.0")
+app = FastAPI(title="SmartEMR Document Analysis API", version="1.0.0", lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -47,13 +63,16 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+instrument_app(app)
+install_profiler(app)
 
 # Configuration
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "your-openai-api-key-here")
 if OPENAI_API_KEY == "your-openai-api-key-here":
-    print("Warning: Using placeholder OpenAI API key. Set OPENAI_API_KEY environment variable.")
+    logger.warning("Using placeholder OpenAI API key. Set OPENAI_API_KEY environment variable.")
 else:
     openai.api_key = OPENAI_API_KEY
+CHAT_MODEL = "gpt-4o-mini"
 
 # Database setup
 DB_URL = os.getenv("DOCUMENT_DB_URL", "sqlite:///./documents.db")
@@ -81,7 +100,11 @@ def init_document_db():
 # Initialize database
 init_document_db()
 
+def db_session() -> async_db.AsyncSession:
+    return async_db.AsyncSession(Session(engine))
+
 # Text extraction utilities
+@STAGE_SECONDS.time(stage="extract_pdf")
 def extract_text_from_pdf_bytes(pdf_bytes: bytes) -> str:
     """Extract text from PDF bytes using PyPDF2"""
     text_parts = []
@@ -92,10 +115,11 @@ def extract_text_from_pdf_bytes(pdf_bytes: bytes) -> str:
             if page_text:
                 text_parts.append(page_text)
     except Exception as e:
-        print(f"PDF parsing failed: {e}")
-        pass
+        logger.warning(f"PDF parsing failed: {e}")
+        FALLBACKS.inc(kind="pdf_parse_failed")
     return "\n".join(text_parts).strip()
 
+@STAGE_SECONDS.time(stage="ocr_page")
 def ocr_image_bytes(image_bytes: bytes) -> str:
     """Extract text from image bytes using OCR"""
     try:
@@ -103,9 +127,11 @@ def ocr_image_bytes(image_bytes: bytes) -> str:
         text = pytesseract.image_to_string(image)
         return text
     except Exception as e:
-        print(f"OCR failed: {e}")
+        logger.warning(f"OCR failed: {e}")
+        FALLBACKS.inc(kind="ocr_failed")
         return ""
 
+@STAGE_SECONDS.time(stage="extract")
 def extract_text_from_upload(file: UploadFile) -> str:
     """Extract text from uploaded file based on content type"""
     content = file.file.read()
@@ -138,6 +164,7 @@ def extract_text_from_upload(file: UploadFile) -> str:
     
     return text
 
+@STAGE_SECONDS.time(stage="chunk")
 def chunk_text(text: str, max_chars: int = 1500, overlap: int = 200) -> List[str]:
     """Chunk long text into overlapping segments for embeddings"""
     text = text.replace("\r\n", "\n")
@@ -162,11 +189,13 @@ def create_embeddings(texts: List[str], model: str = "text-embedding-3-small") -
         return []
     
     try:
-        resp = openai.Embedding.create(model=model, input=texts)
+        with STAGE_SECONDS.time(stage="embed_batch"):
+            resp = openai.Embedding.create(model=model, input=texts)
         embeddings = [item["embedding"] for item in resp["data"]]
         return embeddings
     except Exception as e:
-        print(f"Embedding creation failed: {e}")
+        logger.warning(f"Embedding creation failed: {e}")
+        FALLBACKS.inc(len(texts), kind="zero_vector_embedding")
         # Return dummy embeddings for demo
         return [[0.0] * 1536 for _ in texts]
 
@@ -176,12 +205,13 @@ def cosine_sim(a: np.ndarray, b: np.ndarray) -> float:
         return 0.0
     return float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
 
-def retrieve_relevant_chunks(document_id: int, query: str, top_k: int = 4):
+async def retrieve_relevant_chunks(document_id: int, query: str, top_k: int = 4):
     """Retrieve most relevant document chunks for a query"""
     try:
-        q_emb = create_embeddings([query])[0]
-        with Session(engine) as session:
-            rows = session.exec(select(DocumentChunk).where(DocumentChunk.document_id == document_id)).all()
+        with STAGE_SECONDS.time(stage="retrieve"):
+            q_emb = (await asyncio.to_thread(create_embeddings, [query]))[0]
+            async with db_session() as session:
+                rows = (await session.exec(select(DocumentChunk).where(DocumentChunk.document_id == document_id))).all()
             sims = []
             q_vec = np.array(q_emb)
             
@@ -196,7 +226,8 @@ def retrieve_relevant_chunks(document_id: int, query: str, top_k: int = 4):
             top = sims_sorted[:top_k]
             return [(r.text, score) for (r, score) in top]
     except Exception as e:
-        print(f"Retrieval failed: {e}")
+        logger.warning(f"Retrieval failed: {e}")
+        FALLBACKS.inc(kind="retrieval_failed")
         return []
 
 # AI Analysis Prompts
@@ -222,6 +253,11 @@ Answer concisely and cite the chunk text used. Return JSON ONLY:
 If the answer cannot be found in the text, respond with answer = "I cannot determine from the provided document."
 """
 
+def observe_prompt_tokens(endpoint: str, system_prompt: str, user_prompt: str) -> None:
+    """Record the prompt size under the same series smartemr-backend uses."""
+    tokens = count_tokens(system_prompt, CHAT_MODEL) + count_tokens(user_prompt, CHAT_MODEL)
+    PROMPT_TOKENS.observe(tokens, endpoint=endpoint)
+
 # API Models
 class AnalysisRequest(BaseModel):
     document_id: int
@@ -255,35 +291,39 @@ async def upload_document(
     
     try:
         # Extract text
-        text = extract_text_from_upload(file)
+        text = await asyncio.to_thread(extract_text_from_upload, file)
         
         # Store document
         doc_uuid = str(uuid.uuid4())
-        with Session(engine) as session:
-            doc = Document(
-                uuid=doc_uuid,
-                owner_uid=current_user.get("uid"),
-                filename=file.filename,
-                content_text=text
-            )
-            session.add(doc)
-            session.commit()
-            session.refresh(doc)
-            doc_id = doc.id
+        async with db_session() as session:
+            with STAGE_SECONDS.time(stage="db_write"):
+                doc = Document(
+                    uuid=doc_uuid,
+                    owner_uid=current_user.get("uid"),
+                    filename=file.filename,
+                    content_text=text
+                )
+                session.add(doc)
+                await session.commit()
+                await session.refresh(doc)
+                doc_id = doc.id
+            # No connection is held while the chunks are embedded
+            await session.close()
             
             # Create chunks and embeddings
             chunks = chunk_text(text, max_chars=1500, overlap=200)
-            embeddings = create_embeddings(chunks)
+            embeddings = await asyncio.to_thread(create_embeddings, chunks)
             
-            for idx, (chunk_text_part, emb) in enumerate(zip(chunks, embeddings)):
-                chunk = DocumentChunk(
-                    document_id=doc_id,
-                    chunk_index=idx,
-                    text=chunk_text_part,
-                    embedding_json=json.dumps(emb)
-                )
-                session.add(chunk)
-            session.commit()
+            with STAGE_SECONDS.time(stage="db_write"):
+                for idx, (chunk_text_part, emb) in enumerate(zip(chunks, embeddings)):
+                    chunk = DocumentChunk(
+                        document_id=doc_id,
+                        chunk_index=idx,
+                        text=chunk_text_part,
+                        embedding_json=json.dumps(emb)
+                    )
+                    session.add(chunk)
+                await session.commit()
         
         return {
             "document_id": doc_id,
@@ -304,13 +344,13 @@ async def analyze_document(
 ):
     """Generate comprehensive AI analysis of uploaded document"""
     # Validate document exists
-    with Session(engine) as session:
-        doc = session.get(Document, req.document_id)
+    async with db_session() as session:
+        doc = await session.get(Document, req.document_id)
         if not doc:
             raise HTTPException(404, "Document not found")
     
     # Retrieve relevant chunks
-    retrieved = retrieve_relevant_chunks(
+    retrieved = await retrieve_relevant_chunks(
         req.document_id, 
         "Please summarize the entire document content", 
         top_k=req.top_k
@@ -332,24 +372,17 @@ async def analyze_document(
         "\n\nPlease produce analysis."
     )
     
+    observe_prompt_tokens("analyze", SYSTEM_PROMPT_ANALYSIS, user_prompt)
+    
     try:
         # Call OpenAI for analysis
-        resp = openai.ChatCompletion.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT_ANALYSIS},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0.0,
-            max_tokens=900
+        text = await asyncio.to_thread(
+            llm_calls.chat_completion, openai, CHAT_MODEL, "analyze", SYSTEM_PROMPT_ANALYSIS, user_prompt, 900
         )
+        parsed = parse_llm_json(text)
         
-        text = resp.choices[0].message.content
-        parsed = json.loads(text)
-        
-    except Exception as e:
-        print(f"LLM analysis failed: {e}")
-        # Fallback analysis
+    except Exception:
+        # Fallback analysis (the failure is logged and counted by llm_calls)
         parsed = {
             "report": [
                 "Document uploaded and processed successfully",
@@ -378,13 +411,13 @@ async def document_qa(
 ):
     """Answer questions about uploaded document using RAG"""
     # Validate document
-    with Session(engine) as session:
-        doc = session.get(Document, req.document_id)
+    async with db_session() as session:
+        doc = await session.get(Document, req.document_id)
         if not doc:
             raise HTTPException(404, "Document not found")
     
     # Retrieve relevant chunks for the question
-    retrieved = retrieve_relevant_chunks(req.document_id, req.question, top_k=req.top_k)
+    retrieved = await retrieve_relevant_chunks(req.document_id, req.question, top_k=req.top_k)
     
     if not retrieved:
         return JSONResponse(content={
@@ -400,24 +433,17 @@ async def document_qa(
         f"\n\nQUESTION: {req.question}\n\nAnswer using only the context and cite quotes."
     )
     
+    observe_prompt_tokens("qa", SYSTEM_PROMPT_QA, user_prompt)
+    
     try:
         # Call OpenAI for Q&A
-        resp = openai.ChatCompletion.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT_QA},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0.0,
-            max_tokens=600
+        text = await asyncio.to_thread(
+            llm_calls.chat_completion, openai, CHAT_MODEL, "qa", SYSTEM_PROMPT_QA, user_prompt, 600
         )
+        parsed = parse_llm_json(text)
         
-        text = resp.choices[0].message.content
-        parsed = json.loads(text)
-        
-    except Exception as e:
-        print(f"LLM Q&A failed: {e}")
-        # Fallback response
+    except Exception:
+        # Fallback response (the failure is logged and counted by llm_calls)
         parsed = {
             "answer": "I cannot determine from the provided document.",
             "evidence": [],
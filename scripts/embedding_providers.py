@@ -0,0 +1,143 @@
+"""
+Embedding providers behind `create_embeddings`.
+
+Every provider has a `key` ("<provider>:<model>@<dim>") that is stored next to each
+vector, so vectors from different embedding spaces are never compared.
+
+Select with EMBEDDING_PROVIDER:
+- "openai" (default): OpenAI embeddings API, EMBEDDING_MODEL (text-embedding-3-small);
+  an EMBEDDING_DIM below the model's native size is requested through the API's
+  `dimensions` parameter (text-embedding-3-* only), e.g. 512 or 256
+- "local": hashed word + character n-gram TF vectors, EMBEDDING_DIM (384); no network
+"""
+
+import os
+import re
+import logging
+import zlib
+from typing import List
+
+from observability import EMBED_TEXTS, FALLBACKS
+
+logger = logging.getLogger("smartemr.embeddings")
+
+OPENAI_DEFAULT_MODEL = "text-embedding-3-small"
+OPENAI_DEFAULT_DIM = 1536
+OPENAI_NATIVE_DIMS = {
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+    "text-embedding-ada-002": 1536,
+}
+LOCAL_DEFAULT_DIM = 384
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:[.%/][a-z0-9]+)*")
+
+
+class EmbeddingProvider:
+    name = "base"
+
+    def __init__(self, model: str, dim: int):
+        self.model = model
+        self.dim = dim
+
+    @property
+    def key(self) -> str:
+        return f"{self.name}:{self.model}@{self.dim}"
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        raise NotImplementedError
+
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    name = "openai"
+
+    def __init__(self, model: str, dim: int):
+        super().__init__(model, dim)
+        native = OPENAI_NATIVE_DIMS.get(model)
+        if native is not None and dim != native and not model.startswith("text-embedding-3"):
+            raise ValueError(f"{model} does not support reduced dimensions (native {native})")
+        self.request_kwargs = {"dimensions": dim} if native is not None and dim != native else {}
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        import openai
+        EMBED_TEXTS.inc(len(texts), provider=self.key)
+        try:
+            resp = openai.Embedding.create(model=self.model, input=texts, **self.request_kwargs)
+            return [item["embedding"] for item in resp["data"]]
+        except Exception as e:
+            logger.warning(f"Embedding creation failed: {e}")
+            FALLBACKS.inc(len(texts), kind="zero_vector_embedding")
+            return [[0.0] * self.dim for _ in texts]  # Return dummy embeddings
+
+
+class LocalHashingEmbeddingProvider(EmbeddingProvider):
+    """Feature-hashed word unigrams/bigrams and character 3-5 grams with sublinear TF.
+
+    Signed hashing projects the sparse n-gram space to `dim` dimensions; vectors are
+    L2-normalised so a dot product is the cosine similarity.
+    """
+
+    name = "local"
+    char_ngrams = (3, 4, 5)
+
+    def features(self, text: str) -> List[str]:
+        words = _TOKEN_RE.findall(text.lower())
+        feats = ["w:" + w for w in words]
+        feats += ["b:" + a + " " + b for a, b in zip(words, words[1:])]
+        for w in words:
+            padded = f" {w} "
+            for n in self.char_ngrams:
+                feats += ["c:" + padded[i:i + n] for i in range(len(padded) - n + 1)]
+        return feats
+
+    def embed_one(self, text: str) -> "np.ndarray":
+        import numpy as np
+        feats = self.features(text)
+        if not feats:
+            return np.zeros(self.dim, dtype=np.float32)
+        hashes = np.fromiter((zlib.crc32(f.encode("utf-8")) for f in feats), dtype=np.uint32, count=len(feats))
+        unique, counts = np.unique(hashes, return_counts=True)
+        weights = 1.0 + np.log(counts)
+        signs = np.where(unique & 0x80000000, 1.0, -1.0)
+        vec = np.bincount((unique % self.dim).astype(np.int64), weights=weights * signs, minlength=self.dim)
+        norm = np.linalg.norm(vec)
+        return (vec / norm if norm else vec).astype(np.float32)
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        EMBED_TEXTS.inc(len(texts), provider=self.key)
+        return [self.embed_one(t).tolist() for t in texts]
+
+
+PROVIDERS = {
+    OpenAIEmbeddingProvider.name: OpenAIEmbeddingProvider,
+    LocalHashingEmbeddingProvider.name: LocalHashingEmbeddingProvider,
+}
+
+
+def get_provider(name: str = None, model: str = None, dim: int = None) -> EmbeddingProvider:
+    """Build the provider selected by arguments or the EMBEDDING_* environment variables."""
+    name = (name or os.getenv("EMBEDDING_PROVIDER", "openai")).lower()
+    if name not in PROVIDERS:
+        raise ValueError(f"Unknown EMBEDDING_PROVIDER {name!r}; choose from {sorted(PROVIDERS)}")
+    if name == "openai":
+        model = model or os.getenv("EMBEDDING_MODEL", OPENAI_DEFAULT_MODEL)
+        dim = dim or int(os.getenv("EMBEDDING_DIM", OPENAI_DEFAULT_DIM))
+    else:
+        model = model or "hash-ngram-v1"
+        dim = dim or int(os.getenv("EMBEDDING_DIM", LOCAL_DEFAULT_DIM))
+    return PROVIDERS[name](model, dim)
+
+
+def provider_from_key(key: str) -> EmbeddingProvider:
+    """Rebuild the provider whose vectors are tagged with `key` ("<provider>:<model>@<dim>")."""
+    try:
+        name, rest = key.split(":", 1)
+        model, dim = rest.rsplit("@", 1)
+        provider = get_provider(name, model, int(dim))
+    except ValueError as e:
+        raise ValueError(f"Unknown embedding space {key!r}: {e}") from e
+    if provider.key != key:
+        raise ValueError(f"Unknown embedding space {key!r}")
+    return provider
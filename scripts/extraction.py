@@ -0,0 +1,97 @@
+"""
+Text extraction from uploaded reports: the PDF text layer, and OCR for scans and photos.
+
+The batch upload path runs extract_stored() in a process pool. It is a module of its own,
+free of the backend's app and database state, so that pool workers can be spawned
+(not forked from a process running database and executor threads) and import only what
+extraction needs. Metric updates a worker makes (stage timings, fallbacks, OCR cache
+lookups) are returned with the text and replayed by the caller, so they reach /metrics.
+
+    text, metrics = pool.submit(extract_stored, path, "application/pdf", OcrSettings()).result()
+    observability.replay(metrics)
+"""
+
+import io
+import logging
+from typing import List, NamedTuple, Optional, Tuple
+
+import blob_store
+import ocr_pipeline
+from observability import FALLBACKS, STAGE_SECONDS, recording
+
+logger = logging.getLogger("smartemr")
+
+
+class OcrSettings(NamedTuple):
+    lang: str = "eng"
+    target_dpi: int = 300
+    detect_orientation: bool = True
+    cache_dir: Optional[str] = None  # OCR results are cached here; None disables the cache
+
+
+@STAGE_SECONDS.time(stage="extract_pdf")
+def pdf_text(pdf_bytes: bytes) -> str:
+    import PyPDF2
+    text_parts = []
+    try:
+        reader = PyPDF2.PdfReader(io.BytesIO(pdf_bytes))
+        for page in reader.pages:
+            page_text = page.extract_text()
+            if page_text:
+                text_parts.append(page_text)
+    except Exception:
+        FALLBACKS.inc(kind="pdf_parse_failed")
+    return "\n".join(text_parts).strip()
+
+
+@STAGE_SECONDS.time(stage="ocr_page")
+def ocr_image(image_bytes: bytes, settings: OcrSettings) -> str:
+    key = ocr_pipeline.cache_key(image_bytes, settings.lang)
+    if settings.cache_dir:
+        cached = ocr_pipeline.cache_get(settings.cache_dir, key)
+        if cached is not None:
+            return cached
+    try:
+        import pytesseract
+        with STAGE_SECONDS.time(stage="ocr_preprocess"):
+            image = ocr_pipeline.preprocess(image_bytes, settings.target_dpi, settings.detect_orientation)
+        text = pytesseract.image_to_string(image, lang=settings.lang)
+    except Exception:
+        FALLBACKS.inc(kind="ocr_failed")
+        return ""  # not cached: a retry may succeed
+    if settings.cache_dir:
+        try:
+            ocr_pipeline.cache_put(settings.cache_dir, key, text)
+        except OSError as e:
+            logger.warning(f"OCR cache write failed: {e}")
+            FALLBACKS.inc(kind="ocr_cache_write_failed")
+    return text
+
+
+def extract_text(content: bytes, content_type: Optional[str], settings: OcrSettings) -> str:
+    text = ""
+    if content_type == "application/pdf":
+        text = pdf_text(content)
+        if not text or len(text) < 50:
+            FALLBACKS.inc(kind="pdf_ocr_fallback")
+            try:
+                text = ocr_image(content, settings)
+            except Exception:
+                pass
+    elif content_type and content_type.startswith("image/"):
+        text = ocr_image(content, settings)
+    elif content_type in ["text/plain", "application/text"]:
+        text = content.decode("utf-8", errors="ignore")
+    else:
+        try:
+            text = content.decode("utf-8", errors="ignore")
+        except Exception:
+            text = ""
+    return text
+
+
+def extract_stored(path: str, content_type: Optional[str], settings: OcrSettings) -> Tuple[str, List[tuple]]:
+    """Process-pool entry point: the text of a stored upload and the metric updates made meanwhile."""
+    with recording() as metrics:
+        text = extract_text(blob_store.read(path), content_type, settings)
+    return text, metrics
@@ -0,0 +1,54 @@
+"""
+Chat completion calls, shared by smartemr-backend and document-analysis-backend so both
+services report the same metrics:
+
+- the "llm_call" stage timing (smartemr_stage_seconds);
+- prompt and completion tokens per endpoint (smartemr_llm_tokens_total);
+- fallbacks "llm_call_failed" for a failed API call and "llm_json_parse_failed" for a
+  reply that is not JSON.
+
+    text = chat_completion(openai, "gpt-4o-mini", "qa", SYSTEM_PROMPT_QA, user_prompt, 600)
+    parsed = parse_llm_json(text)
+"""
+
+import json
+import logging
+from typing import Any, Dict
+
+from observability import FALLBACKS, LLM_TOKENS, STAGE_SECONDS
+
+logger = logging.getLogger("smartemr")
+
+
+def chat_completion(client, model: str, endpoint: str, system_prompt: str, user_prompt: str,
+                    max_tokens: int) -> str:
+    """Call the chat API of `client` (the openai module), recording latency and token usage;
+    returns the message content."""
+    try:
+        with STAGE_SECONDS.time(stage="llm_call"):
+            resp = client.ChatCompletion.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt}
+                ],
+                temperature=0.0,
+                max_tokens=max_tokens
+            )
+    except Exception as e:
+        logger.warning(f"LLM call failed ({endpoint}): {e}")
+        FALLBACKS.inc(kind="llm_call_failed")
+        raise
+    usage = resp.get("usage") or {}
+    LLM_TOKENS.inc(usage.get("prompt_tokens", 0), endpoint=endpoint, kind="prompt")
+    LLM_TOKENS.inc(usage.get("completion_tokens", 0), endpoint=endpoint, kind="completion")
+    return resp.choices[0].message.content
+
+
+def parse_llm_json(content: str) -> Dict[str, Any]:
+    try:
+        return json.loads(content)
+    except ValueError:
+        logger.warning("LLM returned non-JSON content")
+        FALLBACKS.inc(kind="llm_json_parse_failed")
+        raise
@@ -0,0 +1,112 @@
+"""
+Local stand-ins for the external services used by smartemr-backend.py.
+
+Replaces the OpenAI embeddings/chat APIs and Firebase Admin with deterministic,
+in-process fakes so the backend can be imported, tested and benchmarked offline:
+
+    import local_standins
+    from backend_loader import load_backend
+    local_standins.install(latency_ms=0)
+    backend = load_backend()
+
+With the Firebase stand-in, a bearer token is accepted as the uid itself
+("Authorization: Bearer doctor-1").
+"""
+
+import os
+import json
+import time
+import hashlib
+from typing import List
+
+import numpy as np
+
+EMBEDDING_DIM = 1536
+
+
+def fake_embedding(text: str, dim: int = EMBEDDING_DIM) -> List[float]:
+    """Hash each token into a fixed-size bag-of-words vector (L2 normalised)."""
+    vec = np.zeros(dim, dtype=np.float32)
+    for token in text.lower().split():
+        h = int.from_bytes(hashlib.md5(token.encode("utf-8")).digest()[:4], "little")
+        vec[h % dim] += 1.0 if h & 0x80000000 else -1.0
+    norm = np.linalg.norm(vec)
+    if norm:
+        vec /= norm
+    return vec.tolist()
+
+
+class _Message:
+    def __init__(self, content: str):
+        self.content = content
+        self.role = "assistant"
+
+
+class _Choice:
+    def __init__(self, content: str):
+        self.message = _Message(content)
+        self.finish_reason = "stop"
+
+
+class _ChatResponse(dict):
+    """Mimics the attribute and key access of openai 0.28 response objects."""
+
+    def __init__(self, content: str, prompt_tokens: int, completion_tokens: int):
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        super().__init__(choices=[{"message": {"role": "assistant", "content": content}}], usage=usage)
+        self.choices = [_Choice(content)]
+        self.usage = usage
+
+
+def fake_chat_content(messages: list) -> str:
+    system = messages[0]["content"] if messages else ""
+    user = messages[-1]["content"] if messages else ""
+    excerpt = user.split("\n\n", 2)[1][:200] if user.count("\n\n") >= 2 else user[:200]
+    if "QA assistant" in system:
+        return json.dumps({"answer": excerpt, "evidence": [excerpt], "confidence": "low"})
+    return json.dumps({
+        "report": [excerpt],
+        "breakdown": [{"title": "Excerpt", "summary": excerpt, "quotes": [excerpt]}],
+        "suggestions": [],
+        "patient_summary": excerpt,
+        "sources": ["chunk 0"],
+    })
+
+
+def install(latency_ms: float = 0.0, embedding_dim: int = EMBEDDING_DIM) -> None:
+    """Patch openai and firebase_admin in place. `latency_ms` simulates network time per call."""
+    os.environ.setdefault("OPENAI_API_KEY", "sk-local-standin")
+
+    import openai
+    import firebase_admin
+    from firebase_admin import auth, credentials
+
+    def embedding_create(model=None, input=None, **kwargs):
+        if latency_ms:
+            time.sleep(latency_ms / 1000.0)
+        texts = [input] if isinstance(input, str) else list(input or [])
+        dim = kwargs.get("dimensions") or embedding_dim
+        return {"data": [{"embedding": fake_embedding(t, dim), "index": i} for i, t in enumerate(texts)],
+                "model": model}
+
+    def chat_create(model=None, messages=None, **kwargs):
+        if latency_ms:
+            time.sleep(latency_ms / 1000.0)
+        content = fake_chat_content(messages or [])
+        prompt_tokens = sum(len(m["content"]) for m in messages or []) // 4
+        return _ChatResponse(content, prompt_tokens, len(content) // 4)
+
+    def verify_id_token(id_token, *args, **kwargs):
+        if not id_token:
+            raise ValueError("empty token")
+        return {"uid": id_token, "email": f"{id_token}@example.com"}
+
+    openai.Embedding.create = staticmethod(embedding_create)
+    openai.ChatCompletion.create = staticmethod(chat_create)
+    credentials.Certificate = lambda *args, **kwargs: None
+    firebase_admin.initialize_app = lambda *args, **kwargs: None
+    auth.verify_id_token = verify_id_token
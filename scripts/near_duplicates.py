@@ -0,0 +1,117 @@
+"""
+MinHash signatures and LSH bucketing for near-duplicate documents.
+
+Faxed and rescanned copies of a report differ by a few OCR characters, so their bytes
+(and sha256) differ while their text is almost the same. A document's text is
+normalised (case, whitespace), cut into overlapping character 5-grams, and summarised
+by NUM_PERM minimum hash values. The fraction of equal positions between two
+signatures estimates the Jaccard similarity of their shingle sets. All shingles are
+hashed at once with numpy; no per-shingle Python work.
+
+For lookup, the signature is split into BANDS bands of ROWS values, and each band is
+hashed to a bucket stored in the DocumentMinHashBand table. Documents sharing any
+bucket are candidates; with 16 bands of 8 rows, pairs at Jaccard 0.9 collide with
+probability > 0.99 and pairs below 0.5 rarely do. Candidates are then checked
+against the full signature.
+
+Similarity alone does not make two reports interchangeable: monthly labs printed
+from one template are just as similar. same_values() requires the numbers in both
+texts to match before a new upload may reuse another document's chunks.
+
+    sig = signature(text)
+    for bucket in band_buckets(sig): ...
+    similarity(sig, other_sig)   # ~ Jaccard of the 5-gram sets
+"""
+
+import re
+import hashlib
+from typing import List, Optional
+
+from observability import Counter
+
+NUM_PERM = 128
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE = 5
+SEED = 0x5EED  # signatures are persisted: changing this or NUM_PERM invalidates them
+BLOCK = 4096  # shingles hashed per step, bounds the (NUM_PERM, BLOCK) working matrix
+
+NEAR_DUPLICATES = Counter(
+    "smartemr_near_duplicates_total", "Near-duplicate documents and chunks detected", ["kind"]
+)
+
+_params = None
+_NUMBER_RE = re.compile(r"\d+(?:[.,]\d+)?")
+
+
+def _permutations():
+    global _params
+    if _params is None:
+        import numpy as np
+        rng = np.random.default_rng(SEED)
+        a = rng.integers(1, 2 ** 63, NUM_PERM, dtype=np.uint64) | np.uint64(1)  # odd multipliers
+        b = rng.integers(0, 2 ** 63, NUM_PERM, dtype=np.uint64)
+        _params = (a[:, None], b[:, None])
+    return _params
+
+
+def normalize(text: str) -> str:
+    return " ".join((text or "").lower().split())
+
+
+def shingle_hashes(text: str) -> "np.ndarray":
+    """Distinct 64-bit hashes of the character 5-grams of the normalised text."""
+    import numpy as np
+    from numpy.lib.stride_tricks import sliding_window_view
+
+    data = np.frombuffer(normalize(text).encode("utf-8"), dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    if len(data) < SHINGLE:
+        data = np.pad(data, (0, SHINGLE - len(data)))
+    windows = sliding_window_view(data, SHINGLE).astype(np.uint64)
+    h = np.zeros(len(windows), dtype=np.uint64)
+    for j in range(SHINGLE):  # polynomial hash; uint64 arithmetic wraps
+        h = h * np.uint64(257) + windows[:, j]
+    h *= np.uint64(0x9E3779B97F4A7C15)  # spread the low-entropy polynomial values
+    return np.unique(h)
+
+
+def signature(text: str) -> Optional[bytes]:
+    """NUM_PERM little-endian uint32 minimum hashes, or None for empty text."""
+    import numpy as np
+
+    hashes = shingle_hashes(text)
+    if len(hashes) == 0:
+        return None
+    a, b = _permutations()
+    mins = np.full(NUM_PERM, np.iinfo(np.uint64).max, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for start in range(0, len(hashes), BLOCK):
+            block = hashes[start:start + BLOCK][None, :]
+            np.minimum(mins, (a * block + b).min(axis=1), out=mins)  # multiply-add hashing mod 2^64
+    return (mins >> np.uint64(32)).astype("<u4").tobytes()
+
+
+def similarity(sig_a: bytes, sig_b: bytes) -> float:
+    """Estimated Jaccard similarity of the two documents' shingle sets."""
+    import numpy as np
+    if not sig_a or not sig_b or len(sig_a) != len(sig_b):
+        return 0.0
+    return float(np.mean(np.frombuffer(sig_a, dtype="<u4") == np.frombuffer(sig_b, dtype="<u4")))
+
+
+def band_buckets(sig: bytes) -> List[int]:
+    """One signed 64-bit bucket id per band (band index is part of the hash)."""
+    width = ROWS * 4
+    return [
+        int.from_bytes(hashlib.blake2b(bytes([band]) + sig[band * width:(band + 1) * width],
+                                       digest_size=8).digest(), "little", signed=True)
+        for band in range(BANDS)
+    ]
+
+
+def same_values(text_a: str, text_b: str) -> bool:
+    """True when both texts state the same numbers in the same order."""
+    return _NUMBER_RE.findall(text_a or "") == _NUMBER_RE.findall(text_b or "")
+
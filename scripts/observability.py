@@ -0,0 +1,295 @@
+"""
+Metrics, trace IDs and logging for the SmartEMR backends.
+
+A small in-process metrics registry rendered in the Prometheus text format
+(version 0.0.4), so no extra dependency is needed. Values are per process: with
+several uvicorn workers, scrape each worker or run a single worker behind the scraper.
+
+    EMBED_TEXTS.inc(len(texts))
+    with STAGE_SECONDS.time(stage="retrieve"):
+        ...
+"""
+
+import time
+import uuid
+import logging
+import threading
+import contextvars
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
+
+CONTENT_TYPE_LATEST = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TRACE_HEADER = "X-Trace-Id"
+
+REGISTRY: List["_Metric"] = []
+# While set (see recording()), counter and histogram updates are appended here instead of applied
+_recorded: contextvars.ContextVar[Optional[list]] = contextvars.ContextVar("recorded_metrics", default=None)
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    parts = []
+    for k, v in labels.items():
+        value = str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{k}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, int):
+        return str(value)
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _record(self, op: str, value: float, labels: Dict[str, str]) -> bool:
+        updates = _recorded.get()
+        if updates is None:
+            return False
+        updates.append((self.name, op, value, labels))
+        return True
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def samples(self) -> Iterable[Tuple[str, Dict[str, str], float]]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        if self._record("inc", amount, labels):
+            return
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._series: Dict[Tuple[str, ...], list] = {}  # key -> [bucket counts, sum, count]
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        if self._record("observe", value, labels):
+            return
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            series[0][idx] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, **labels) -> int:
+        series = self._series.get(self._key(labels))
+        return series[2] if series else 0
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall time of a block; also usable as a decorator."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            items = [(k, (list(s[0]), s[1], s[2])) for k, s in self._series.items()]
+        for key, (counts, total, count) in items:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield f"{self.name}_bucket", {**labels, "le": _format_value(bound)}, cumulative
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, count
+
+
+def render_metrics() -> str:
+    return "\n".join(m.render() for m in REGISTRY) + "\n"
+
+
+@contextmanager
+def recording():
+    """Collect the counter and histogram updates of a block (in this context) instead of
+    applying them; a worker process returns the list and its parent calls replay()."""
+    updates: list = []
+    token = _recorded.set(updates)
+    try:
+        yield updates
+    finally:
+        _recorded.reset(token)
+
+
+def replay(updates: Iterable[tuple]) -> None:
+    """Apply updates collected by recording(), typically in another process."""
+    metrics = {m.name: m for m in REGISTRY}
+    for name, op, value, labels in updates:
+        metric = metrics.get(name)
+        if metric is not None:
+            getattr(metric, op)(value, **labels)
+
+
+# ---------------- Shared metrics ----------------
+STAGE_SECONDS = Histogram(
+    "smartemr_stage_seconds", "Time spent in each ingestion / query pipeline stage", ["stage"]
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "smartemr_http_request_seconds", "HTTP request latency by route", ["method", "route", "status"]
+)
+LLM_TOKENS = Counter(
+    "smartemr_llm_tokens_total", "Tokens reported by the chat completions API", ["endpoint", "kind"]
+)
+PROMPT_TOKENS = Histogram(
+    "smartemr_prompt_tokens", "Prompt tokens per chat request, counted before the call", ["endpoint"],
+    buckets=(250, 500, 1000, 2000, 4000, 8000, 16000, 32000),
+)
+EMBED_TEXTS = Counter("smartemr_embedded_texts_total", "Texts sent for embedding", ["provider"])
+FALLBACKS = Counter(
+    "smartemr_fallbacks_total", "Degraded code paths taken instead of failing the request", ["kind"]
+)
+
+# ---------------- Trace IDs and logging ----------------
+trace_id_var: contextvars.ContextVar[str] = contextvars.ContextVar("trace_id", default="-")
+
+
+def current_trace_id() -> str:
+    return trace_id_var.get()
+
+
+class TraceIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = trace_id_var.get()
+        return True
+
+
+def configure_logging(level: str = "INFO") -> logging.Logger:
+    logger = logging.getLogger("smartemr")
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.addFilter(TraceIdFilter())
+        handler.setFormatter(logging.Formatter(
+            "%(asctime)s %(levelname)s [trace=%(trace_id)s] %(name)s: %(message)s"
+        ))
+        logger.addHandler(handler)
+        logger.setLevel(level)
+        logger.propagate = False
+    return logger
+
+
+def incoming_trace_id(request: Request) -> Optional[str]:
+    """Reuse the caller's trace id (X-Trace-Id, X-Request-ID or W3C traceparent)."""
+    for header in (TRACE_HEADER, "X-Request-ID"):
+        value = request.headers.get(header)
+        if value:
+            return value[:64]
+    traceparent = request.headers.get("traceparent", "").split("-")
+    if len(traceparent) == 4 and len(traceparent[1]) == 32:
+        return traceparent[1]
+    return None
+
+
+def instrument_app(app: FastAPI) -> None:
+    """Add request timing + trace id propagation middleware and a /metrics endpoint."""
+
+    @app.middleware("http")
+    async def trace_and_time(request: Request, call_next):
+        token = trace_id_var.set(incoming_trace_id(request) or uuid.uuid4().hex)
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            response.headers[TRACE_HEADER] = trace_id_var.get()
+            return response
+        finally:
+            route = request.scope.get("route")
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - start,
+                method=request.method,
+                route=getattr(route, "path", "unmatched"),
+                status=str(status),
+            )
+            trace_id_var.reset(token)
+
+    @app.get("/metrics", include_in_schema=False)
+    def metrics():
+        return PlainTextResponse(render_metrics(), media_type=CONTENT_TYPE_LATEST)
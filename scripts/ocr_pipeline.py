@@ -0,0 +1,122 @@
+"""
+Image normalisation before tesseract and a persistent cache of OCR results.
+
+Phone photos of reports arrive as 12-megapixel colour JPEGs, often sideways with
+only an EXIF flag saying so. Tesseract's time grows with the pixel count while its
+accuracy peaks around 300 DPI, so preprocess() turns an upload into what it reads
+best:
+
+1. decode JPEGs at reduced size when the target allows it (Image.draft, done by
+   the JPEG decoder's DCT scaling, far cheaper than decoding then resizing);
+2. convert to 8-bit grayscale;
+3. downscale to `target_dpi`, using the DPI in the file or, without a plausible
+   one, assuming the longer side spans an A4 / Letter page. Images are never upscaled;
+4. apply the EXIF orientation, or, without one, the rotation tesseract's orientation
+   detection reports (optional, it costs a short extra tesseract pass).
+
+OCR results are cached on disk keyed by the sha256 of the image bytes plus
+PIPELINE_VERSION and the tesseract language, so re-uploads and retries skip OCR
+entirely, across workers and restarts. Entries live at {root}/{key[:2]}/{key}.txt
+and are written atomically; bump PIPELINE_VERSION when preprocessing changes.
+
+    key = cache_key(image_bytes, "eng")
+    text = cache_get(root, key)
+    if text is None:
+        text = pytesseract.image_to_string(preprocess(image_bytes, 300, True))
+        cache_put(root, key, text)
+"""
+
+import io
+import os
+import hashlib
+import tempfile
+from typing import Optional
+
+from observability import Counter
+
+PIPELINE_VERSION = "1"
+PAGE_LONG_SIDE_INCHES = 11.69  # A4; Letter (11in) is within rounding
+# A stated DPI is trusted only if it makes the image a plausible page; cameras write 72
+# whatever the resolution
+PAGE_INCHES_RANGE = (4.0, 17.0)
+EXIF_ORIENTATION = 0x0112
+# EXIF orientation -> PIL transpose method (Image.Transpose values) that makes the image upright
+EXIF_TRANSPOSE = {2: 0, 3: 3, 4: 1, 5: 5, 6: 4, 7: 6, 8: 2}
+
+OCR_CACHE = Counter("smartemr_ocr_cache_total", "OCR cache lookups", ["result"])
+
+
+def cache_key(image_bytes: bytes, lang: str = "eng") -> str:
+    h = hashlib.sha256(image_bytes)
+    h.update(f"\0{PIPELINE_VERSION}\0{lang}".encode())
+    return h.hexdigest()
+
+
+def cache_path(root: str, key: str) -> str:
+    return os.path.join(root, key[:2], key + ".txt")
+
+
+def cache_get(root: str, key: str) -> Optional[str]:
+    try:
+        with open(cache_path(root, key), encoding="utf-8") as f:
+            text = f.read()
+    except FileNotFoundError:
+        OCR_CACHE.inc(result="miss")
+        return None
+    OCR_CACHE.inc(result="hit")
+    return text
+
+
+def cache_put(root: str, key: str, text: str) -> None:
+    """Write an entry atomically; concurrent writers of the same key store the same text."""
+    path = cache_path(root, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".incoming-")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def source_dpi(image: "Image.Image") -> float:
+    """DPI stated by the file, or estimated from the pixel size of a full page."""
+    dpi = image.info.get("dpi")
+    if dpi and min(dpi) > 0:
+        dpi = float(min(dpi))
+        if PAGE_INCHES_RANGE[0] <= max(image.size) / dpi <= PAGE_INCHES_RANGE[1]:
+            return dpi
+    return max(image.size) / PAGE_LONG_SIDE_INCHES
+
+
+def detect_rotation(image: "Image.Image") -> int:
+    """Clockwise degrees tesseract suggests rotating by, 0 when it cannot tell."""
+    import pytesseract
+    try:
+        return int(pytesseract.image_to_osd(image, output_type=pytesseract.Output.DICT)["rotate"])
+    except Exception:  # too little text, or osd.traineddata not installed
+        return 0
+
+
+def preprocess(image_bytes: bytes, target_dpi: int = 300, detect_orientation: bool = False) -> "Image.Image":
+    """Upright 8-bit grayscale image at no more than `target_dpi`."""
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(image_bytes))
+    orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+    scale = min(1.0, target_dpi / source_dpi(image))
+    target = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    if scale < 1.0 and image.format == "JPEG":
+        image.draft("L", target)  # decoder scales by 1/2, 1/4 or 1/8, never below `target`
+    image = image.convert("L")
+    if scale < 1.0 and image.size != target:
+        image = image.resize(target, Image.BICUBIC, reducing_gap=2.0)
+    if orientation in EXIF_TRANSPOSE:  # after resizing: fewer pixels to move
+        image = image.transpose(EXIF_TRANSPOSE[orientation])
+    if detect_orientation and orientation == 1:
+        rotation = detect_rotation(image)
+        if rotation:
+            image = image.rotate(-rotation, expand=True, fillcolor=255)
+    return image
@@ -0,0 +1,202 @@
+"""
+Opt-in sampling profiler for the SmartEMR FastAPI apps.
+
+A request is profiled when it is picked by PROFILE_SAMPLE_RATE (0.0-1.0) or carries
+`X-Profile: 1` (if PROFILE_HEADER_ENABLED, off by default: any client could otherwise
+profile any request). While at least one profiled request is in
+flight, a background thread samples every thread's Python stack each
+PROFILE_INTERVAL_MS. That covers the handler, its dependencies (verify_token,
+get_session) and any threadpool work. Unprofiled requests only pay for one random() call.
+
+Each profile is written to PROFILE_DIR in collapsed-stack format ("a;b;c 12"), which
+flamegraph.pl, speedscope and inferno read directly. Only the newest PROFILE_MAX_FILES
+files are kept. Samples are process-wide, so stacks from concurrent requests can appear
+in a profile; keep the sample rate low in production.
+
+GET /debug/profiles returns a per-route summary of the profiles taken since startup.
+Neither the middleware nor that route is installed unless one of the two triggers is
+enabled.
+"""
+
+import os
+import re
+import sys
+import time
+import random
+import asyncio
+import threading
+from collections import Counter
+from typing import Dict, List, Optional
+
+from fastapi import FastAPI, Request
+
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_HEADER_ENABLED = os.getenv("PROFILE_HEADER_ENABLED", "false").lower() == "true"
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "./profiles")
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "200"))
+PROFILE_MAX_CONCURRENT = int(os.getenv("PROFILE_MAX_CONCURRENT", "4"))
+PROFILE_HEADER = "X-Profile"
+
+# A thread whose innermost frame is in one of these modules is idle (waiting on a lock,
+# queue or selector), not doing work for the request.
+_IDLE_MODULES = ("threading.py", "selectors.py", "queue.py")
+
+
+def _collapse(frame, thread_name: str) -> Optional[str]:
+    if frame.f_code.co_filename.endswith(_IDLE_MODULES):
+        return None
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    names.append(thread_name)
+    return ";".join(reversed(names))
+
+
+class ProfileSession:
+    def __init__(self):
+        self.stacks: Counter = Counter()
+        self.started = time.perf_counter()
+
+    @property
+    def samples(self) -> int:
+        return sum(self.stacks.values())
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class SamplingProfiler:
+    """Runs one sampler thread while any ProfileSession is active."""
+
+    def __init__(self, interval_ms: float):
+        self.interval = interval_ms / 1000.0
+        self._sessions: List[ProfileSession] = []
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def active(self) -> int:
+        return len(self._sessions)
+
+    def start(self) -> ProfileSession:
+        session = ProfileSession()
+        with self._lock:
+            self._sessions.append(session)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="smartemr-profiler", daemon=True)
+                self._thread.start()
+        return session
+
+    def stop(self, session: ProfileSession) -> None:
+        with self._lock:
+            self._sessions.remove(session)
+
+    def _run(self) -> None:
+        me = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            names = {t.ident: t.name for t in threading.enumerate()}
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = _collapse(frame, names.get(ident, f"thread-{ident}"))
+                if stack:
+                    stacks.append(stack)
+            with self._lock:
+                if not self._sessions:
+                    self._thread = None
+                    return
+                for session in self._sessions:
+                    session.stacks.update(stacks)
+
+
+class RouteSummary:
+    def __init__(self):
+        self.profiles = 0
+        self.total_ms = 0.0
+        self.samples = 0
+        self.self_samples: Counter = Counter()
+
+    def add(self, session: ProfileSession, duration_ms: float) -> None:
+        self.profiles += 1
+        self.total_ms += duration_ms
+        self.samples += session.samples
+        for stack, count in session.stacks.items():
+            self.self_samples[stack.rsplit(";", 1)[-1]] += count
+
+    def to_dict(self, top: int = 15) -> Dict:
+        return {
+            "profiles": self.profiles,
+            "mean_ms": self.total_ms / self.profiles if self.profiles else 0.0,
+            "samples": self.samples,
+            "top_self": [{"frame": f, "samples": n} for f, n in self.self_samples.most_common(top)],
+        }
+
+
+def _write_profile(directory: str, name: str, content: str, max_files: int) -> str:
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, name)
+    with open(path, "w") as f:
+        f.write(content)
+    files = sorted(
+        (os.path.join(directory, n) for n in os.listdir(directory) if n.endswith(".collapsed")),
+        key=os.path.getmtime,
+    )
+    for old in files[:-max_files] if max_files > 0 else []:
+        try:
+            os.remove(old)
+        except FileNotFoundError:
+            pass
+    return path
+
+
+def profiling_enabled() -> bool:
+    return PROFILE_HEADER_ENABLED or PROFILE_SAMPLE_RATE > 0
+
+
+def install_profiler(app: FastAPI) -> Optional[SamplingProfiler]:
+    """Add the profiling middleware and GET /debug/profiles to `app`, if profiling is enabled."""
+    if not profiling_enabled():
+        return None
+    profiler = SamplingProfiler(PROFILE_INTERVAL_MS)
+    summaries: Dict[str, RouteSummary] = {}
+
+    def wants_profile(request: Request) -> bool:
+        if PROFILE_HEADER_ENABLED and request.headers.get(PROFILE_HEADER) == "1":
+            return True
+        return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+    @app.middleware("http")
+    async def sample_profile(request: Request, call_next):
+        if not wants_profile(request) or profiler.active >= PROFILE_MAX_CONCURRENT:
+            return await call_next(request)
+
+        session = profiler.start()
+        try:
+            response = await call_next(request)
+        finally:
+            profiler.stop(session)
+        duration_ms = (time.perf_counter() - session.started) * 1000.0
+
+        route = getattr(request.scope.get("route"), "path", "unmatched")
+        summaries.setdefault(f"{request.method} {route}", RouteSummary()).add(session, duration_ms)
+        slug = re.sub(r"[^A-Za-z0-9]+", "_", f"{request.method}{route}").strip("_")
+        name = f"{time.strftime('%Y%m%dT%H%M%S')}_{int(duration_ms)}ms_{slug}_{os.urandom(3).hex()}.collapsed"
+        await asyncio.to_thread(_write_profile, PROFILE_DIR, name, session.collapsed(), PROFILE_MAX_FILES)
+        response.headers["X-Profile-Id"] = name
+        return response
+
+    @app.get("/debug/profiles", include_in_schema=False)
+    def profile_summary():
+        return {
+            "sample_rate": PROFILE_SAMPLE_RATE,
+            "header_enabled": PROFILE_HEADER_ENABLED,
+            "directory": os.path.abspath(PROFILE_DIR),
+            "routes": {route: s.to_dict() for route, s in sorted(summaries.items())},
+        }
+
+    return profiler
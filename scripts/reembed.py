@@ -0,0 +1,237 @@
+"""
+Resumable re-embedding of stale chunk vectors.
+
+A document is stale when its chunks were embedded in another embedding space than the
+target (provider key "<provider>:<model>@<dim>"), predate the int8 copy, or hold zero
+vectors left by the embedding fallback. Documents are processed in id order: the new
+vectors are written to the target's vector store first, then one transaction updates
+the chunk rows, switches Document.embedding_model and advances the job checkpoint.
+Until that commit, retrieval keeps using the old vectors; afterwards it embeds queries
+with the target provider.
+
+Embedding calls are batched and rate-limited (texts per minute). A batch that comes
+back as zero vectors (API failure) stops the job before the document is switched, and
+the next run resumes after the last committed document.
+
+    python reembed.py --provider openai --model text-embedding-3-small --dim 512
+    python reembed.py --provider openai --dim 1536        # only repair zero vectors
+    python reembed.py --job 3                             # resume a specific job
+
+Once the job is done, point EMBEDDING_* at the target so new uploads use it, and run
+the job again to pick up documents uploaded in the meantime.
+"""
+
+import sys
+import time
+import json
+import logging
+import argparse
+import datetime
+from typing import Any, Dict, List, Optional
+
+import embedding_providers
+from backend_loader import load_backend
+
+logger = logging.getLogger("smartemr.reembed")
+
+
+class ReembedError(RuntimeError):
+    pass
+
+
+class RateLimiter:
+    """Spaces calls so that at most `per_minute` texts are sent per minute."""
+
+    def __init__(self, per_minute: float):
+        self.interval = 60.0 / per_minute if per_minute > 0 else 0.0
+        self.next_at = time.monotonic()
+
+    def wait(self, n: int) -> None:
+        now = time.monotonic()
+        if self.next_at > now:
+            time.sleep(self.next_at - now)
+        self.next_at = max(self.next_at, now) + n * self.interval
+
+
+def stale_document_ids(backend, target_key: str, after_id: int, limit: int) -> List[int]:
+    """Ids of documents after `after_id` with any chunk outside the target space or without a usable vector.
+
+    Document ids are unique across shards, so the first `limit` of every shard merge into one order.
+    """
+    Chunk = backend.DocumentChunk
+    stale = backend.or_(
+        Chunk.embedding_model.is_(None),
+        Chunk.embedding_model != target_key,
+        Chunk.embedding_scale.is_(None),
+        Chunk.embedding_scale == 0,
+    )
+    ids: List[int] = []
+    for shard in backend.shards.names():
+        with backend.shards.session(shard) as session:
+            ids += session.exec(
+                backend.select(Chunk.document_id).where(Chunk.document_id > after_id, stale)
+                .group_by(Chunk.document_id).order_by(Chunk.document_id).limit(limit)
+            ).all()
+    return sorted(ids)[:limit]
+
+
+def reusable_vector(row, key: str, target_key: str, dim: int) -> Optional[List[float]]:
+    """The chunk's current vector if it is already a non-zero vector in the target space."""
+    if key != target_key or not row.embedding_json:
+        return None
+    try:
+        vector = json.loads(row.embedding_json)
+    except ValueError:
+        return None
+    if len(vector) != dim or not any(vector):
+        return None
+    return vector
+
+
+def reembed_document(backend, job, document_id: int, provider, limiter: RateLimiter, batch_size: int) -> Dict[str, int]:
+    """Re-embed one document and switch it to `provider` in a single transaction."""
+    Chunk = backend.DocumentChunk
+    with backend.shards.session() as session:
+        if not backend.use_shard_of(session, "document", document_id):
+            raise ReembedError(f"document {document_id} is not in the shard directory")
+        shard = session.shard
+        rows = session.exec(
+            backend.select(Chunk).where(Chunk.document_id == document_id).order_by(Chunk.chunk_index)
+        ).all()
+        old_key = session.exec(
+            backend.select(backend.Document.embedding_model).where(backend.Document.id == document_id)
+        ).first()
+    vectors = [
+        reusable_vector(r, r.embedding_model or backend.LEGACY_EMBEDDING_KEY, provider.key, provider.dim)
+        for r in rows
+    ]
+    todo = [i for i, v in enumerate(vectors) if v is None]
+    for start in range(0, len(todo), batch_size):
+        batch = todo[start:start + batch_size]
+        limiter.wait(len(batch))
+        embedded = backend.create_embeddings([rows[i].text for i in batch], provider)
+        for i, vector in zip(batch, embedded):
+            if not any(vector) and rows[i].text.strip():
+                raise ReembedError(f"embedding API returned zero vectors for document {document_id}")
+            vectors[i] = vector
+
+    new_rows = backend.chunk_rows(document_id, [r.text for r in rows], vectors, provider)
+    if new_rows:
+        backend.publish_vectors(document_id, vectors, provider=provider)
+    with backend.shards.session(shard) as session:
+        if new_rows:
+            session.execute(backend.update(Chunk), [
+                {"id": r.id, **{k: v for k, v in new.items() if k.startswith("embedding_")}}
+                for r, new in zip(rows, new_rows)
+            ])
+        session.execute(backend.update(backend.Document).where(backend.Document.id == document_id)
+                        .values(embedding_model=provider.key))
+        session.execute(backend.update(backend.ReembedJob).where(backend.ReembedJob.id == job.id).values(
+            last_document_id=document_id,
+            documents_done=backend.ReembedJob.documents_done + 1,
+            chunks_embedded=backend.ReembedJob.chunks_embedded + len(todo),
+            chunks_reused=backend.ReembedJob.chunks_reused + len(rows) - len(todo),
+            updated_at=datetime.datetime.utcnow(),
+        ))
+        session.commit()
+
+    if old_key and old_key != provider.key:
+        old_store = backend.get_vector_store(backend.provider_for(old_key))
+        if old_store is not None:
+            old_store.delete(document_id)
+    return {"embedded": len(todo), "reused": len(rows) - len(todo)}
+
+
+def get_or_create_job(backend, target_key: str, job_id: Optional[int] = None):
+    Job = backend.ReembedJob
+    with backend.shards.session() as session:
+        if job_id is not None:
+            job = session.get(Job, job_id)
+            if job is None:
+                raise ReembedError(f"job {job_id} not found")
+        else:
+            job = session.exec(backend.select(Job).where(
+                Job.target_model == target_key, Job.status != "done"
+            ).order_by(Job.id.desc())).first() or Job(target_model=target_key)
+        job.status, job.error = "running", None
+        session.add(job)
+        session.commit()
+        session.refresh(job)
+        return job
+
+
+def finish_job(backend, job_id: int, status: str, error: Optional[str] = None) -> Any:
+    with backend.shards.session() as session:
+        job = session.get(backend.ReembedJob, job_id)
+        job.status, job.error, job.updated_at = status, error, datetime.datetime.utcnow()
+        session.add(job)
+        session.commit()
+        session.refresh(job)
+        return job
+
+
+def run_job(backend, provider, job_id: Optional[int] = None, batch_size: int = 64,
+            texts_per_minute: float = 3000, max_documents: Optional[int] = None):
+    """Re-embed stale documents into `provider`'s space, resuming from the job checkpoint.
+
+    Stops after `max_documents` (leaving the job running, to be resumed) or when no stale
+    document is left after the checkpoint (job done).
+    """
+    backend.ensure_db()
+    job = get_or_create_job(backend, provider.key, job_id)
+    if job.target_model != provider.key:
+        provider = backend.provider_for(job.target_model)
+    limiter = RateLimiter(texts_per_minute)
+    processed = 0
+    checkpoint = job.last_document_id
+    try:
+        while max_documents is None or processed < max_documents:
+            ids = stale_document_ids(backend, provider.key, checkpoint, 100)
+            if not ids:
+                return finish_job(backend, job.id, "done")
+            for document_id in ids:
+                if max_documents is not None and processed >= max_documents:
+                    break
+                counts = reembed_document(backend, job, document_id, provider, limiter, batch_size)
+                logger.info(f"job {job.id}: document {document_id} switched to {provider.key} ({counts})")
+                checkpoint = document_id
+                processed += 1
+    except Exception as e:
+        logger.error(f"job {job.id} stopped at document {checkpoint}: {e}")
+        finish_job(backend, job.id, "failed", str(e))
+        raise
+    with backend.shards.session() as session:
+        return session.get(backend.ReembedJob, job.id)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Re-embed stale or zero chunk vectors")
+    parser.add_argument("--provider", default=None, help="target EMBEDDING_PROVIDER (default: configured)")
+    parser.add_argument("--model", default=None, help="target EMBEDDING_MODEL")
+    parser.add_argument("--dim", type=int, default=None, help="target EMBEDDING_DIM")
+    parser.add_argument("--job", type=int, default=None, help="resume this job id")
+    parser.add_argument("--batch-size", type=int, default=64, help="texts per embeddings API call")
+    parser.add_argument("--texts-per-minute", type=float, default=3000, help="embedding rate limit (0 = none)")
+    parser.add_argument("--max-documents", type=int, default=None, help="stop after this many documents")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    backend = load_backend()
+    provider = embedding_providers.get_provider(args.provider, args.model, args.dim)
+    try:
+        job = run_job(backend, provider, args.job, args.batch_size, args.texts_per_minute, args.max_documents)
+    except Exception as e:
+        print(f"reembed failed: {e}", file=sys.stderr)
+        return 1
+    print(json.dumps({
+        "job": job.id, "target_model": job.target_model, "status": job.status,
+        "last_document_id": job.last_document_id, "documents_done": job.documents_done,
+        "chunks_embedded": job.chunks_embedded, "chunks_reused": job.chunks_reused,
+    }))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
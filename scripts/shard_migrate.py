@@ -0,0 +1,179 @@
+"""
+Split a single SmartEMR database into a shard directory plus per-doctor shards.
+
+Users, blobs and re-embed jobs are copied to the new directory database; every
+patient goes to the shard of its owning doctor (see sharding.py), and its visits,
+vitals, reports, documents, chunks and MinHash bands follow it. Documents without a
+patient follow their owner. Ids are kept, so vector store entries and blob paths stay
+valid, and the directory records the shard of every patient id, document id and
+report_id; new ids continue after the highest migrated one.
+
+The source database is only read. Rows whose parent is missing (a vital of a deleted
+visit, say) are skipped and counted. Afterwards, point DATABASE_URL at the directory
+and SHARD_DIR (and SHARD_MAP) at the shards:
+
+    python shard_migrate.py --source sqlite:///./smartemr.db \\
+        --directory sqlite:///./directory.db --shard-dir ./shards [--shard-map clinics.json]
+"""
+
+import sys
+import json
+import argparse
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional
+
+from sqlalchemy import create_engine, inspect, select
+
+import sharding
+from backend_loader import load_backend
+
+BATCH_ROWS = 5000
+
+
+class MigrationError(RuntimeError):
+    pass
+
+
+def source_rows(source, table):
+    """Batches of row dicts of `table`, limited to the columns the source has (older schemas lack some)."""
+    inspector = inspect(source)
+    if not inspector.has_table(table.name):
+        return
+    present = {c["name"] for c in inspector.get_columns(table.name)}
+    columns = [c for c in table.columns if c.name in present]
+    key = list(table.primary_key.columns)
+    with source.connect() as conn:
+        result = conn.execution_options(yield_per=BATCH_ROWS).execute(select(*columns).order_by(*key))
+        for batch in result.mappings().partitions():
+            yield [dict(row) for row in batch]
+
+
+def copy_table(source, table, write: Callable[[Optional[str], List[Dict[str, Any]]], None],
+               route: Callable[[Dict[str, Any]], Optional[str]] = None) -> Dict[str, int]:
+    """Copy every row to the shard `route` returns (the directory without `route`)."""
+    copied = skipped = 0
+    for batch in source_rows(source, table):
+        by_shard = defaultdict(list)
+        for row in batch:
+            shard = route(row) if route else None
+            if route and shard is None:
+                skipped += 1
+                continue
+            by_shard[shard].append(row)
+        for shard, rows in by_shard.items():
+            write(shard, rows)
+            copied += len(rows)
+    return {"copied": copied, "skipped": skipped}
+
+
+def migrate(backend, source_url: str, shards) -> Dict[str, Any]:
+    """Copy the source database into `shards` (a sharding.ShardRouter) and its directory database."""
+    if not shards.sharded:
+        raise MigrationError("the router has no shard directory")
+    directory = shards.directory
+    tables = backend.database_tables(directory=True)
+    backend.SQLModel.metadata.create_all(directory, tables=tables)
+    backend.migrate_schema(directory, tables)
+    with directory.connect() as conn:
+        if conn.execute(select(backend.PatientShard.id).limit(1)).first() is not None:
+            raise MigrationError("the directory already lists patients; migrate into an empty directory")
+    source = create_engine(source_url)
+
+    def write(shard: Optional[str], rows: List[Dict[str, Any]], table) -> None:
+        engine = directory if shard is None else shards.engine_for(shard)
+        with engine.begin() as conn:
+            conn.execute(table.insert(), rows)
+
+    def copier(model, route=None, directory_entries=None):
+        """Copy `model`; `directory_entries(shard, rows)` lists (table, rows) to add to the directory."""
+        table = model.__table__
+
+        def write_batch(shard, rows):
+            write(shard, rows, table)
+            for entry_table, entries in directory_entries(shard, rows) if directory_entries else ():
+                if entries:
+                    write(None, entries, entry_table)
+        return copy_table(source, table, write_batch, route)
+
+    report = {}
+    for model in (backend.User, backend.Blob, backend.ReembedJob):
+        report[model.__tablename__] = copier(model)
+
+    patient_shard: Dict[int, str] = {}
+    visit_shard: Dict[int, str] = {}
+    document_shard: Dict[int, str] = {}
+    report_ids = set()
+
+    def route_patient(row):
+        patient_shard[row["id"]] = shards.shard_for_doctor(row["owner_doctor_uid"])
+        return patient_shard[row["id"]]
+
+    def route_visit(row):
+        shard = patient_shard.get(row["patient_id"])
+        if shard is not None:
+            visit_shard[row["id"]] = shard
+        return shard
+
+    def route_document(row):
+        if row.get("patient_id") is not None:
+            shard = patient_shard.get(row["patient_id"])
+        else:
+            shard = shards.shard_for_doctor(row["owner_uid"])
+        if shard is not None:
+            document_shard[row["id"]] = shard
+        return shard
+
+    def patient_entries(shard, rows):
+        return [(backend.PatientShard.__table__, [{"id": r["id"], "shard": shard} for r in rows])]
+
+    def report_entries(shard, rows):
+        entries = []
+        for r in rows:
+            if r.get("report_id") and r["report_id"] not in report_ids:
+                report_ids.add(r["report_id"])
+                entries.append({"report_id": r["report_id"], "shard": shard})
+        return [(backend.ReportShard.__table__, entries)]
+
+    def document_entries(shard, rows):
+        return report_entries(shard, rows) + [
+            (backend.DocumentShard.__table__, [{"id": r["id"], "shard": shard} for r in rows])
+        ]
+
+    report["patient"] = copier(backend.Patient, route_patient, patient_entries)
+    report["visit"] = copier(backend.Visit, route_visit)
+    report["vital"] = copier(backend.Vital, lambda row: visit_shard.get(row["visit_id"]))
+    report["report"] = copier(backend.Report, lambda row: patient_shard.get(row["patient_id"]), report_entries)
+    report["document"] = copier(backend.Document, route_document, document_entries)
+    report["documentchunk"] = copier(backend.DocumentChunk, lambda row: document_shard.get(row["document_id"]))
+    report["documentminhashband"] = copier(backend.DocumentMinHashBand,
+                                           lambda row: document_shard.get(row["document_id"]))
+    return {"shards": shards.names(), "tables": report}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Split a SmartEMR database into per-doctor shards")
+    parser.add_argument("--source", required=True, help="database URL of the existing single database")
+    parser.add_argument("--directory", required=True, help="database URL of the new shard directory")
+    parser.add_argument("--shard-dir", required=True, help="directory for the shard files")
+    parser.add_argument("--shard-map", default=None, help="JSON {doctor_uid: shard name} to group doctors")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    backend = load_backend()
+    try:
+        shards = sharding.ShardRouter(
+            create_engine(args.directory), args.shard_dir, sharding.load_shard_map(args.shard_map),
+            backend.DIRECTORY_TABLES, prepare=backend.prepare_shard
+        )
+        result = migrate(backend, args.source, shards)
+    except MigrationError as e:
+        print(f"shard migration failed: {e}", file=sys.stderr)
+        return 1
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
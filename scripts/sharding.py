@@ -0,0 +1,164 @@
+"""
+Per-doctor SQLite shards behind one SQLAlchemy session.
+
+A single SQLite file has one writer lock, so every clinic's uploads queue behind each
+other. With a shard directory configured, patient data (patients, visits, vitals,
+reports, documents and their chunks) lives in one database file per doctor, or per
+group of doctors named in a shard map (e.g. one shard per clinic), and only a small
+directory database stays global: users, blobs, jobs, and the tables saying which shard
+holds a patient id, document id or report_id.
+
+    {shard_dir}/{shard}.db     shard names: "doctor-<sha256(uid)[:16]>" or from the map
+
+RoutedSession picks the engine per statement from the tables it touches (Session.get_bind):
+directory tables go to the directory engine, everything else to the shard selected on
+the session. Handlers select the shard once, from the doctor's uid or by looking up an
+id in the directory, and keep using ordinary queries. Patient and document ids are
+allocated by the directory so they stay unique across shards.
+
+Without a shard directory every shard resolves to the directory engine: one database,
+as before, and selecting a shard is a no-op.
+
+    router = ShardRouter(engine, shard_dir, shard_map, directory_tables={"user", ...}, prepare=create_tables)
+    with router.session(router.shard_for_doctor(uid)) as session:
+        session.exec(select(Patient).where(Patient.owner_doctor_uid == uid))
+"""
+
+import os
+import json
+import hashlib
+import threading
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, Optional
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql import visitors
+from sqlalchemy.sql.schema import Table
+from sqlmodel import Session
+
+DEFAULT_SHARD = "default"
+SHARD_SUFFIX = ".db"
+
+
+class ShardNotSelected(RuntimeError):
+    """A statement touched sharded tables on a session without a shard."""
+
+
+def load_shard_map(path: Optional[str]) -> Dict[str, str]:
+    """{doctor_uid: shard name} from a JSON file; empty without one."""
+    if not path:
+        return {}
+    with open(path, encoding="utf-8") as f:
+        mapping = json.load(f)
+    for uid, shard in mapping.items():
+        if not shard or os.sep in shard or shard.startswith("."):
+            raise ValueError(f"invalid shard name {shard!r} for {uid!r}")
+    return mapping
+
+
+def _statement_tables(clause: Any) -> Iterable[str]:
+    for element in visitors.iterate(clause):
+        if isinstance(element, Table):
+            yield element.name
+
+
+class ShardRouter:
+    def __init__(self, directory: Engine, shard_dir: Optional[str] = None, shard_map: Optional[Dict[str, str]] = None,
+                 directory_tables: Iterable[str] = (), prepare: Optional[Callable[[Engine], None]] = None):
+        self.directory = directory
+        self.shard_dir = shard_dir
+        self.shard_map = shard_map or {}
+        self.directory_tables: FrozenSet[str] = frozenset(directory_tables)
+        self.prepare = prepare  # creates/migrates the shard tables of a new engine
+        self._engines: Dict[str, Engine] = {}
+        self._lock = threading.Lock()
+        self._located: Dict[tuple, str] = {}  # (kind, key) -> shard; rows never move between shards
+
+    @property
+    def sharded(self) -> bool:
+        return bool(self.shard_dir)
+
+    def shard_for_doctor(self, uid: Optional[str]) -> str:
+        if not self.sharded:
+            return DEFAULT_SHARD
+        if uid in self.shard_map:
+            return self.shard_map[uid]
+        return "doctor-" + hashlib.sha256((uid or "").encode()).hexdigest()[:16]
+
+    def shard_path(self, shard: str) -> str:
+        return os.path.join(self.shard_dir, shard + SHARD_SUFFIX)
+
+    def engine_for(self, shard: str) -> Engine:
+        if not self.sharded:
+            return self.directory
+        engine = self._engines.get(shard)
+        if engine is None:
+            with self._lock:
+                engine = self._engines.get(shard)
+                if engine is None:
+                    os.makedirs(self.shard_dir, exist_ok=True)
+                    engine = create_shard_engine(self.shard_path(shard))
+                    if self.prepare is not None:
+                        self.prepare(engine)
+                    self._engines[shard] = engine
+        return engine
+
+    def names(self) -> List[str]:
+        """Shards that exist on disk (the single database when unsharded)."""
+        if not self.sharded:
+            return [DEFAULT_SHARD]
+        if not os.path.isdir(self.shard_dir):
+            return []
+        return sorted(name[:-len(SHARD_SUFFIX)] for name in os.listdir(self.shard_dir)
+                      if name.endswith(SHARD_SUFFIX) and not name.startswith("."))
+
+    def locate(self, kind: str, key: Any, lookup: Callable[[], Optional[str]]) -> Optional[str]:
+        """Shard of a directory entry, cached once found."""
+        if not self.sharded:
+            return DEFAULT_SHARD
+        shard = self._located.get((kind, key))
+        if shard is None:
+            shard = lookup()
+            if shard is not None:
+                self._located[(kind, key)] = shard
+        return shard
+
+    def session(self, shard: Optional[str] = None, **kwargs) -> "RoutedSession":
+        return RoutedSession(self, shard, **kwargs)
+
+    def dispose(self) -> None:
+        with self._lock:
+            for engine in self._engines.values():
+                engine.dispose()
+            self._engines.clear()
+            self._located.clear()
+
+
+def create_shard_engine(path: str) -> Engine:
+    # unbounded overflow: async_db sessions hold connections across awaits, a checkout must not wait
+    return create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False}, max_overflow=-1)
+
+
+class RoutedSession(Session):
+    """Session whose statements run on the directory or on the selected shard, by table."""
+
+    def __init__(self, router: ShardRouter, shard: Optional[str] = None, **kwargs):
+        super().__init__(router.directory, **kwargs)
+        self.router = router
+        self.shard = shard
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        router = self.router
+        if not router.sharded:
+            return router.directory
+        if mapper is not None:
+            tables = [mapper.local_table.name]
+        elif clause is not None:
+            tables = list(_statement_tables(clause))
+        else:
+            tables = []
+        if tables and all(name in router.directory_tables for name in tables):
+            return router.directory
+        if self.shard is None:
+            raise ShardNotSelected(f"no shard selected for a statement on {', '.join(tables) or 'unknown tables'}")
+        return router.engine_for(self.shard)
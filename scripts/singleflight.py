@@ -0,0 +1,50 @@
+"""
+Single-flight coalescing of identical concurrent requests.
+
+The first caller for a key starts the computation as its own task; callers arriving with
+the same key while it runs await that task instead of starting another one, and all of
+them get the same result or the same exception. The task is shielded, so one client
+disconnecting does not cancel the work the others are waiting for. Keys are forgotten
+as soon as the computation finishes: this is not a cache.
+
+    result = await analyze_flights.do((document_id, top_k), lambda: compute(...))
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+from observability import Counter
+
+COALESCED = Counter(
+    "smartemr_coalesced_requests_total", "Requests served by an identical in-flight computation", ["endpoint"]
+)
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    def _finished(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # retrieved here so an unawaited failure is not logged as lost
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._finished(key, t))
+        else:
+            COALESCED.inc(endpoint=self.name)
+        return await asyncio.shield(task)
+
+
+def normalize_question(question: str) -> str:
+    """Case, whitespace and trailing punctuation do not change what is being asked."""
+    return " ".join(question.lower().split()).rstrip(" ?!.")
@@ -1,56 +1,155 @@
 # backend/app/main.py
 import os
-import io
 import json
+import math
+import time
 import uuid
+import asyncio
+import threading
+import importlib
+import zipfile
 import datetime
-from typing import List, Optional, Dict, Any
+import mimetypes
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from typing import List, NamedTuple, Optional, Dict, Any, Tuple
 
 from fastapi import FastAPI, APIRouter, UploadFile, File, HTTPException, Depends, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from sqlmodel import SQLModel, Field, create_engine, Session, select
+from pydantic import BaseModel, conint
+from sqlmodel import SQLModel, Field, Index, create_engine, Session, select, insert, update, func, or_, and_
+from sqlalchemy import BigInteger, Integer, delete, inspect, literal, tuple_, true, text as sql_text
+from sqlalchemy.exc import IntegrityError
 import uvicorn
-
-# text extraction
-import PyPDF2
-from PIL import Image
-import pytesseract
-
-# OpenAI
-import openai
 from dotenv import load_dotenv
-import numpy as np
 
-# Firebase Admin
-import firebase_admin
-from firebase_admin import credentials, auth
+# Heavy dependencies (PyPDF2, PIL, pytesseract, openai, numpy, firebase_admin) are
+# imported inside the functions that use them so workers start quickly; see warm_up().
+import admission
+import async_db
+import blob_store
+import embedding_providers
+import extraction
+import llm_calls
+import ndjson_export
+import near_duplicates
+import sharding
+import singleflight
+import text_codec
+import vitals_extraction
+from context_packing import count_tokens, pack_context
+from llm_calls import parse_llm_json
+from observability import replay, STAGE_SECONDS, PROMPT_TOKENS, FALLBACKS, configure_logging, instrument_app
+from profiling import install_profiler
 
 load_dotenv()
+logger = configure_logging(os.getenv("LOG_LEVEL", "INFO"))
 
 # Configuration
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-if not OPENAI_API_KEY:
-    raise RuntimeError("Set OPENAI_API_KEY in your .env")
-openai.api_key = OPENAI_API_KEY
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./smartemr.db")
+# Per-doctor SQLite shards (see sharding.py); DATABASE_URL then only holds the directory
+SHARD_DIR = os.getenv("SHARD_DIR")
+SHARD_MAP = os.getenv("SHARD_MAP")  # JSON {doctor_uid: shard name}, e.g. one shard per clinic
+# Handlers await their queries on this many database threads (see async_db.py)
+DB_THREADS = int(os.getenv("DB_THREADS", "8"))
+async_db.configure(DB_THREADS)
 USE_AUTH = os.getenv("USE_AUTH", "true").lower() == "true"
 UPLOAD_DIR = os.getenv("UPLOAD_DIR", "./uploads")
+VITALS_BATCH_SIZE = int(os.getenv("VITALS_BATCH_SIZE", "5000"))
+MAX_VITAL_BUCKETS = 5000
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(os.cpu_count() or 4)))
+MAX_BATCH_FILES = int(os.getenv("MAX_BATCH_FILES", "500"))
+MAX_BATCH_BYTES = int(os.getenv("MAX_BATCH_BYTES", str(1 << 30)))  # uncompressed bytes of a batch's ZIP entries
+BLOB_DIR = os.getenv("BLOB_DIR", os.path.join(UPLOAD_DIR, "blobs"))
+COMPRESS_UPLOADS = os.getenv("COMPRESS_UPLOADS", "true").lower() == "true"
+# Unreferenced blob files (released, or left by failed uploads) are removed by sweep_blobs()
+# once nothing stored them for BLOB_SWEEP_GRACE_S; it runs every BLOB_SWEEP_INTERVAL_S (0 = never)
+BLOB_SWEEP_GRACE_S = float(os.getenv("BLOB_SWEEP_GRACE_S", "3600"))
+BLOB_SWEEP_INTERVAL_S = float(os.getenv("BLOB_SWEEP_INTERVAL_S", "3600"))
+# OCR: images are normalised to OCR_TARGET_DPI grayscale first; results are cached by content hash
+OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR", os.path.join(UPLOAD_DIR, "ocr-cache"))
+USE_OCR_CACHE = os.getenv("USE_OCR_CACHE", "true").lower() == "true"
+OCR_TARGET_DPI = int(os.getenv("OCR_TARGET_DPI", "300"))
+OCR_DETECT_ORIENTATION = os.getenv("OCR_DETECT_ORIENTATION", "true").lower() == "true"
+OCR_LANG = os.getenv("OCR_LANG", "eng")
+# Document and chunk text are stored zstd-compressed with a trained dictionary (see text_codec.py)
+TEXT_DICT_DIR = os.getenv("TEXT_DICT_DIR", os.path.join(UPLOAD_DIR, "text-dicts"))
+TEXT_ZSTD_LEVEL = int(os.getenv("TEXT_ZSTD_LEVEL", "3"))
+text_codec.configure(TEXT_DICT_DIR, TEXT_ZSTD_LEVEL)
+TEXT_DICT_MIN_SAMPLES = 100  # training on fewer chunks yields a dictionary that barely helps
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "true").lower() == "true"
+WARMUP_MODULES = ("numpy", "openai", "PyPDF2", "PIL.Image", "pytesseract")
+# Shared memory-mapped vector store (see vector_store.py); embedding_json stays the source of truth
+USE_VECTOR_STORE = os.getenv("USE_VECTOR_STORE", "true").lower() == "true"
+VECTOR_STORE_DIR = os.getenv("VECTOR_STORE_DIR", os.path.join(UPLOAD_DIR, "vectors"))
+# EMBEDDING_STORAGE=json keeps full-precision JSON in SQLite next to the int8 copy;
+# "int8" stores only the quantised vector (full precision lives in the vector store)
+EMBEDDING_STORAGE = os.getenv("EMBEDDING_STORAGE", "json").lower()
+# Retrieval scores int8 rows first and rescores this many candidates at full precision
+QUANTIZED_SEARCH = os.getenv("QUANTIZED_SEARCH", "true").lower() == "true"
+RESCORE_CANDIDATES = int(os.getenv("RESCORE_CANDIDATES", "64"))
+# Admission control for chat calls (see admission.py); batch callers send "X-Priority: batch"
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "100"))
+LLM_QUEUE_TIMEOUT_S = float(os.getenv("LLM_QUEUE_TIMEOUT_S", "10"))
+LLM_BATCH_QUEUE_TIMEOUT_S = float(os.getenv("LLM_BATCH_QUEUE_TIMEOUT_S", "60"))
+PRIORITY_HEADER = "X-Priority"
+
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0.8"))  # estimated Jaccard of 5-grams
+NEAR_DUPLICATE_PREFILTER = 0.9  # chunk pairs below this cosine are never compared by MinHash
+
+MAX_TIMELINE_LIMIT = 200
+MAX_TOP_K = 20  # chunks retrieved per analyze/qa request
+MAX_TIMELINE_VITALS = 1000  # per visit; bulk-imported visits can hold many thousands of readings
+EXPORT_PAGE_ROWS = int(os.getenv("EXPORT_PAGE_ROWS", "200"))  # rows per read (and per gzip flush) in exports
+EXPORT_SECTIONS = ("report", "document", "visit", "vital")
+
+# Retrieved chunks are merged and packed into at most this many context tokens
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+CHAT_MODEL = "gpt-4o-mini"
+
+# Embeddings: EMBEDDING_PROVIDER=openai|local (see embedding_providers.py)
+embedding_provider = embedding_providers.get_provider()
+# Chunks stored before vectors were tagged all came from the original OpenAI model
+LEGACY_EMBEDDING_KEY = "openai:text-embedding-3-small@1536"
+
+def init_firebase():
+    """Initialize Firebase Admin (only if USE_AUTH is true); called at startup."""
+    global USE_AUTH
+    if not USE_AUTH:
+        return
+    import firebase_admin
+    from firebase_admin import credentials
 
-# Initialize Firebase Admin (only if USE_AUTH is true)
-if USE_AUTH:
     SERVICE_ACCOUNT = os.getenv("FIREBASE_SERVICE_ACCOUNT", "./firebase_service_account.json")
     try:
         cred = credentials.Certificate(SERVICE_ACCOUNT)
         firebase_admin.initialize_app(cred)
     except Exception as e:
-        print(f"Firebase initialization failed: {e}")
+        logger.warning(f"Firebase initialization failed: {e}")
+        FALLBACKS.inc(kind="firebase_init_failed")
         USE_AUTH = False
 
+def get_openai():
+    import openai
+    if OPENAI_API_KEY:
+        openai.api_key = OPENAI_API_KEY
+    return openai
+
 # Database setup
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {})
+# A session writing keeps its connection across awaits (see async_db.py), so a checkout must
+# not wait on connections held by sessions queued behind it for a database thread. Reads
+# release theirs after each call; the pool covers the database threads plus DB_POOL_OVERFLOW
+# sessions mid-write. SQLite connections are cheap; there the overflow is unbounded.
+DB_POOL_OVERFLOW = int(os.getenv("DB_POOL_OVERFLOW", str(4 * DB_THREADS)))
+engine = create_engine(DATABASE_URL, **(
+    {"connect_args": {"check_same_thread": False}, "max_overflow": -1} if "sqlite" in DATABASE_URL
+    else {"pool_size": DB_THREADS, "max_overflow": DB_POOL_OVERFLOW}
+))
 
 # ---------------- Models ----------------
 class User(SQLModel, table=True):
@@ -70,27 +169,36 @@ class Patient(SQLModel, table=True):
     created_at: datetime.datetime = Field(default_factory=datetime.datetime.utcnow)
 
 class Visit(SQLModel, table=True):
+    __table_args__ = (Index("ix_visit_patient_date", "patient_id", "visit_date"),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
-    patient_id: int
+    patient_id: int = Field(index=True)
     doctor_uid: Optional[str] = None
     visit_date: Optional[datetime.datetime] = Field(default_factory=datetime.datetime.utcnow)
     notes: Optional[str] = None
 
 class Vital(SQLModel, table=True):
+    __table_args__ = (Index("ix_vital_visit_name_recorded", "visit_id", "name", "recorded_at"),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
-    visit_id: int
+    visit_id: int = Field(index=True)  # (visit_id, id) order for keyset-paged exports
     name: str
     value: float
     unit: Optional[str] = None
+    document_id: Optional[int] = Field(default=None, index=True)  # report the reading was extracted from
     recorded_at: Optional[datetime.datetime] = Field(default_factory=datetime.datetime.utcnow)
 
 class Report(SQLModel, table=True):
+    # (patient_id, NULL visit_id) is an index range: the timeline's reports without a visit
+    __table_args__ = (Index("ix_report_patient_visit_created", "patient_id", "visit_id", "created_at"),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
-    report_id: str  # REP-YYYYMMDD-XXXXXX
+    report_id: str = Field(index=True)  # REP-YYYYMMDD-XXXXXX
     patient_id: int
     doctor_uid: str
     filename: str
     file_path: str
+    visit_id: Optional[int] = None  # visit recorded from this report (see save_extracted_vitals)
     created_at: datetime.datetime = Field(default_factory=datetime.datetime.utcnow)
 
 class Document(SQLModel, table=True):
@@ -98,21 +206,127 @@ class Document(SQLModel, table=True):
     uuid: str
     owner_uid: Optional[str] = None
     filename: str
-    content_text: Optional[str] = None
-    report_id: Optional[str] = None
+    content_text: Optional[str] = Field(default=None, sa_type=text_codec.CompressedText)
+    report_id: Optional[str] = Field(default=None, index=True)
     patient_id: Optional[int] = None  # Link to patient
+    content_sha256: Optional[str] = Field(default=None, index=True)  # sha256 of the uploaded bytes
+    # Embedding space retrieval uses for this document; reembed.py switches it atomically
+    # with the chunk vectors. NULL (older rows) means the configured provider.
+    embedding_model: Optional[str] = None
+    minhash: Optional[bytes] = None  # near_duplicates.signature of content_text
+    near_duplicate_of: Optional[int] = None  # earlier document of the same patient/owner with near-identical text
     created_at: datetime.datetime = Field(default_factory=datetime.datetime.utcnow)
 
 class DocumentChunk(SQLModel, table=True):
+    __table_args__ = (Index("ix_documentchunk_document_chunk", "document_id", "chunk_index"),)
     id: Optional[int] = Field(default=None, primary_key=True)
-    document_id: int
+    document_id: int = Field(index=True)
     chunk_index: int
-    text: str
-    embedding_json: str
+    text: str = Field(sa_type=text_codec.CompressedText)
+    embedding_json: str  # "" when EMBEDDING_STORAGE=int8
+    embedding_model: Optional[str] = None  # provider key, e.g. "openai:text-embedding-3-small@1536"
+    embedding_q8: Optional[bytes] = None  # int8 L2-normalised vector, see vector_store.quantize_int8
+    embedding_scale: Optional[float] = None
+    created_at: datetime.datetime = Field(default_factory=datetime.datetime.utcnow)
+
+class DocumentMinHashBand(SQLModel, table=True):
+    """LSH buckets of Document.minhash: documents sharing a bucket are near-duplicate candidates."""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    document_id: int = Field(index=True)
+    bucket: int = Field(index=True, sa_type=BigInteger)  # signed 64-bit, see near_duplicates.band_buckets
+
+class ReembedJob(SQLModel, table=True):
+    """Progress of a reembed.py run; last_document_id is the resume checkpoint."""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    target_model: str  # provider key the job converts documents to
+    status: str = "running"  # running, done, failed
+    last_document_id: int = 0
+    documents_done: int = 0
+    chunks_embedded: int = 0
+    chunks_reused: int = 0
+    error: Optional[str] = None
+    created_at: datetime.datetime = Field(default_factory=datetime.datetime.utcnow)
+    updated_at: datetime.datetime = Field(default_factory=datetime.datetime.utcnow)
+
+# Shard directory: which shard holds a patient, document or report. Patient and
+# document ids are allocated here so they are unique across shards.
+class PatientShard(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    shard: str
+
+class DocumentShard(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    shard: str
+
+class ReportShard(SQLModel, table=True):
+    report_id: str = Field(primary_key=True)
+    shard: str
+
+class Blob(SQLModel, table=True):
+    sha256: str = Field(primary_key=True)
+    path: str
+    size: int
+    stored_size: int
+    compression: Optional[str] = None  # 'zstd' or None
+    refcount: int = 0  # number of Report rows whose file_path points here
     created_at: datetime.datetime = Field(default_factory=datetime.datetime.utcnow)
 
-# Create tables
-SQLModel.metadata.create_all(engine)
+DIRECTORY_TABLES = ("user", "blob", "reembedjob", "patientshard", "documentshard", "reportshard")
+
+def database_tables(directory: bool):
+    """Tables of the shard directory database, or of each shard."""
+    return [t for t in SQLModel.metadata.sorted_tables if (t.name in DIRECTORY_TABLES) == directory]
+
+def migrate_schema(bind=engine, tables=None):
+    """create_all never alters existing tables: add new nullable columns, widen INTEGER columns
+    the models declare BIGINT (SQLite integers are 64-bit already) and add missing indexes."""
+    tables = tables if tables is not None else SQLModel.metadata.sorted_tables
+    inspector = inspect(bind)
+    with bind.begin() as conn:
+        for table in tables:
+            existing = {c["name"]: c["type"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                col_type = column.type.compile(dialect=bind.dialect)
+                if column.name not in existing:
+                    conn.execute(sql_text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}"))
+                elif (isinstance(column.type, BigInteger) and bind.dialect.name != "sqlite"
+                      and isinstance(existing[column.name], Integer)
+                      and not isinstance(existing[column.name], BigInteger)):
+                    conn.execute(sql_text(f"ALTER TABLE {table.name} ALTER COLUMN {column.name} TYPE {col_type}"))
+    for table in tables:
+        for index in table.indexes:
+            index.create(bind, checkfirst=True)
+
+def prepare_shard(shard_engine):
+    tables = database_tables(directory=False)
+    SQLModel.metadata.create_all(shard_engine, tables=tables)
+    migrate_schema(shard_engine, tables)
+
+shards = sharding.ShardRouter(engine, SHARD_DIR, sharding.load_shard_map(SHARD_MAP),
+                              DIRECTORY_TABLES, prepare=prepare_shard)
+
+_db_ready = False
+_db_lock = threading.Lock()
+
+def ensure_db():
+    """Create tables and apply migrations once per process (at startup or first use)."""
+    global _db_ready
+    if _db_ready:
+        return
+    with _db_lock:
+        if not _db_ready:
+            tables = database_tables(directory=True) if shards.sharded else SQLModel.metadata.sorted_tables
+            SQLModel.metadata.create_all(engine, tables=tables)
+            migrate_schema(engine, tables)
+            _db_ready = True
+
+def warm_up():
+    """Import heavy dependencies ahead of the first request that needs them."""
+    for name in WARMUP_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            logger.warning(f"Warm-up import of {name} failed: {e}")
 
 # ---------------- Auth Dependencies ----------------
 async def verify_token(request: Request):
@@ -127,61 +341,137 @@ async def verify_token(request: Request):
     
     id_token = auth_header.split(" ", 1)[1].strip()
     try:
+        from firebase_admin import auth
         decoded = auth.verify_id_token(id_token)
         return decoded
     except Exception as e:
         raise HTTPException(status_code=401, detail=f"Invalid token: {e}")
 
-def get_session():
-    with Session(engine) as session:
+def db_session(shard: Optional[str] = None) -> async_db.AsyncSession:
+    return async_db.AsyncSession(shards.session(shard))
+
+async def get_session():
+    if not _db_ready:
+        await async_db.run(ensure_db)
+    async with db_session() as session:
         yield session
 
-# ---------------- Helper Functions ----------------
-def extract_text_from_pdf_bytes(pdf_bytes: bytes) -> str:
-    text_parts = []
+SHARD_KEYS = {"patient": PatientShard.id, "document": DocumentShard.id, "report": ReportShard.report_id}
+
+def use_shard_of(session: Session, kind: str, key: Any) -> bool:
+    """Point the session at the shard holding patient/document/report `key`; False if none does."""
+    column = SHARD_KEYS[kind]
+    shard = shards.locate(kind, key, lambda: session.exec(
+        select(column.class_.shard).where(column == key)
+    ).first())
+    if shard is None:
+        return False
+    session.shard = shard
+    return True
+
+def use_doctor_shard(session: Session, uid: str) -> None:
+    session.shard = shards.shard_for_doctor(uid)
+
+@contextmanager
+def directory_transaction(session: Session):
+    """Session for the directory rows that go with a write to `session`'s shard.
+
+    Sharded, a short transaction of its own on the directory, committed before the
+    shard write starts: the directory's SQLite write lock is never held while a shard
+    is written, so writers of different shards do not queue on it. If the shard write
+    then fails, forget_directory_entries() removes the rows again. Unsharded, it is
+    `session` itself and the rows commit atomically with the rest.
+    """
+    if not shards.sharded:
+        yield session
+        return
+    with Session(shards.directory) as directory:
+        yield directory
+        directory.commit()
+
+def allocate_id(directory: Session, directory_model, shard: str) -> Optional[int]:
+    """Directory-assigned id for a new Patient or Document in `shard`.
+
+    None when unsharded: the row's own autoincrement assigns it.
+    """
+    if not shards.sharded:
+        return None
+    entry = directory_model(shard=shard)
+    directory.add(entry)
+    directory.flush()
+    return entry.id
+
+def register_report_id(directory: Session, report_id: str, shard: str) -> None:
+    if shards.sharded:
+        directory.add(ReportShard(report_id=report_id, shard=shard))
+
+def reserve_directory_entries(session: Session, directory_model, report_id: Optional[str] = None,
+                              blob: Optional[blob_store.StoredBlob] = None) -> Optional[int]:
+    """Allocate the id of a new Patient/Document in the session's shard, register its
+    report_id and take a reference to its blob, in one directory transaction."""
+    with directory_transaction(session) as directory:
+        if report_id is not None:
+            register_report_id(directory, report_id, session.shard)
+        if blob is not None:
+            acquire_blob(directory, blob)
+        return allocate_id(directory, directory_model, session.shard)
+
+def forget_directory_entries(session: Session, directory_model, entry_id: Optional[int],
+                             report_id: Optional[str] = None, digest: Optional[str] = None) -> None:
+    """Undo reserve_directory_entries() once the shard rows are gone: the shard write failed,
+    or the document was deleted (unsharded, the shard transaction itself did it)."""
+    if not shards.sharded:
+        return
     try:
-        reader = PyPDF2.PdfReader(io.BytesIO(pdf_bytes))
-        for page in reader.pages:
-            page_text = page.extract_text()
-            if page_text:
-                text_parts.append(page_text)
+        with directory_transaction(session) as directory:
+            if entry_id is not None:
+                directory.execute(delete(directory_model).where(directory_model.id == entry_id))
+            if report_id is not None:
+                directory.execute(delete(ReportShard).where(ReportShard.report_id == report_id))
+            if digest is not None:
+                release_blob(directory, digest)
     except Exception:
-        pass
-    return "\n".join(text_parts).strip()
+        logger.exception("Removing directory entries of a failed shard write failed")
+        FALLBACKS.inc(kind="directory_cleanup_failed")
+
+def get_accessible_patient(session: Session, uid: str, patient_id: int) -> Patient:
+    """Return the patient if `uid` is its owning doctor or the linked patient user."""
+    user = session.exec(select(User).where(User.uid == uid)).first()
+    if not user:
+        raise HTTPException(status_code=401, detail="User not registered")
+    if not use_shard_of(session, "patient", patient_id):
+        raise HTTPException(status_code=404, detail="Patient not found")
+    patient = session.get(Patient, patient_id)
+    if not patient:
+        raise HTTPException(status_code=404, detail="Patient not found")
+    if user.role == "doctor" and patient.owner_doctor_uid == uid:
+        return patient
+    if user.role == "patient" and patient.patient_uid == uid:
+        return patient
+    raise HTTPException(status_code=403, detail="Not authorized for this patient")
+
+# ---------------- Helper Functions ----------------
+def ocr_settings() -> extraction.OcrSettings:
+    return extraction.OcrSettings(OCR_LANG, OCR_TARGET_DPI, OCR_DETECT_ORIENTATION,
+                                  OCR_CACHE_DIR if USE_OCR_CACHE else None)
 
 def ocr_image_bytes(image_bytes: bytes) -> str:
-    try:
-        image = Image.open(io.BytesIO(image_bytes))
-        text = pytesseract.image_to_string(image)
-        return text
-    except Exception:
-        return ""
+    return extraction.ocr_image(image_bytes, ocr_settings())
+
+@STAGE_SECONDS.time(stage="extract")
+def extract_text_from_bytes(content: bytes, content_type: Optional[str]) -> str:
+    return extraction.extract_text(content, content_type, ocr_settings())
 
 def extract_text_from_upload(file: UploadFile) -> str:
     content = file.file.read()
-    text = ""
-    if file.content_type == "application/pdf":
-        text = extract_text_from_pdf_bytes(content)
-        if not text or len(text) < 50:
-            try:
-                text = ocr_image_bytes(content)
-            except Exception:
-                pass
-    elif file.content_type and file.content_type.startswith("image/"):
-        text = ocr_image_bytes(content)
-    elif file.content_type in ["text/plain", "application/text"]:
-        text = content.decode("utf-8", errors="ignore")
-    else:
-        try:
-            text = content.decode("utf-8", errors="ignore")
-        except Exception:
-            text = ""
+    text = extract_text_from_bytes(content, file.content_type)
     
     file.file.seek(0)  # Reset file pointer
     if not text or len(text.strip()) == 0:
         raise HTTPException(status_code=400, detail="Could not extract text from document.")
     return text
 
+@STAGE_SECONDS.time(stage="chunk")
 def chunk_text(text: str, max_chars: int = 1200, overlap: int = 200) -> List[str]:
     text = text.replace("\r\n", "\n")
     chunks = []
@@ -197,40 +487,754 @@ def chunk_text(text: str, max_chars: int = 1200, overlap: int = 200) -> List[str
         start = end - overlap
     return chunks
 
-def create_embeddings(texts: List[str], model: str = "text-embedding-3-small") -> List[List[float]]:
+def create_embeddings(texts: List[str], provider: Optional[embedding_providers.EmbeddingProvider] = None) -> List[List[float]]:
+    """Embed texts with the configured provider; store the vectors tagged with its `key`."""
     if not texts:
         return []
+    with STAGE_SECONDS.time(stage="embed_batch"):
+        return (provider or embedding_provider).embed(texts)
+
+def same_embedding_space(key: str):
+    """SQL filter for chunks whose vectors were produced by the provider `key`."""
+    if key == LEGACY_EMBEDDING_KEY:
+        return or_(DocumentChunk.embedding_model == key, DocumentChunk.embedding_model.is_(None))
+    return DocumentChunk.embedding_model == key
+
+_providers: Dict[str, embedding_providers.EmbeddingProvider] = {}
+
+def provider_for(key: Optional[str]) -> embedding_providers.EmbeddingProvider:
+    """Provider for a stored embedding space key (None means the configured provider)."""
+    if key is None or key == embedding_provider.key:
+        return embedding_provider
+    provider = _providers.get(key)
+    if provider is None:
+        provider = _providers[key] = embedding_providers.provider_from_key(key)
+    return provider
+
+_vector_stores: Dict[str, Any] = {}
+
+def get_vector_store(provider: Optional[embedding_providers.EmbeddingProvider] = None):
+    """Per-process handle on the shared vector file for `provider`'s embedding space."""
+    if not USE_VECTOR_STORE:
+        return None
+    provider = provider or embedding_provider
+    store = _vector_stores.get(provider.key)
+    if store is None:
+        import vector_store
+        store = _vector_stores[provider.key] = vector_store.VectorStore(VECTOR_STORE_DIR, provider.key, provider.dim)
+    return store
+
+def publish_vectors(document_id: int, embeddings: List[List[float]] = None, link_from: Optional[int] = None,
+                    provider: Optional[embedding_providers.EmbeddingProvider] = None) -> None:
+    """Append a document's vectors (or link them to an identical document's rows) to the shared store.
+
+    Failures only cost speed: retrieval falls back to embedding_json and backfills.
+    """
+    store = get_vector_store(provider)
+    if store is None:
+        return
     try:
-        resp = openai.Embedding.create(model=model, input=texts)
-        return [item["embedding"] for item in resp["data"]]
+        if link_from is not None:
+            store.link(document_id, link_from)
+        elif embeddings is not None and len(embeddings):
+            store.append(document_id, embeddings)
     except Exception as e:
-        print(f"Embedding creation failed: {e}")
-        return [[0.0] * 1536 for _ in texts]  # Return dummy embeddings
-
-def cosine_sim(a: np.ndarray, b: np.ndarray) -> float:
-    if np.linalg.norm(a) == 0 or np.linalg.norm(b) == 0:
-        return 0.0
-    return float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
-
-def retrieve_relevant_chunks(document_id: int, query: str, top_k: int = 4):
+        logger.warning(f"Vector store write failed for document {document_id}: {e}")
+        FALLBACKS.inc(kind="vector_store_write_failed")
+
+def unpublish_vectors(document_id: int, provider: Optional[embedding_providers.EmbeddingProvider] = None) -> None:
+    """Tombstone a deleted document's vectors; compaction reclaims the rows."""
+    store = get_vector_store(provider)
+    if store is None:
+        return
     try:
-        q_emb = create_embeddings([query])[0]
-        q_vec = np.array(q_emb)
-        with Session(engine) as session:
-            rows = session.exec(select(DocumentChunk).where(DocumentChunk.document_id == document_id)).all()
-            sims = []
-            for r in rows:
-                try:
-                    emb = np.array(json.loads(r.embedding_json))
-                    sims.append((r, cosine_sim(q_vec, emb)))
-                except:
-                    sims.append((r, 0.0))
-            sims_sorted = sorted(sims, key=lambda x: x[1], reverse=True)
-            top = sims_sorted[:top_k]
-            return [(r.text, float(score)) for (r, score) in top]
+        store.delete(document_id)
     except Exception as e:
-        print(f"Chunk retrieval failed: {e}")
+        logger.warning(f"Vector store delete failed for document {document_id}: {e}")
+        FALLBACKS.inc(kind="vector_store_write_failed")
+
+def chunk_rows(document_id: int, chunks: List[str], embeddings: List[List[float]],
+               provider: Optional[embedding_providers.EmbeddingProvider] = None) -> List[Dict[str, Any]]:
+    """DocumentChunk rows for executemany insert, with the int8 copy of each vector."""
+    if not chunks:
+        return []
+    from vector_store import quantize_int8
+    q, scales = quantize_int8(embeddings)
+    return [
+        {
+            "document_id": document_id,
+            "chunk_index": idx,
+            "text": ch_text,
+            "embedding_json": json.dumps(emb) if EMBEDDING_STORAGE == "json" else "",
+            "embedding_model": (provider or embedding_provider).key,
+            "embedding_q8": q[idx].tobytes(),
+            "embedding_scale": float(scales[idx]),
+        }
+        for idx, (ch_text, emb) in enumerate(zip(chunks, embeddings))
+    ]
+
+def load_chunk_vectors(session: Session, document_id: int, key: str, dim: int) -> Tuple["np.ndarray", List[int]]:
+    """Decode a document's stored vectors (ordered by chunk_index) into one matrix.
+
+    Uses embedding_json when present, otherwise the dequantised int8 copy.
+    """
+    import numpy as np
+    rows = session.exec(select(
+        DocumentChunk.chunk_index, DocumentChunk.embedding_json,
+        DocumentChunk.embedding_q8, DocumentChunk.embedding_scale
+    ).where(
+        DocumentChunk.document_id == document_id,
+        same_embedding_space(key)
+    ).order_by(DocumentChunk.chunk_index)).all()
+    matrix = np.zeros((len(rows), dim), dtype=np.float32)
+    for i, (_, embedding_json, q8, scale) in enumerate(rows):
+        try:
+            if embedding_json:
+                matrix[i] = json.loads(embedding_json)
+            else:
+                matrix[i] = np.frombuffer(q8, dtype=np.int8) * np.float32(scale)
+        except Exception:
+            FALLBACKS.inc(kind="embedding_decode_failed")
+    return matrix, [row[0] for row in rows]
+
+def cosine_scores(matrix: "np.ndarray", q_vec: "np.ndarray") -> "np.ndarray":
+    import numpy as np
+    norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(q_vec)
+    dots = matrix @ q_vec
+    return np.divide(dots, norms, out=np.zeros_like(dots), where=norms > 0)
+
+def collapse_near_duplicate_chunks(vectors: "np.ndarray", texts: List[str], limit: int) -> List[int]:
+    """Positions of up to `limit` chunks (best first), skipping near-copies of a better one.
+
+    Only pairs whose vectors are nearly parallel are compared by MinHash.
+    """
+    import numpy as np
+    norms = np.linalg.norm(vectors, axis=1)
+    unit = np.divide(vectors, norms[:, None], out=np.zeros_like(vectors), where=norms[:, None] > 0)
+    cosines = unit @ unit.T
+    kept: List[int] = []
+    signatures: Dict[int, Optional[bytes]] = {}
+    for i in range(len(texts)):
+        if len(kept) == limit:
+            break
+        close = [j for j in kept if cosines[i, j] >= NEAR_DUPLICATE_PREFILTER]
+        if close:
+            for j in [i] + close:
+                if j not in signatures:
+                    signatures[j] = near_duplicates.signature(texts[j])
+            if any(signatures[i] and signatures[j] and near_duplicates.similarity(signatures[i], signatures[j])
+                   >= NEAR_DUPLICATE_THRESHOLD for j in close):
+                near_duplicates.NEAR_DUPLICATES.inc(kind="chunk_collapsed")
+                continue
+        kept.append(i)
+    return kept
+
+def retrieve_relevant_chunks(document_id: int, query: str, top_k: int = 4) -> List[Tuple[str, float]]:
+    """Blocking retrieval for scripts and benchmarks; handlers await retrieve_scored_chunks()."""
+    return [(text, score) for _, text, score in asyncio.run(retrieve_scored_chunks(document_id, query, top_k))]
+
+def rank_chunks(matrix: "np.ndarray", q_vec: "np.ndarray", quantized, top_k: int) -> Tuple["np.ndarray", "np.ndarray"]:
+    """Rows of `matrix` most similar to `q_vec` (2 * top_k, best first) and their cosine scores."""
+    import numpy as np
+    if quantized is not None:
+        # int8 first pass reads a quarter of the bytes; rescore the shortlist exactly
+        from vector_store import quantized_scores
+        shortlist = max(RESCORE_CANDIDATES, top_k)
+        approx = quantized_scores(*quantized, q_vec)
+        candidates = np.sort(np.argpartition(-approx, shortlist - 1)[:shortlist])
+        scores = cosine_scores(matrix[candidates], q_vec)
+    else:
+        candidates = np.arange(len(matrix))
+        scores = cosine_scores(matrix, q_vec)
+    # over-fetch so that pages repeated within the document can be collapsed
+    order = np.argsort(-scores, kind="stable")[:top_k * 2]
+    return candidates[order], scores[order]
+
+async def retrieve_scored_chunks(document_id: int, query: str, top_k: int = 4) -> List[Tuple[int, str, float]]:
+    """Top-k (chunk_index, text, cosine score) for `query`, best first.
+
+    Queries run on the database threads and embedding and scoring on worker threads,
+    so the event loop is free while a retrieval waits.
+    """
+    import numpy as np
+    with STAGE_SECONDS.time(stage="retrieve"):
+        try:
+            if not _db_ready:
+                await async_db.run(ensure_db)
+            async with db_session() as session:
+                if not await session.run_sync(use_shard_of, "document", document_id):
+                    return []
+                shard = session.shard
+                provider = provider_for((await session.exec(
+                    select(Document.embedding_model).where(Document.id == document_id)
+                )).first())
+            # no connection held while the embedding API is called
+            embedded = await asyncio.to_thread(create_embeddings, [query], provider)
+            q_vec = np.asarray(embedded[0], dtype=np.float32)
+            async with db_session(shard) as session:
+                store = get_vector_store(provider)
+                matrix = store.get(document_id) if store is not None else None
+                if matrix is not None:
+                    chunk_indexes = range(len(matrix))
+                else:
+                    matrix, chunk_indexes = await session.run_sync(load_chunk_vectors, document_id, provider.key, len(q_vec))
+                    if store is not None and len(matrix) and chunk_indexes == list(range(len(matrix))):
+                        await asyncio.to_thread(publish_vectors, document_id, matrix, provider=provider)
+                if not len(matrix):
+                    return []
+                quantized = None
+                if store is not None and QUANTIZED_SEARCH and len(matrix) > max(RESCORE_CANDIDATES, top_k):
+                    quantized = store.get_quantized(document_id)
+                top, scores = await asyncio.to_thread(rank_chunks, matrix, q_vec, quantized, top_k)
+                wanted = [chunk_indexes[i] for i in top]
+                # chunk_index is unique per document whatever the embedding space, so this
+                # still finds the text if reembed.py switches the document meanwhile
+                texts = dict((await session.exec(select(DocumentChunk.chunk_index, DocumentChunk.text).where(
+                    DocumentChunk.document_id == document_id,
+                    DocumentChunk.chunk_index.in_(wanted)
+                ))).all())
+            found = [i for i, idx in enumerate(wanted) if idx in texts]
+            kept = collapse_near_duplicate_chunks(matrix[top[found]], [texts[wanted[i]] for i in found], top_k)
+            return [(wanted[found[i]], texts[wanted[found[i]]], float(scores[found[i]])) for i in kept]
+        except Exception as e:
+            logger.warning(f"Chunk retrieval failed: {e}")
+            FALLBACKS.inc(kind="retrieval_failed")
+            return []
+
+def call_chat_completion(endpoint: str, system_prompt: str, user_prompt: str, max_tokens: int) -> str:
+    """Call the chat API, recording latency and token usage; returns the message content."""
+    return llm_calls.chat_completion(get_openai(), CHAT_MODEL, endpoint, system_prompt, user_prompt, max_tokens)
+
+llm_scheduler = admission.LLMScheduler(
+    LLM_MAX_CONCURRENCY, LLM_MAX_QUEUE, LLM_QUEUE_TIMEOUT_S, LLM_BATCH_QUEUE_TIMEOUT_S
+)
+
+def request_priority(session: Session, decoded: Dict[str, Any], request: Request) -> str:
+    """Admission class for a chat call: the caller's role and interactive vs batch mode."""
+    role = session.exec(select(User.role).where(User.uid == decoded.get("uid"))).first()
+    return admission.priority_class(role or decoded.get("role"), request.headers.get(PRIORITY_HEADER, "").lower())
+
+def parse_timestamp(value: Any) -> datetime.datetime:
+    """Parse ISO-8601 text or epoch seconds into a naive UTC datetime."""
+    if value is None:
+        return datetime.datetime.utcnow()
+    if isinstance(value, (int, float)):
+        try:
+            return datetime.datetime.utcfromtimestamp(value)
+        except (OverflowError, OSError, ValueError):
+            raise ValueError(f"timestamp out of range: {value!r}")
+    ts = datetime.datetime.fromisoformat(str(value))
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return ts
+
+def parse_vitals_payload(body: bytes, content_type: str) -> List[Dict[str, Any]]:
+    """Parse NDJSON readings or a columnar JSON object into Vital rows (without visit_id)."""
+    if "ndjson" in content_type or "jsonlines" in content_type:
+        records = [json.loads(line) for line in body.splitlines() if line.strip()]
+    else:
+        payload = json.loads(body)
+        values = payload.get("values") or []
+        n = len(values)
+        names = payload.get("names") or [payload.get("name")] * n
+        units = payload.get("units") or [payload.get("unit")] * n
+        times = payload.get("recorded_at") or [None] * n
+        if not (len(names) == len(units) == len(times) == n):
+            raise ValueError("columnar arrays must all have the same length")
+        records = [
+            {"name": name, "value": value, "unit": unit, "recorded_at": ts}
+            for name, value, unit, ts in zip(names, values, units, times)
+        ]
+
+    rows = []
+    for rec in records:
+        if not rec.get("name") or rec.get("value") is None:
+            raise ValueError("every reading needs a name and a value")
+        value = float(rec["value"])
+        if not math.isfinite(value):
+            raise ValueError(f"reading values must be finite numbers, got {rec['value']!r}")
+        rows.append({
+            "name": str(rec["name"]),
+            "value": value,
+            "unit": rec.get("unit"),
+            "recorded_at": parse_timestamp(rec.get("recorded_at")),
+        })
+    return rows
+
+def downsample_series(times: "np.ndarray", values: "np.ndarray", buckets: int,
+                      start: Optional[datetime.datetime] = None,
+                      end: Optional[datetime.datetime] = None) -> List[Dict[str, Any]]:
+    """Reduce a time-sorted series to at most `buckets` equal-width time buckets.
+
+    Empty buckets are omitted; each returned bucket carries min/max/mean/last.
+    """
+    import numpy as np
+    if len(values) == 0:
         return []
+    t = times.astype("datetime64[us]").astype(np.int64)
+    t0 = np.datetime64(start, "us").astype(np.int64) if start else t[0]
+    t1 = np.datetime64(end, "us").astype(np.int64) if end else t[-1]
+    width = max(1, -(-(int(t1) - int(t0)) // buckets))  # ceil division
+
+    bucket_ids = np.clip((t - t0) // width, 0, buckets - 1)
+    starts = np.flatnonzero(np.r_[True, bucket_ids[1:] != bucket_ids[:-1]])
+    ends = np.r_[starts[1:], len(values)]
+    counts = ends - starts
+
+    mins = np.minimum.reduceat(values, starts)
+    maxs = np.maximum.reduceat(values, starts)
+    means = np.add.reduceat(values, starts) / counts
+    lasts = values[ends - 1]
+    edges = (t0 + bucket_ids[starts] * width).astype("datetime64[us]").tolist()
+
+    return [
+        {
+            "start": edges[i].isoformat(),
+            "end": (edges[i] + datetime.timedelta(microseconds=width)).isoformat(),
+            "count": int(counts[i]),
+            "min": float(mins[i]),
+            "max": float(maxs[i]),
+            "mean": float(means[i]),
+            "last": float(lasts[i]),
+        }
+        for i in range(len(starts))
+    ]
+
+def new_report_id() -> str:
+    return "REP-" + datetime.datetime.utcnow().strftime("%Y%m%d") + "-" + uuid.uuid4().hex[:6].upper()
+
+def store_upload(src, filename: str, content_type: Optional[str] = None) -> blob_store.StoredBlob:
+    """Stream a file-like object into the content-addressed blob store."""
+    compress = COMPRESS_UPLOADS and blob_store.is_text_like(content_type, filename)
+    return blob_store.put(BLOB_DIR, src, compress=compress)
+
+def acquire_blob(session: Session, blob: blob_store.StoredBlob) -> None:
+    """Record one more Report referencing `blob` (creating its Blob row if needed)."""
+    bump = update(Blob).where(Blob.sha256 == blob.digest).values(refcount=Blob.refcount + 1)
+    if not session.execute(bump).rowcount:
+        try:
+            with session.begin_nested():
+                session.add(Blob(
+                    sha256=blob.digest,
+                    path=blob.path,
+                    size=blob.size,
+                    stored_size=blob.stored_size,
+                    compression=blob.compression,
+                    refcount=1
+                ))
+        except IntegrityError:  # another request created it concurrently
+            session.execute(bump)
+    # The row now holds a reference, so sweep_blobs() leaves the file alone; it can only
+    # have gone already if this upload took longer than BLOB_SWEEP_GRACE_S to get here.
+    if not os.path.exists(blob.path):
+        raise RuntimeError(f"Stored upload {blob.digest} was swept before it was referenced; upload it again")
+
+def release_blob(session: Session, digest: str) -> None:
+    """Drop one reference to a blob; sweep_blobs() deletes the file once none are left."""
+    session.execute(update(Blob).where(Blob.sha256 == digest).values(refcount=Blob.refcount - 1))
+
+def sweep_blobs(grace_seconds: float = BLOB_SWEEP_GRACE_S) -> int:
+    """Delete blob files no Report references: released to refcount 0, or stored by an upload
+    that failed before acquire_blob(). Files store_upload() wrote or resolved to within
+    `grace_seconds` are kept, as their upload may not have taken its reference yet.
+    A file is only unlinked after its row's deletion committed. Returns the files deleted."""
+    cutoff = time.time() - grace_seconds
+    removed = 0
+    with shards.session() as session:
+        for digest, path in blob_store.iter_blobs(BLOB_DIR):
+            if not blob_store.is_idle(path, cutoff):
+                continue
+            session.execute(delete(Blob).where(Blob.sha256 == digest, Blob.refcount <= 0))
+            referenced = session.get(Blob, digest) is not None
+            session.commit()
+            if not referenced and blob_store.remove_if_idle(path, cutoff):
+                removed += 1
+    return removed
+
+async def sweep_blobs_periodically() -> None:
+    while True:
+        await asyncio.sleep(BLOB_SWEEP_INTERVAL_S)
+        try:
+            removed = await asyncio.to_thread(sweep_blobs)
+            if removed:
+                logger.info(f"Removed {removed} unreferenced upload files")
+        except Exception:
+            logger.exception("Sweeping unreferenced upload files failed")
+
+def find_processed_document(session: Session, digest: str) -> Optional[Document]:
+    """Return an earlier Document built from identical bytes, if any."""
+    return session.exec(
+        select(Document).where(Document.content_sha256 == digest).order_by(Document.id)
+    ).first()
+
+def save_duplicate_upload(session: Session, patient_id: int, doctor_uid: str, filename: str,
+                          blob: blob_store.StoredBlob) -> Optional[Dict[str, Any]]:
+    """Short-circuit ingestion when identical bytes were already extracted and embedded."""
+    if not blob.existed:
+        return None
+    source = find_processed_document(session, blob.digest)
+    if not source:
+        return None
+    report, doc = save_report_document(
+        session, patient_id, doctor_uid, filename, blob, source.content_text, [], [],
+        reuse_chunks_from=source.id, minhash=source.minhash
+    )
+    return {
+        "status": "ok",
+        "report_id": report.report_id,
+        "document_id": doc.id,
+        "chunks": count_chunks(session, doc.id),
+        "deduplicated": True
+    }
+
+def count_chunks(session: Session, document_id: int) -> int:
+    return session.exec(
+        select(func.count()).select_from(DocumentChunk).where(DocumentChunk.document_id == document_id)
+    ).one()
+
+class NearDuplicate(NamedTuple):
+    document_id: int
+    report_id: Optional[str]
+    embedding_model: Optional[str]
+    similarity: float
+    linkable: bool  # same numbers as the new text: its chunks can be reused
+
+    def info(self) -> Dict[str, Any]:
+        return {"document_id": self.document_id, "report_id": self.report_id,
+                "similarity": round(self.similarity, 3), "linked": self.linkable}
+
+def find_near_duplicate(session: Session, minhash: Optional[bytes], text: str,
+                        patient_id: Optional[int] = None, owner_uid: Optional[str] = None) -> Optional[NearDuplicate]:
+    """Most similar earlier document of the same patient (or, without a patient, the same owner)."""
+    if minhash is None:
+        return None
+    if patient_id is not None:
+        scope = Document.patient_id == patient_id
+    else:
+        scope = and_(Document.owner_uid == owner_uid, Document.patient_id.is_(None))
+    in_bucket = select(DocumentMinHashBand.document_id).where(
+        DocumentMinHashBand.bucket.in_(near_duplicates.band_buckets(minhash))
+    )
+    candidates = session.exec(
+        select(Document.id, Document.minhash).where(Document.id.in_(in_bucket), scope)
+    ).all()
+    scored = [(near_duplicates.similarity(minhash, m), doc_id) for doc_id, m in candidates]
+    best = max(scored, default=None)
+    if best is None or best[0] < NEAR_DUPLICATE_THRESHOLD:
+        return None
+    source = session.exec(
+        select(Document.report_id, Document.embedding_model, Document.content_text).where(Document.id == best[1])
+    ).one()
+    linkable = near_duplicates.same_values(text, source.content_text)
+    near_duplicates.NEAR_DUPLICATES.inc(kind="document_linked" if linkable else "document_flagged")
+    return NearDuplicate(best[1], source.report_id, source.embedding_model, best[0], linkable)
+
+def train_text_dictionary(samples: int = 20000) -> Optional[int]:
+    """Train the text_codec dictionary on randomly sampled chunk texts and compress with it from now on."""
+    texts: List[str] = []
+    names = shards.names()
+    for shard in names:
+        with shards.session(shard) as session:
+            sampled = select(DocumentChunk.id).order_by(func.random()).limit(max(1, samples // len(names)))
+            texts += session.exec(select(DocumentChunk.text).where(DocumentChunk.id.in_(sampled))).all()
+    if len(texts) < TEXT_DICT_MIN_SAMPLES:
+        return None
+    dict_id = text_codec.save_dictionary(TEXT_DICT_DIR, text_codec.train(texts))
+    text_codec.configure(TEXT_DICT_DIR, TEXT_ZSTD_LEVEL)  # re-read CURRENT now
+    return dict_id
+
+def recompress_text(batch: int = 500) -> int:
+    """Rewrite all stored document and chunk text with the current dictionary; returns rows rewritten."""
+    rewritten = 0
+    for shard in shards.names():
+        for model, column in ((Document, Document.content_text), (DocumentChunk, DocumentChunk.text)):
+            last_id = 0
+            while True:
+                with shards.session(shard) as session:
+                    rows = session.exec(
+                        select(model.id, column).where(model.id > last_id).order_by(model.id).limit(batch)
+                    ).all()
+                    if not rows:
+                        break
+                    session.execute(update(model), [
+                        {"id": row_id, column.key: value} for row_id, value in rows if value is not None
+                    ])
+                    session.commit()
+                rewritten += len(rows)
+                last_id = rows[-1][0]
+    return rewritten
+
+def near_duplicate_info(near: Optional[NearDuplicate]) -> Dict[str, Any]:
+    return {"near_duplicate_of": near.info()} if near else {}
+
+def save_near_duplicate_upload(session: Session, patient_id: int, doctor_uid: str, filename: str,
+                               blob: blob_store.StoredBlob, text: str, minhash: bytes,
+                               near: NearDuplicate) -> Dict[str, Any]:
+    """Store a rescan of an earlier document with that document's chunks instead of embedding again."""
+    report, doc = save_report_document(
+        session, patient_id, doctor_uid, filename, blob, text, [], [],
+        reuse_chunks_from=near.document_id, minhash=minhash, near_duplicate_of=near.document_id
+    )
+    return {
+        "status": "ok",
+        "report_id": report.report_id,
+        "document_id": doc.id,
+        "chunks": count_chunks(session, doc.id),
+        "deduplicated": True,
+        **near_duplicate_info(near)
+    }
+
+def index_minhash(session: Session, document_id: int, minhash: Optional[bytes]) -> None:
+    if minhash is not None:
+        session.execute(insert(DocumentMinHashBand), [
+            {"document_id": document_id, "bucket": bucket} for bucket in near_duplicates.band_buckets(minhash)
+        ])
+
+def copy_chunks(session: Session, document_id: int, source_id: int) -> None:
+    """Give `document_id` the chunk rows (texts and vectors) of `source_id`, in SQL."""
+    columns = ["document_id", "chunk_index", "text", "embedding_json", "embedding_model",
+               "embedding_q8", "embedding_scale"]
+    session.execute(insert(DocumentChunk).from_select(columns, select(
+        literal(document_id), DocumentChunk.chunk_index, DocumentChunk.text,
+        DocumentChunk.embedding_json, DocumentChunk.embedding_model,
+        DocumentChunk.embedding_q8, DocumentChunk.embedding_scale
+    ).where(DocumentChunk.document_id == source_id)))
+
+def save_extracted_vitals(session: Session, report: Report, doc: Document, text: str) -> int:
+    """Store the readings found in a patient's report as Vital rows of a new Visit for that report."""
+    if doc.patient_id is None:
+        return 0
+    rows = vitals_extraction.extract_vitals(text)
+    if not rows:
+        return 0
+    recorded_at = vitals_extraction.extract_report_date(text) or doc.created_at
+    visit = Visit(patient_id=doc.patient_id, doctor_uid=report.doctor_uid, visit_date=recorded_at,
+                  notes=f"Report {doc.report_id}")
+    session.add(visit)
+    session.flush()
+    report.visit_id = visit.id
+    for row in rows:
+        row.update(visit_id=visit.id, document_id=doc.id, recorded_at=recorded_at)
+    session.execute(insert(Vital), rows)
+    return len(rows)
+
+def structured_answer(session: Session, document_id: int, question: str) -> Optional[Dict[str, Any]]:
+    """Answer a plain vital/lab lookup from the document's extracted readings, without an LLM call."""
+    topic = vitals_extraction.match_question(question)
+    if topic is None:
+        return None
+    rows = session.exec(
+        select(Vital.name, Vital.value, Vital.unit)
+        .where(Vital.document_id == document_id, Vital.name.in_(vitals_extraction.row_names(topic)))
+        .order_by(Vital.id)
+    ).all()
+    answer = vitals_extraction.format_answer(topic, rows)
+    if answer is not None:
+        vitals_extraction.STRUCTURED_ANSWERS.inc(topic=topic)
+    return answer
+
+@STAGE_SECONDS.time(stage="db_write")
+def save_report_document(
+    session: Session,
+    patient_id: int,
+    doctor_uid: str,
+    filename: str,
+    blob: blob_store.StoredBlob,
+    text: str,
+    chunks: List[str],
+    embeddings: List[List[float]],
+    reuse_chunks_from: Optional[int] = None,
+    minhash: Optional[bytes] = None,
+    near_duplicate_of: Optional[int] = None,
+):
+    """Persist the Report, its Document and the embedded chunks in one transaction.
+
+    With `reuse_chunks_from`, the chunks and embeddings of that document are copied
+    in SQL instead of `chunks`/`embeddings`, and the new document is served from the
+    same embedding space as that one.
+    """
+    embedding_model = embedding_provider.key
+    if reuse_chunks_from is not None:
+        embedding_model = session.exec(
+            select(Document.embedding_model).where(Document.id == reuse_chunks_from)
+        ).first()
+    report_id = new_report_id()
+    doc_id = reserve_directory_entries(session, DocumentShard, report_id=report_id, blob=blob)
+    try:
+        report = Report(
+            report_id=report_id,
+            patient_id=patient_id,
+            doctor_uid=doctor_uid,
+            filename=filename,
+            file_path=blob.path
+        )
+        doc = Document(
+            id=doc_id,
+            uuid=str(uuid.uuid4()),
+            owner_uid=doctor_uid,
+            filename=filename,
+            content_text=text,
+            report_id=report_id,
+            patient_id=patient_id,
+            content_sha256=blob.digest,
+            embedding_model=embedding_model,
+            minhash=minhash,
+            near_duplicate_of=near_duplicate_of
+        )
+        session.add(report)
+        session.add(doc)
+        session.flush()
+        index_minhash(session, doc.id, minhash)
+        if reuse_chunks_from is not None:
+            copy_chunks(session, doc.id, reuse_chunks_from)
+        rows = chunk_rows(doc.id, chunks, embeddings)
+        if rows:
+            session.execute(insert(DocumentChunk), rows)
+        save_extracted_vitals(session, report, doc, text)
+        session.commit()
+    except Exception:
+        session.rollback()
+        forget_directory_entries(session, DocumentShard, doc_id, report_id=report_id, digest=blob.digest)
+        raise
+    session.refresh(report)
+    session.refresh(doc)
+    publish_vectors(doc.id, embeddings, link_from=reuse_chunks_from, provider=provider_for(embedding_model))
+    return report, doc
+
+def delete_report(session: Session, report: Report) -> Optional[Document]:
+    """Delete a report with its document, chunks, extracted visit and vitals, and drop its
+    reference to the uploaded blob (sweep_blobs() removes the file after the last one).
+    Returns the document."""
+    doc = session.exec(select(Document).where(Document.report_id == report.report_id)).first()
+    if doc is not None:
+        session.execute(delete(DocumentChunk).where(DocumentChunk.document_id == doc.id))
+        session.execute(delete(DocumentMinHashBand).where(DocumentMinHashBand.document_id == doc.id))
+        session.execute(delete(Vital).where(Vital.document_id == doc.id))
+        session.delete(doc)
+    if report.visit_id is not None:
+        session.execute(delete(Visit).where(Visit.id == report.visit_id))
+    session.delete(report)
+    digest = doc.content_sha256 if doc is not None else None
+    if digest is not None and not shards.sharded:
+        release_blob(session, digest)
+    session.commit()
+    forget_directory_entries(session, DocumentShard, doc.id if doc is not None else None,
+                             report_id=report.report_id, digest=digest)
+    return doc
+
+# Process pool for CPU-bound extraction (PyPDF2, tesseract) and a global cap on
+# files being processed at once across all batch requests. Workers are spawned, not
+# forked from this process and its database and executor threads, and run extraction.py.
+_extract_pool: Optional[ProcessPoolExecutor] = None
+ingest_semaphore = asyncio.Semaphore(INGEST_WORKERS)
+
+def get_extract_pool() -> ProcessPoolExecutor:
+    global _extract_pool
+    if _extract_pool is None:
+        _extract_pool = ProcessPoolExecutor(max_workers=INGEST_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _extract_pool
+
+async def ingest_stored_file(patient_id: int, doctor_uid: str, filename: str,
+                             blob: blob_store.StoredBlob, content_type: Optional[str],
+                             shard: Optional[str] = None) -> Dict[str, Any]:
+    """Extract, chunk, embed and store one file already written to the blob store (in the patient's shard)."""
+    loop = asyncio.get_running_loop()
+    async with ingest_semaphore:
+        try:
+            async with db_session(shard) as session:
+                duplicate = await session.run_sync(save_duplicate_upload, patient_id, doctor_uid, filename, blob)
+            if duplicate:
+                return {"filename": filename, **duplicate}
+
+            with STAGE_SECONDS.time(stage="extract"):
+                text, metrics = await loop.run_in_executor(
+                    get_extract_pool(), extraction.extract_stored, blob.path, content_type, ocr_settings()
+                )
+            replay(metrics)  # the worker's stage timings, fallbacks and OCR cache lookups
+            if not text or not text.strip():
+                return {"filename": filename, "status": "error", "detail": "Could not extract text from document."}
+            minhash = near_duplicates.signature(text)
+            async with db_session(shard) as session:
+                near = await session.run_sync(find_near_duplicate, minhash, text, patient_id=patient_id)
+                if near and near.linkable:
+                    return {"filename": filename, **await session.run_sync(
+                        save_near_duplicate_upload, patient_id, doctor_uid, filename, blob, text, minhash, near
+                    )}
+            chunks = chunk_text(text)
+            embeddings = await asyncio.to_thread(create_embeddings, chunks)
+            async with db_session(shard) as session:
+                report, doc = await session.run_sync(
+                    save_report_document, patient_id, doctor_uid, filename, blob, text, chunks, embeddings,
+                    minhash=minhash, near_duplicate_of=near.document_id if near else None
+                )
+            return {
+                "filename": filename,
+                "status": "ok",
+                "report_id": report.report_id,
+                "document_id": doc.id,
+                "chunks": len(chunks),
+                **near_duplicate_info(near)
+            }
+        except Exception as e:
+            logger.exception(f"Batch ingestion failed for {filename}")
+            FALLBACKS.inc(kind="batch_file_failed")
+            return {"filename": filename, "status": "error", "detail": str(e)}
+
+def is_zip_upload(file: UploadFile) -> bool:
+    return file.content_type in ("application/zip", "application/x-zip-compressed") or \
+        (file.filename or "").lower().endswith(".zip")
+
+class BoundedReader:
+    """File-like view of `src` that fails once more than `limit` bytes come out of it."""
+
+    def __init__(self, src, limit: int, name: str):
+        self.src = src
+        self.left = limit
+        self.name = name
+
+    def read(self, size: int = -1) -> bytes:
+        # read one byte past the limit, so an entry larger than it declares is caught
+        block = self.src.read(self.left + 1 if size < 0 else min(size, self.left + 1))
+        self.left -= len(block)
+        if self.left < 0:
+            raise HTTPException(status_code=400, detail=f"{self.name} is larger than its archive entry declares")
+        return block
+
+def archive_entries(archive: zipfile.ZipFile) -> List[zipfile.ZipInfo]:
+    """Report files of an archive, after checking their declared total size against MAX_BATCH_BYTES."""
+    entries = [
+        info for info in archive.infolist()
+        if not info.is_dir() and os.path.basename(info.filename) and not info.filename.startswith("__MACOSX/")
+    ]
+    if sum(info.file_size for info in entries) > MAX_BATCH_BYTES:
+        raise HTTPException(status_code=400, detail=f"Archive expands to more than {MAX_BATCH_BYTES} bytes")
+    return entries
+
+def store_batch_uploads(files: List[UploadFile]) -> List[tuple]:
+    """Store uploads (expanding ZIP archives); returns (filename, StoredBlob, content_type).
+
+    Archive entries are read no further than the size they declare, which archive_entries()
+    checked against MAX_BATCH_BYTES: a ZIP bomb cannot fill the disk.
+    """
+    stored = []
+    for file in files:
+        if is_zip_upload(file):
+            with zipfile.ZipFile(file.file) as archive:
+                for info in archive_entries(archive):
+                    name = os.path.basename(info.filename)
+                    if len(stored) >= MAX_BATCH_FILES:
+                        raise HTTPException(status_code=400, detail=f"Batch exceeds {MAX_BATCH_FILES} files")
+                    content_type = mimetypes.guess_type(name)[0]
+                    with archive.open(info) as src:
+                        blob = store_upload(BoundedReader(src, info.file_size, name), name, content_type)
+                    stored.append((name, blob, content_type))
+        else:
+            if len(stored) >= MAX_BATCH_FILES:
+                raise HTTPException(status_code=400, detail=f"Batch exceeds {MAX_BATCH_FILES} files")
+            content_type = file.content_type or mimetypes.guess_type(file.filename)[0]
+            blob = store_upload(file.file, file.filename, content_type)
+            stored.append((file.filename, blob, content_type))
+    return stored
 
 # ---------------- Prompts ----------------
 SYSTEM_PROMPT_ANALYSIS = """
@@ -252,7 +1256,24 @@ Answer only from provided text; if not found respond: "I cannot determine from t
 """
 
 # ---------------- FastAPI App ----------------
-app = FastAPI(title="SmartEMR AI Backend")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Deferred initialization: Firebase, DB schema, and optional background warm-up."""
+    if not OPENAI_API_KEY:
+        logger.warning("OPENAI_API_KEY is not set; LLM calls and OpenAI embeddings will use fallbacks")
+    init_firebase()
+    await async_db.run(ensure_db)
+    if STARTUP_WARMUP:
+        threading.Thread(target=warm_up, name="smartemr-warmup", daemon=True).start()
+    sweeper = asyncio.create_task(sweep_blobs_periodically()) if BLOB_SWEEP_INTERVAL_S > 0 else None
+    yield
+    if sweeper is not None:
+        sweeper.cancel()
+    if _extract_pool is not None:
+        _extract_pool.shutdown(wait=False, cancel_futures=True)
+    async_db.shutdown()
+
+app = FastAPI(title="SmartEMR AI Backend", lifespan=lifespan)
 
 # CORS middleware
 app.add_middleware(
@@ -262,6 +1283,16 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+instrument_app(app)
+install_profiler(app)
+
+@app.exception_handler(admission.AdmissionRejected)
+async def llm_admission_rejected(request: Request, exc: admission.AdmissionRejected):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": f"Too many AI requests in progress ({exc.reason}); retry later"},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
 
 # ---------------- Request/Response Models ----------------
 class RegisterRequest(BaseModel):
@@ -275,12 +1306,12 @@ class PatientCreateRequest(BaseModel):
 
 class AnalyzeRequest(BaseModel):
     document_id: int
-    top_k: int = 6
+    top_k: conint(ge=1, le=MAX_TOP_K) = 6
 
 class QARequest(BaseModel):
     document_id: int
     question: str
-    top_k: int = 6
+    top_k: conint(ge=1, le=MAX_TOP_K) = 6
 
 # ---------------- Routes ----------------
 
@@ -293,7 +1324,7 @@ def health():
 async def register_user(
     request: RegisterRequest, 
     decoded = Depends(verify_token), 
-    session: Session = Depends(get_session)
+    session: async_db.AsyncSession = Depends(get_session)
 ):
     uid = decoded.get("uid")
     email = decoded.get("email")
@@ -303,22 +1334,22 @@ async def register_user(
     if request.role not in ("doctor", "patient"):
         raise HTTPException(status_code=400, detail="role must be 'doctor' or 'patient'")
     
-    existing = session.exec(select(User).where(User.uid == uid)).first()
+    existing = (await session.exec(select(User).where(User.uid == uid))).first()
     if existing:
         return {"status": "ok", "message": "already registered", "user": existing}
     
     user = User(uid=uid, email=email, name=request.name, role=request.role)
     session.add(user)
-    session.commit()
+    await session.commit()
     return {"status": "ok", "uid": uid, "user": user}
 
 @app.get("/auth/me")
 async def get_current_user(
     decoded = Depends(verify_token), 
-    session: Session = Depends(get_session)
+    session: async_db.AsyncSession = Depends(get_session)
 ):
     uid = decoded.get("uid")
-    user = session.exec(select(User).where(User.uid == uid)).first()
+    user = (await session.exec(select(User).where(User.uid == uid))).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not registered")
     return user
@@ -328,38 +1359,47 @@ async def get_current_user(
 async def create_patient(
     request: PatientCreateRequest,
     decoded = Depends(verify_token), 
-    session: Session = Depends(get_session)
+    session: async_db.AsyncSession = Depends(get_session)
 ):
     uid = decoded.get("uid")
-    user = session.exec(select(User).where(User.uid == uid)).first()
+    user = (await session.exec(select(User).where(User.uid == uid))).first()
     if not user or user.role != "doctor":
         raise HTTPException(status_code=403, detail="Only doctors can create patients")
     
     if not request.name or len(request.name.strip()) == 0:
         raise HTTPException(status_code=400, detail="Name required")
     
+    use_doctor_shard(session, uid)
+    patient_id = await session.run_sync(reserve_directory_entries, PatientShard)
     patient = Patient(
+        id=patient_id,
         name=request.name, 
         dob=request.dob, 
         gender=request.gender, 
         owner_doctor_uid=uid
     )
     session.add(patient)
-    session.commit()
-    session.refresh(patient)
+    try:
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        await session.run_sync(forget_directory_entries, PatientShard, patient_id)
+        raise
+    await session.refresh(patient)
     return {"patient_id": patient.id, "name": patient.name}
 
 @app.get("/doctor/patients")
 async def get_doctor_patients(
     decoded = Depends(verify_token), 
-    session: Session = Depends(get_session)
+    session: async_db.AsyncSession = Depends(get_session)
 ):
     uid = decoded.get("uid")
-    user = session.exec(select(User).where(User.uid == uid)).first()
+    user = (await session.exec(select(User).where(User.uid == uid))).first()
     if not user or user.role != "doctor":
         raise HTTPException(status_code=403, detail="Only doctors can view patients")
     
-    patients = session.exec(select(Patient).where(Patient.owner_doctor_uid == uid)).all()
+    use_doctor_shard(session, uid)
+    patients = (await session.exec(select(Patient).where(Patient.owner_doctor_uid == uid))).all()
     return {"patients": patients}
 
 @app.post("/doctor/patients/{patient_id}/upload_report")
@@ -367,108 +1407,154 @@ async def upload_report(
     patient_id: int,
     file: UploadFile = File(...),
     decoded = Depends(verify_token), 
-    session: Session = Depends(get_session)
+    session: async_db.AsyncSession = Depends(get_session)
 ):
     uid = decoded.get("uid")
-    user = session.exec(select(User).where(User.uid == uid)).first()
+    user = (await session.exec(select(User).where(User.uid == uid))).first()
     if not user or user.role != "doctor":
         raise HTTPException(status_code=403, detail="Only doctors can upload reports")
     
     # Check patient exists and belongs to this doctor
-    patient = session.exec(select(Patient).where(Patient.id == patient_id)).first()
+    patient = None
+    if await session.run_sync(use_shard_of, "patient", patient_id):
+        patient = (await session.exec(select(Patient).where(Patient.id == patient_id))).first()
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
     if patient.owner_doctor_uid != uid:
         raise HTTPException(status_code=403, detail="Not authorized for this patient")
 
     # Save file
-    os.makedirs(UPLOAD_DIR, exist_ok=True)
-    safe_name = f"{uuid.uuid4().hex}_{file.filename}"
-    file_path = os.path.join(UPLOAD_DIR, safe_name)
-    
-    content = await file.read()
-    with open(file_path, "wb") as f:
-        f.write(content)
-
-    # Generate report ID
-    report_id = "REP-" + datetime.datetime.utcnow().strftime("%Y%m%d") + "-" + uuid.uuid4().hex[:6].upper()
+    blob = await asyncio.to_thread(store_upload, file.file, file.filename, file.content_type)
 
-    # Store Report record
-    report = Report(
-        report_id=report_id, 
-        patient_id=patient_id, 
-        doctor_uid=uid, 
-        filename=file.filename, 
-        file_path=file_path
-    )
-    session.add(report)
-    session.commit()
-    session.refresh(report)
+    # Identical bytes were already processed: reuse their text and chunks
+    duplicate = await session.run_sync(save_duplicate_upload, patient_id, uid, file.filename, blob)
+    if duplicate:
+        return duplicate
+    await session.close()  # no connection held while extracting
 
     # Process document for AI analysis
     try:
-        # Create a new UploadFile-like object for text extraction
-        file.file = io.BytesIO(content)
-        text = extract_text_from_upload(file)
+        file.file.seek(0)
+        text = await asyncio.to_thread(extract_text_from_upload, file)
+        minhash = near_duplicates.signature(text)
     except Exception as e:
+        FALLBACKS.inc(kind="text_extraction_failed")
         text = f"Text extraction failed: {str(e)}"
+        minhash = None  # error messages must not match each other
 
-    # Create document entry
-    doc = Document(
-        uuid=str(uuid.uuid4()), 
-        owner_uid=uid, 
-        filename=file.filename, 
-        content_text=text, 
-        report_id=report_id,
-        patient_id=patient_id
-    )
-    session.add(doc)
-    session.commit()
-    session.refresh(doc)
+    # A rescan of an earlier report of this patient reuses its chunks; a merely similar one is flagged
+    near = await session.run_sync(find_near_duplicate, minhash, text, patient_id=patient_id)
+    if near and near.linkable:
+        return await session.run_sync(
+            save_near_duplicate_upload, patient_id, uid, file.filename, blob, text, minhash, near
+        )
+    await session.close()
 
-    # Create chunks & embeddings
+    # Create chunks & embeddings, then store Report, Document and chunks
     chunks = chunk_text(text)
-    if chunks:
-        embeddings = create_embeddings(chunks)
-        for idx, (ch_text, emb) in enumerate(zip(chunks, embeddings)):
-            chunk = DocumentChunk(
-                document_id=doc.id, 
-                chunk_index=idx, 
-                text=ch_text, 
-                embedding_json=json.dumps(emb)
-            )
-            session.add(chunk)
-        session.commit()
+    embeddings = await asyncio.to_thread(create_embeddings, chunks)
+    report, doc = await session.run_sync(
+        save_report_document, patient_id, uid, file.filename, blob, text, chunks, embeddings,
+        minhash=minhash, near_duplicate_of=near.document_id if near else None
+    )
 
     return {
         "status": "ok", 
-        "report_id": report_id, 
+        "report_id": report.report_id, 
         "document_id": doc.id,
-        "chunks": len(chunks)
+        "chunks": len(chunks),
+        **near_duplicate_info(near)
     }
 
+@app.post("/doctor/patients/{patient_id}/upload_reports")
+async def upload_reports_batch(
+    patient_id: int,
+    files: List[UploadFile] = File(...),
+    decoded = Depends(verify_token),
+    session: async_db.AsyncSession = Depends(get_session)
+):
+    """Upload many reports (individual files and/or ZIP archives) for one patient."""
+    uid = decoded.get("uid")
+    user = (await session.exec(select(User).where(User.uid == uid))).first()
+    if not user or user.role != "doctor":
+        raise HTTPException(status_code=403, detail="Only doctors can upload reports")
+
+    patient = None
+    if await session.run_sync(use_shard_of, "patient", patient_id):
+        patient = (await session.exec(select(Patient).where(Patient.id == patient_id))).first()
+    if not patient:
+        raise HTTPException(status_code=404, detail="Patient not found")
+    if patient.owner_doctor_uid != uid:
+        raise HTTPException(status_code=403, detail="Not authorized for this patient")
+
+    await session.close()
+    try:
+        stored = await asyncio.to_thread(store_batch_uploads, files)
+    except zipfile.BadZipFile:
+        raise HTTPException(status_code=400, detail="Invalid ZIP archive")
+
+    results = await asyncio.gather(*(
+        ingest_stored_file(patient_id, uid, name, blob, content_type, session.shard)
+        for name, blob, content_type in stored
+    ))
+    return {
+        "status": "ok",
+        "patient_id": patient_id,
+        "total": len(results),
+        "succeeded": sum(1 for r in results if r["status"] == "ok"),
+        "results": results
+    }
+
+@app.delete("/doctor/reports/{report_id}")
+async def delete_report_route(
+    report_id: str,
+    decoded = Depends(verify_token),
+    session: async_db.AsyncSession = Depends(get_session)
+):
+    uid = decoded.get("uid")
+    user = (await session.exec(select(User).where(User.uid == uid))).first()
+    if not user or user.role != "doctor":
+        raise HTTPException(status_code=403, detail="Only doctors can delete reports")
+
+    report = None
+    if await session.run_sync(use_shard_of, "report", report_id):
+        report = (await session.exec(select(Report).where(Report.report_id == report_id))).first()
+    if not report:
+        raise HTTPException(status_code=404, detail="Report not found")
+    if report.doctor_uid != uid:
+        raise HTTPException(status_code=403, detail="Not authorized for this report")
+
+    doc = await session.run_sync(delete_report, report)
+    if doc is not None:
+        await asyncio.to_thread(unpublish_vectors, doc.id, provider_for(doc.embedding_model))
+    return {"status": "ok", "report_id": report_id, "document_id": doc.id if doc else None}
+
 # Patient routes
 @app.get("/patient/reports/search/{report_id}")
 async def search_report(
     report_id: str,
     decoded = Depends(verify_token), 
-    session: Session = Depends(get_session)
+    session: async_db.AsyncSession = Depends(get_session)
 ):
     uid = decoded.get("uid")
-    user = session.exec(select(User).where(User.uid == uid)).first()
+    user = (await session.exec(select(User).where(User.uid == uid))).first()
     if not user:
         raise HTTPException(status_code=401, detail="User not registered")
     
-    report = session.exec(select(Report).where(Report.report_id == report_id)).first()
+    report = None
+    if await session.run_sync(use_shard_of, "report", report_id):
+        report = (await session.exec(select(Report).where(Report.report_id == report_id))).first()
     if not report:
         raise HTTPException(status_code=404, detail="Report not found")
     
     # Get document content preview
-    doc = session.exec(select(Document).where(Document.report_id == report_id)).first()
+    doc = (await session.exec(
+        select(Document.id, Document.content_text).where(Document.report_id == report_id)
+    )).first()
     preview = doc.content_text[:500] if doc and doc.content_text else ""
     
     # Get patient info
-    patient = session.exec(select(Patient).where(Patient.id == report.patient_id)).first()
+    patient = (await session.exec(select(Patient).where(Patient.id == report.patient_id))).first()
     
     return {
         "report_id": report.report_id,
@@ -481,143 +1567,547 @@ async def search_report(
         "document_id": doc.id if doc else None
     }
 
+# Vitals routes
+@app.post("/patients/{patient_id}/vitals/bulk")
+async def bulk_ingest_vitals(
+    patient_id: int,
+    request: Request,
+    visit_id: Optional[int] = None,
+    decoded = Depends(verify_token),
+    session: async_db.AsyncSession = Depends(get_session)
+):
+    """Insert many readings at once from NDJSON lines or columnar JSON arrays."""
+    patient = await session.run_sync(get_accessible_patient, decoded.get("uid"), patient_id)
+
+    try:
+        rows = parse_vitals_payload(await request.body(), request.headers.get("content-type", ""))
+    except (ValueError, TypeError, AttributeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid vitals payload: {e}")
+    if not rows:
+        raise HTTPException(status_code=400, detail="No readings provided")
+
+    if visit_id is None:
+        visit = Visit(patient_id=patient_id, doctor_uid=patient.owner_doctor_uid, notes="Bulk vitals import")
+        session.add(visit)
+        await session.flush()  # commits with its readings: a failed import leaves no empty visit
+        visit_id = visit.id
+    else:
+        visit = await session.get(Visit, visit_id)
+        if not visit or visit.patient_id != patient_id:
+            raise HTTPException(status_code=404, detail="Visit not found")
+
+    for row in rows:
+        row["visit_id"] = visit_id
+    try:
+        for i in range(0, len(rows), VITALS_BATCH_SIZE):
+            await session.execute(insert(Vital), rows[i:i + VITALS_BATCH_SIZE])
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+
+    return {"status": "ok", "visit_id": visit_id, "inserted": len(rows)}
+
+@app.get("/patients/{patient_id}/vitals")
+async def query_vitals(
+    patient_id: int,
+    name: str,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    buckets: int = 200,
+    decoded = Depends(verify_token),
+    session: async_db.AsyncSession = Depends(get_session)
+):
+    """Return one vital for a patient over a time range, downsampled to `buckets`."""
+    await session.run_sync(get_accessible_patient, decoded.get("uid"), patient_id)
+    if buckets < 1 or buckets > MAX_VITAL_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"buckets must be between 1 and {MAX_VITAL_BUCKETS}")
+    try:
+        start_ts = parse_timestamp(start) if start else None
+        end_ts = parse_timestamp(end) if end else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid timestamp: {e}")
+
+    stmt = (
+        select(Vital.recorded_at, Vital.value, Vital.unit)
+        .join(Visit, Visit.id == Vital.visit_id)
+        .where(Visit.patient_id == patient_id, Vital.name == name)
+    )
+    if start_ts:
+        stmt = stmt.where(Vital.recorded_at >= start_ts)
+    if end_ts:
+        stmt = stmt.where(Vital.recorded_at <= end_ts)
+    rows = (await session.exec(stmt.order_by(Vital.recorded_at))).all()
+
+    import numpy as np
+    times = np.array([r[0] for r in rows], dtype="datetime64[us]")
+    values = np.array([r[1] for r in rows], dtype=np.float64)
+    return {
+        "patient_id": patient_id,
+        "name": name,
+        "unit": rows[-1][2] if rows else None,
+        "count": len(rows),
+        "buckets": downsample_series(times, values, buckets, start_ts, end_ts),
+    }
+
+# Patient timeline
+TIMELINE_FIELDS = {
+    "visit": {"doctor_uid": Visit.doctor_uid, "notes": Visit.notes},
+    "vital": {"name": Vital.name, "value": Vital.value, "unit": Vital.unit,
+              "recorded_at": Vital.recorded_at, "document_id": Vital.document_id},
+    "report": {"report_id": Report.report_id, "filename": Report.filename, "doctor_uid": Report.doctor_uid,
+               "document_id": Document.id},
+}
+TIMELINE_RANK = {"visit": 0, "report": 1}  # order of items with the same date
+
+def parse_timeline_fields(fields: Optional[str]) -> Dict[str, List[str]]:
+    """Map "visit.notes,vital.value,..." to the columns to select per kind; all of them by default.
+
+    Vitals or reports are not queried at all when none of their fields is requested.
+    """
+    if not fields:
+        return {kind: list(columns) for kind, columns in TIMELINE_FIELDS.items()}
+    selected: Dict[str, List[str]] = {kind: [] for kind in TIMELINE_FIELDS}
+    for name in fields.split(","):
+        kind, _, column = name.strip().partition(".")
+        if column not in TIMELINE_FIELDS.get(kind, {}):
+            raise ValueError(f"unknown field {name.strip()!r}")
+        if column not in selected[kind]:
+            selected[kind].append(column)
+    return selected
+
+def format_timeline_cursor(item: Dict[str, Any]) -> str:
+    return f"{item['date'].isoformat()}|{item['type']}|{item['id']}"
+
+def parse_timeline_cursor(cursor: str) -> Tuple[datetime.datetime, int, int]:
+    date, kind, item_id = cursor.split("|")
+    return datetime.datetime.fromisoformat(date), TIMELINE_RANK[kind], int(item_id)
+
+def timeline_after(date_column, id_column, kind: str, cursor: Optional[Tuple[datetime.datetime, int, int]]):
+    """Rows that come after the cursor in (date desc, kind, id desc) order."""
+    if cursor is None:
+        return true()
+    date, rank, item_id = cursor
+    if TIMELINE_RANK[kind] == rank:
+        tie = id_column < item_id
+    else:
+        tie = literal(TIMELINE_RANK[kind] > rank)
+    return or_(date_column < date, and_(date_column == date, tie))
+
+def timeline_items(session: Session, patient_id: int, start: Optional[datetime.datetime],
+                   end: Optional[datetime.datetime], limit: int, cursor, fields: Dict[str, List[str]],
+                   vitals_limit: int) -> Tuple[List[Dict[str, Any]], bool]:
+    """One page of visits (with vitals and reports) and reports not recorded as a visit.
+
+    At most four queries whatever the history length: the visits page, the page of
+    reports not recorded as a visit, the vitals of the page's visits and their reports.
+    """
+    def in_range(column):
+        conditions = [column.is_not(None)]
+        if start:
+            conditions.append(column >= start)
+        if end:
+            conditions.append(column <= end)
+        return and_(*conditions)
+
+    def report_columns():
+        return [TIMELINE_FIELDS["report"][c].label(c) for c in fields["report"]]
+
+    visit_rows = session.execute(
+        select(Visit.id, Visit.visit_date.label("date"),
+               *[TIMELINE_FIELDS["visit"][c].label(c) for c in fields["visit"]])
+        .where(Visit.patient_id == patient_id, in_range(Visit.visit_date),
+               timeline_after(Visit.visit_date, Visit.id, "visit", cursor))
+        .order_by(Visit.visit_date.desc(), Visit.id.desc()).limit(limit + 1)
+    ).mappings().all()
+    items = [{"type": "visit", **row} for row in visit_rows]
+
+    if fields["report"]:
+        report_rows = session.execute(
+            select(Report.id, Report.created_at.label("date"), *report_columns())
+            .outerjoin(Document, Document.report_id == Report.report_id)
+            .where(Report.patient_id == patient_id, Report.visit_id.is_(None), in_range(Report.created_at),
+                   timeline_after(Report.created_at, Report.id, "report", cursor))
+            .order_by(Report.created_at.desc(), Report.id.desc()).limit(limit + 1)
+        ).mappings().all()
+        items += [{"type": "report", **row} for row in report_rows]
+
+    items.sort(key=lambda item: (-item["date"].timestamp(), TIMELINE_RANK[item["type"]], -item["id"]))
+    has_more = len(items) > limit
+    items = items[:limit]
+    visits = {item["id"]: item for item in items if item["type"] == "visit"}
+
+    if visits and fields["vital"]:
+        order = func.row_number().over(partition_by=Vital.visit_id, order_by=(Vital.recorded_at.desc(), Vital.id.desc()))
+        ranked = select(
+            Vital.visit_id, *[TIMELINE_FIELDS["vital"][c].label(c) for c in fields["vital"]],
+            order.label("rn"), func.count().over(partition_by=Vital.visit_id).label("total")
+        ).where(Vital.visit_id.in_(list(visits))).subquery()
+        for visit in visits.values():
+            visit["vitals"], visit["vital_count"] = [], 0
+        for row in session.execute(
+            select(ranked).where(ranked.c.rn <= vitals_limit).order_by(ranked.c.visit_id, ranked.c.rn)
+        ).mappings():
+            visit = visits[row["visit_id"]]
+            visit["vital_count"] = row["total"]
+            visit["vitals"].append({c: row[c] for c in fields["vital"]})
+
+    if visits and fields["report"]:
+        for visit in visits.values():
+            visit["reports"] = []
+        for row in session.execute(
+            select(Report.id, Report.created_at.label("date"), Report.visit_id, *report_columns())
+            .outerjoin(Document, Document.report_id == Report.report_id)
+            .where(Report.patient_id == patient_id, Report.visit_id.in_(list(visits)))
+            .order_by(Report.id)
+        ).mappings():
+            report = dict(row)
+            visits[report.pop("visit_id")]["reports"].append(report)
+    return items, has_more
+
+@app.get("/patients/{patient_id}/timeline")
+async def patient_timeline(
+    patient_id: int,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    vitals_limit: int = 100,
+    decoded = Depends(verify_token),
+    session: async_db.AsyncSession = Depends(get_session)
+):
+    """Visits with their vitals and reports, newest first, in one request.
+
+    `fields` projects the response, e.g. "visit.notes,vital.name,vital.value"; pass the
+    returned `next_cursor` as `cursor` for the next page.
+    """
+    await session.run_sync(get_accessible_patient, decoded.get("uid"), patient_id)
+    if limit < 1 or limit > MAX_TIMELINE_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_TIMELINE_LIMIT}")
+    if vitals_limit < 1 or vitals_limit > MAX_TIMELINE_VITALS:
+        raise HTTPException(status_code=400, detail=f"vitals_limit must be between 1 and {MAX_TIMELINE_VITALS}")
+    try:
+        start_ts = parse_timestamp(start) if start else None
+        end_ts = parse_timestamp(end) if end else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid timestamp: {e}")
+    try:
+        selected = parse_timeline_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        position = parse_timeline_cursor(cursor) if cursor else None
+    except (ValueError, KeyError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    items, has_more = await session.run_sync(
+        timeline_items, patient_id, start_ts, end_ts, limit, position, selected, vitals_limit
+    )
+    payload = {
+        "patient_id": patient_id,
+        "items": items,
+        "next_cursor": format_timeline_cursor(items[-1]) if has_more else None,
+    }
+    # plain rows: json.dumps is several times faster than FastAPI's jsonable_encoder here
+    return Response(content=json.dumps(payload, default=ndjson_export.json_default), media_type="application/json")
+
+# Record export
+def export_query(section: str, patient_id: int):
+    """Keyset columns and select() of one export section for a patient (no embeddings or file paths).
+
+    Vitals are keyed by (visit id, vital id) so that each page is read from the visit
+    and vital visit_id indexes in order, instead of sorting all of the patient's vitals.
+    """
+    if section == "report":
+        return (Report.id,), select(
+            Report.id, Report.report_id, Report.doctor_uid, Report.filename, Report.created_at
+        ).where(Report.patient_id == patient_id)
+    if section == "document":
+        return (Document.id,), select(
+            Document.id, Document.uuid, Document.report_id, Document.filename, Document.content_sha256,
+            Document.created_at, Document.content_text
+        ).where(Document.patient_id == patient_id)
+    if section == "visit":
+        return (Visit.id,), select(
+            Visit.id, Visit.doctor_uid, Visit.visit_date, Visit.notes
+        ).where(Visit.patient_id == patient_id)
+    return (Visit.id, Vital.id), select(
+        Vital.id, Vital.visit_id, Vital.document_id, Vital.name, Vital.value, Vital.unit, Vital.recorded_at
+    ).join(Visit, Visit.id == Vital.visit_id).where(Visit.patient_id == patient_id)
+
+def export_resume_key(session: Session, section: str, after: int) -> Optional[Tuple[int, ...]]:
+    """Keyset position of the row a cursor names; None if that row no longer exists."""
+    if section != "vital" or after == 0:
+        return (after,)
+    visit_id = session.exec(select(Vital.visit_id).where(Vital.id == after)).first()
+    return None if visit_id is None else (visit_id, after)
+
+def export_pages(patient_id: int, header: Optional[Dict[str, Any]], section_index: int, after: Tuple[int, ...],
+                 shard: Optional[str] = None):
+    """Yield pages of encoded NDJSON lines, resuming after keyset position `after` in EXPORT_SECTIONS[section_index].
+
+    Each page is read with keyset pagination in its own short session, so memory stays
+    bounded by EXPORT_PAGE_ROWS and no read lock is held while the client downloads.
+    """
+    if header is not None:
+        yield [ndjson_export.line("patient", header)]
+    counts = {}
+    for section in EXPORT_SECTIONS[section_index:]:
+        key_columns, stmt = export_query(section, patient_id)
+        count = 0
+        while True:
+            if len(key_columns) == 1:
+                past = key_columns[0] > after[-1]
+            else:
+                past = tuple_(*key_columns) > tuple_(*after)
+            with shards.session(shard) as session:
+                rows = session.execute(
+                    stmt.where(past).order_by(*key_columns).limit(EXPORT_PAGE_ROWS)
+                ).mappings().all()
+            if rows:
+                yield [ndjson_export.line(section, dict(r), ndjson_export.format_cursor(section, r["id"])) for r in rows]
+                count += len(rows)
+                last = rows[-1]
+                after = (last["visit_id"], last["id"]) if section == "vital" else (last["id"],)
+            if len(rows) < EXPORT_PAGE_ROWS:
+                break
+        ndjson_export.EXPORTED_ROWS.inc(count, type=section)
+        counts[section] = count
+        after = (0, 0)
+    yield [ndjson_export.line("end", {"counts": counts})]
+
+@app.get("/patients/{patient_id}/export")
+async def export_patient_record(
+    patient_id: int,
+    cursor: Optional[str] = None,
+    compress: bool = False,
+    decoded = Depends(verify_token),
+    session: async_db.AsyncSession = Depends(get_session)
+):
+    """Stream the patient's reports, document texts, visits and vitals as NDJSON (see ndjson_export.py)."""
+    patient = await session.run_sync(get_accessible_patient, decoded.get("uid"), patient_id)
+    try:
+        section_index, after = ndjson_export.parse_cursor(cursor, EXPORT_SECTIONS)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    resume_key = await session.run_sync(export_resume_key, EXPORT_SECTIONS[section_index], after)
+    if resume_key is None:
+        raise HTTPException(status_code=400, detail="The row this cursor points at no longer exists")
+    header = None if cursor else {
+        "id": patient.id, "name": patient.name, "dob": patient.dob, "gender": patient.gender,
+        "owner_doctor_uid": patient.owner_doctor_uid, "created_at": patient.created_at,
+        "exported_at": datetime.datetime.utcnow(),
+    }
+
+    filename = f"patient-{patient_id}.ndjson" + (".gz" if compress else "")
+    return StreamingResponse(
+        ndjson_export.encode_pages(export_pages(patient_id, header, section_index, resume_key, session.shard), compress),
+        media_type="application/gzip" if compress else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
 # Document AI routes
 @app.post("/documents/upload")
 async def upload_document(
     file: UploadFile = File(...), 
     decoded = Depends(verify_token),
-    session: Session = Depends(get_session)
+    session: async_db.AsyncSession = Depends(get_session)
 ):
     allowed = ["application/pdf", "image/png", "image/jpeg", "text/plain"]
     if file.content_type not in allowed:
         raise HTTPException(status_code=400, detail=f"Unsupported file type: {file.content_type}")
 
     try:
-        text = extract_text_from_upload(file)
+        text = await asyncio.to_thread(extract_text_from_upload, file)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
     doc_uuid = str(uuid.uuid4())
     report_id = "REP-" + datetime.datetime.utcnow().strftime("%Y%m%d") + "-" + uuid.uuid4().hex[:6].upper()
+    minhash = near_duplicates.signature(text)
+    use_doctor_shard(session, decoded.get("uid"))
+    near = await session.run_sync(find_near_duplicate, minhash, text, owner_uid=decoded.get("uid"))
+    linked = near is not None and near.linkable
 
+    doc_id = await session.run_sync(reserve_directory_entries, DocumentShard, report_id=report_id)
     doc = Document(
+        id=doc_id,
         uuid=doc_uuid,
         owner_uid=decoded.get("uid"),
         filename=file.filename,
         content_text=text,
-        report_id=report_id
+        report_id=report_id,
+        embedding_model=near.embedding_model if linked else embedding_provider.key,
+        minhash=minhash,
+        near_duplicate_of=near.document_id if near else None
     )
     session.add(doc)
-    session.commit()
-    session.refresh(doc)
+    try:
+        await session.flush()
+        await session.run_sync(index_minhash, doc.id, minhash)
+        if linked:
+            # the copy commits with the document: a linked upload never exists without its chunks
+            await session.run_sync(copy_chunks, doc.id, near.document_id)
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        await session.run_sync(forget_directory_entries, DocumentShard, doc_id, report_id=report_id)
+        raise
+    await session.refresh(doc)
+
+    if linked:
+        await asyncio.to_thread(
+            publish_vectors, doc.id, link_from=near.document_id, provider=provider_for(near.embedding_model)
+        )
+        return {
+            "document_id": doc.id,
+            "uuid": doc_uuid,
+            "report_id": report_id,
+            "chunks": await session.run_sync(count_chunks, doc.id),
+            "deduplicated": True,
+            **near_duplicate_info(near)
+        }
 
+    await session.close()
     chunks = chunk_text(text)
-    embeddings = create_embeddings(chunks)
-    for idx, (chunk_text_part, emb) in enumerate(zip(chunks, embeddings)):
-        ch = DocumentChunk(
-            document_id=doc.id, 
-            chunk_index=idx, 
-            text=chunk_text_part, 
-            embedding_json=json.dumps(emb)
-        )
-        session.add(ch)
-    session.commit()
+    embeddings = await asyncio.to_thread(create_embeddings, chunks)
+    with STAGE_SECONDS.time(stage="db_write"):
+        rows = chunk_rows(doc.id, chunks, embeddings)
+        if rows:
+            await session.execute(insert(DocumentChunk), rows)
+        await session.commit()
+    await asyncio.to_thread(publish_vectors, doc.id, embeddings)
 
     return {
         "document_id": doc.id, 
         "uuid": doc_uuid, 
         "report_id": report_id, 
-        "chunks": len(chunks)
+        "chunks": len(chunks),
+        **near_duplicate_info(near)
     }
 
-@app.post("/documents/analyze")
-async def analyze_document(
-    request: AnalyzeRequest,
-    decoded = Depends(verify_token),
-    session: Session = Depends(get_session)
-):
-    doc = session.get(Document, request.document_id)
-    if not doc:
-        raise HTTPException(status_code=404, detail="Document not found")
+def build_prompt(endpoint: str, scored_chunks: List[Tuple[int, str, float]], system_prompt: str,
+                 header: str, footer: str) -> Tuple[str, int]:
+    """Pack retrieved chunks within CONTEXT_TOKEN_BUDGET; returns the user prompt and prompt tokens."""
+    context = pack_context(scored_chunks, CONTEXT_TOKEN_BUDGET, CHAT_MODEL)
+    user_prompt = header + context.text + footer
+    prompt_tokens = count_tokens(system_prompt, CHAT_MODEL) + count_tokens(user_prompt, CHAT_MODEL)
+    PROMPT_TOKENS.observe(prompt_tokens, endpoint=endpoint)
+    logger.info(
+        f"{endpoint} prompt: {prompt_tokens} tokens, {len(context.chunk_indexes)} chunks in "
+        f"{context.passages} passages, {context.dropped} dropped over budget"
+    )
+    return user_prompt, prompt_tokens
 
-    retrieved = retrieve_relevant_chunks(request.document_id, "Please summarize the document", top_k=request.top_k)
-    context_texts = [t for t, s in retrieved]
+async def run_analysis(document_id: int, top_k: int, uid: str, priority: str) -> Tuple[Dict[str, Any], int]:
+    retrieved = await retrieve_scored_chunks(document_id, "Please summarize the document", top_k)
     
-    if not context_texts:
-        return JSONResponse(content={
+    if not retrieved:
+        return {
             "report": ["No content available for analysis"],
             "breakdown": [],
             "suggestions": [],
             "patient_summary": "Document analysis unavailable",
             "sources": []
-        })
+        }, 0
     
-    user_prompt = "DOCUMENT CHUNKS:\n\n" + "\n\n---\n\n".join(context_texts) + "\n\nPlease produce the structured analysis."
+    user_prompt, prompt_tokens = build_prompt(
+        "analyze", retrieved, SYSTEM_PROMPT_ANALYSIS,
+        "DOCUMENT CHUNKS:\n\n", "\n\nPlease produce the structured analysis."
+    )
 
-    try:
-        resp = openai.ChatCompletion.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT_ANALYSIS},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0.0,
-            max_tokens=900
-        )
-        text = resp.choices[0].message.content
-        parsed = json.loads(text)
-    except Exception as e:
-        parsed = {
-            "report": [f"Analysis failed: {str(e)}"],
-            "breakdown": [{"title": "Excerpt", "summary": context_texts[0][:200], "quotes": [context_texts[0][:200]]}],
-            "suggestions": [],
-            "patient_summary": "Analysis unavailable due to processing error",
-            "sources": []
-        }
+    async with llm_scheduler.slot(uid, priority):  # 429 when over capacity
+        try:
+            text = await asyncio.to_thread(call_chat_completion, "analyze", SYSTEM_PROMPT_ANALYSIS, user_prompt, 900)
+            return parse_llm_json(text), prompt_tokens
+        except Exception as e:
+            excerpt = retrieved[0][1][:200]
+            return {
+                "report": [f"Analysis failed: {str(e)}"],
+                "breakdown": [{"title": "Excerpt", "summary": excerpt, "quotes": [excerpt]}],
+                "suggestions": [],
+                "patient_summary": "Analysis unavailable due to processing error",
+                "sources": []
+            }, prompt_tokens
+
+async def run_qa(document_id: int, question: str, top_k: int, uid: str, priority: str) -> Tuple[Dict[str, Any], int]:
+    retrieved = await retrieve_scored_chunks(document_id, question, top_k)
+    
+    if not retrieved:
+        return {
+            "answer": "I cannot determine from the provided document.", 
+            "evidence": [], 
+            "confidence": "low"
+        }, 0
+    
+    user_prompt, prompt_tokens = build_prompt(
+        "qa", retrieved, SYSTEM_PROMPT_QA,
+        "CONTEXT:\n\n", f"\n\nQUESTION: {question}\nAnswer using only the context and cite quotes."
+    )
 
-    return JSONResponse(content=parsed)
+    async with llm_scheduler.slot(uid, priority):  # 429 when over capacity
+        try:
+            text = await asyncio.to_thread(call_chat_completion, "qa", SYSTEM_PROMPT_QA, user_prompt, 600)
+            return parse_llm_json(text), prompt_tokens
+        except Exception:
+            return {
+                "answer": "I cannot determine from the provided document.", 
+                "evidence": [], 
+                "confidence": "low"
+            }, prompt_tokens
+
+def document_exists(session: Session, document_id: int) -> bool:
+    """Key-only lookup: never reads the (compressed) text columns."""
+    return use_shard_of(session, "document", document_id) and session.exec(
+        select(Document.id).where(Document.id == document_id)
+    ).first() is not None
+
+# Identical concurrent requests share one retrieval + chat call (see singleflight.py). The
+# admission class is part of the key: a doctor never waits in a flight queued as a patient's.
+analyze_flights = singleflight.SingleFlight("analyze")
+qa_flights = singleflight.SingleFlight("qa")
+
+@app.post("/documents/analyze")
+async def analyze_document(
+    request: AnalyzeRequest,
+    http_request: Request,
+    decoded = Depends(verify_token),
+    session: async_db.AsyncSession = Depends(get_session)
+):
+    if not await session.run_sync(document_exists, request.document_id):
+        raise HTTPException(status_code=404, detail="Document not found")
+
+    priority = await session.run_sync(request_priority, decoded, http_request)
+    await session.close()  # no connection held while waiting on the model
+    parsed, prompt_tokens = await analyze_flights.do(
+        (request.document_id, request.top_k, priority),
+        lambda: run_analysis(request.document_id, request.top_k, decoded.get("uid"), priority)
+    )
+    return JSONResponse(content=parsed, headers={"X-Prompt-Tokens": str(prompt_tokens)})
 
 @app.post("/documents/qa")
 async def document_qa(
     request: QARequest,
+    http_request: Request,
     decoded = Depends(verify_token),
-    session: Session = Depends(get_session)
+    session: async_db.AsyncSession = Depends(get_session)
 ):
-    doc = session.get(Document, request.document_id)
-    if not doc:
+    if not await session.run_sync(document_exists, request.document_id):
         raise HTTPException(status_code=404, detail="Document not found")
 
-    retrieved = retrieve_relevant_chunks(request.document_id, request.question, top_k=request.top_k)
-    context_texts = [t for t, s in retrieved]
-    
-    if not context_texts:
-        return JSONResponse(content={
-            "answer": "I cannot determine from the provided document.", 
-            "evidence": [], 
-            "confidence": "low"
-        })
-    
-    user_prompt = "CONTEXT:\n\n" + "\n\n---\n\n".join(context_texts) + f"\n\nQUESTION: {request.question}\nAnswer using only the context and cite quotes."
-
-    try:
-        resp = openai.ChatCompletion.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT_QA},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0.0,
-            max_tokens=600
-        )
-        parsed = json.loads(resp.choices[0].message.content)
-    except Exception:
-        parsed = {
-            "answer": "I cannot determine from the provided document.", 
-            "evidence": [], 
-            "confidence": "low"
-        }
+    # "What is the blood pressure?" is answered from the readings extracted at ingest
+    answer = await session.run_sync(structured_answer, request.document_id, request.question)
+    if answer is not None:
+        return JSONResponse(content=answer, headers={"X-Prompt-Tokens": "0", "X-Answer-Source": "vitals"})
 
-    return JSONResponse(content=parsed)
+    priority = await session.run_sync(request_priority, decoded, http_request)
+    await session.close()
+    parsed, prompt_tokens = await qa_flights.do(
+        (request.document_id, singleflight.normalize_question(request.question), request.top_k, priority),
+        lambda: run_qa(request.document_id, request.question, request.top_k, decoded.get("uid"), priority)
+    )
+    return JSONResponse(content=parsed, headers={"X-Prompt-Tokens": str(prompt_tokens), "X-Answer-Source": "rag"})
 
 if __name__ == "__main__":
     uvicorn.run("smartemr-backend:app", host="0.0.0.0", port=8001, reload=True)
@@ -1,7 +1,12 @@
 import pytest
+import io
 import os
+import sys
+import subprocess
+import zipfile
 import tempfile
 from fastapi.testclient import TestClient
+import smartemr_backend as backend
 from smartemr_backend import app
 
 # Override auth for testing
@@ -116,5 +121,1002 @@ def test_patient_search_report():
     finally:
         os.unlink(temp_file)
 
+def test_bulk_vitals_ingest_and_downsampled_query():
+    client.post("/auth/register", json={"name": "Dr. Test", "role": "doctor"})
+    patient_id = client.post("/doctor/patients/create", json={"name": "Vitals Patient"}).json()["patient_id"]
+
+    # Columnar upload: 120 heart-rate readings, one per minute
+    times = [f"2025-01-01T{m // 60:02d}:{m % 60:02d}:00" for m in range(120)]
+    response = client.post(f"/patients/{patient_id}/vitals/bulk", json={
+        "name": "heart_rate",
+        "unit": "bpm",
+        "values": [60 + (m % 10) for m in range(120)],
+        "recorded_at": times
+    })
+    assert response.status_code == 200
+    assert response.json()["inserted"] == 120
+
+    # NDJSON upload into the same visit
+    visit_id = response.json()["visit_id"]
+    ndjson = "\n".join(
+        '{"name": "spo2", "value": %d, "unit": "%%", "recorded_at": "2025-01-01T00:00:%02d"}' % (95 + i % 3, i)
+        for i in range(30)
+    )
+    response = client.post(
+        f"/patients/{patient_id}/vitals/bulk?visit_id={visit_id}",
+        content=ndjson,
+        headers={"Content-Type": "application/x-ndjson"}
+    )
+    assert response.status_code == 200
+    assert response.json()["inserted"] == 30
+
+    response = client.get(f"/patients/{patient_id}/vitals", params={"name": "heart_rate", "buckets": 4})
+    assert response.status_code == 200
+    result = response.json()
+    assert result["count"] == 120
+    assert len(result["buckets"]) == 4
+    assert sum(b["count"] for b in result["buckets"]) == 120
+    assert all(b["min"] <= b["mean"] <= b["max"] for b in result["buckets"])
+
+    bad = client.post(f"/patients/{patient_id}/vitals/bulk", json={"name": "x", "values": [1, 2], "recorded_at": ["2025-01-01"]})
+    assert bad.status_code == 400
+    for payload in ({"name": "x", "values": ["nan"]}, {"name": "x", "values": [1], "recorded_at": [1e20]}):
+        assert client.post(f"/patients/{patient_id}/vitals/bulk", json=payload).status_code == 400
+
+def test_failed_bulk_vitals_import_leaves_no_visit(monkeypatch):
+    from sqlmodel import select
+
+    client.post("/auth/register", json={"name": "Dr. Test", "role": "doctor"})
+    patient_id = client.post("/doctor/patients/create", json={"name": "Import Patient"}).json()["patient_id"]
+    monkeypatch.setattr(backend, "VITALS_BATCH_SIZE", 1)
+    original = backend.async_db.AsyncSession.execute
+    async def failing_second_batch(self, statement, params=None, **kwargs):
+        if params and params[0]["value"] == 2.0:
+            raise RuntimeError("disk full")
+        return await original(self, statement, params, **kwargs)
+    monkeypatch.setattr(backend.async_db.AsyncSession, "execute", failing_second_batch)
+    with pytest.raises(RuntimeError):
+        client.post(f"/patients/{patient_id}/vitals/bulk", json={"name": "hr", "values": [1, 2]})
+    with backend.Session(backend.engine) as session:
+        assert session.exec(select(backend.Visit).where(backend.Visit.patient_id == patient_id)).all() == []
+
+def test_batch_upload_files_and_zip():
+    client.post("/auth/register", json={"name": "Dr. Test", "role": "doctor"})
+    patient_id = client.post("/doctor/patients/create", json={"name": "Batch Patient"}).json()["patient_id"]
+
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("scans/report_1.txt", "Hemoglobin: 13.5 g/dL")
+        zf.writestr("scans/report_2.txt", "Glucose: 98 mg/dL")
+        zf.writestr("scans/empty.txt", "")
+    archive.seek(0)
+
+    response = client.post(
+        f"/doctor/patients/{patient_id}/upload_reports",
+        files=[
+            ("files", ("loose.txt", io.BytesIO(b"Cholesterol: 180 mg/dL"), "text/plain")),
+            ("files", ("scans.zip", archive, "application/zip")),
+        ]
+    )
+    assert response.status_code == 200
+    result = response.json()
+    assert result["total"] == 4
+    assert result["succeeded"] == 3
+    by_name = {r["filename"]: r for r in result["results"]}
+    assert by_name["report_1.txt"]["report_id"].startswith("REP-")
+    assert by_name["empty.txt"]["status"] == "error"
+
+def test_batch_extraction_metrics_reach_the_parent():
+    from observability import FALLBACKS, STAGE_SECONDS
+    client.post("/auth/register", json={"name": "Dr. Test", "role": "doctor"})
+    patient_id = client.post("/doctor/patients/create", json={"name": "Scan Patient"}).json()["patient_id"]
+    fallbacks = FALLBACKS.value(kind="pdf_ocr_fallback")
+    pdf_timings = STAGE_SECONDS.count(stage="extract_pdf")
+
+    # a scan without a text layer: the spawned worker falls back to OCR
+    response = client.post(
+        f"/doctor/patients/{patient_id}/upload_reports",
+        files=[("files", ("scan.pdf", io.BytesIO(b"%PDF-1.4 not really a pdf"), "application/pdf"))]
+    )
+    assert response.status_code == 200
+    assert FALLBACKS.value(kind="pdf_ocr_fallback") == fallbacks + 1
+    assert STAGE_SECONDS.count(stage="extract_pdf") == pdf_timings + 1
+
+def test_batch_upload_rejects_zip_bombs(monkeypatch):
+    client.post("/auth/register", json={"name": "Dr. Test", "role": "doctor"})
+    patient_id = client.post("/doctor/patients/create", json={"name": "Bomb Patient"}).json()["patient_id"]
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("a.txt", "0" * 4096)
+        zf.writestr("b.txt", "0" * 4096)
+
+    monkeypatch.setattr(backend, "MAX_BATCH_BYTES", 6000)
+    archive.seek(0)
+    response = client.post(f"/doctor/patients/{patient_id}/upload_reports",
+                           files=[("files", ("bomb.zip", archive, "application/zip"))])
+    assert response.status_code == 400
+
+    # an entry that inflates past the size it declares is cut off
+    monkeypatch.setattr(backend, "MAX_BATCH_BYTES", 1 << 20)
+    lying = bytearray(archive.getvalue())
+    for header in (b"PK\x01\x02", b"PK\x03\x04"):
+        at = lying.find(header)
+        size_at = at + (24 if header == b"PK\x01\x02" else 22)
+        lying[size_at:size_at + 4] = (100).to_bytes(4, "little")
+    response = client.post(f"/doctor/patients/{patient_id}/upload_reports",
+                           files=[("files", ("bomb.zip", io.BytesIO(bytes(lying)), "application/zip"))])
+    assert response.status_code == 400
+
+    reader = backend.BoundedReader(io.BytesIO(b"0" * 200), 100, "c.txt")
+    assert len(reader.read(60)) == 60
+    with pytest.raises(backend.HTTPException):
+        reader.read()
+
+def test_duplicate_upload_reuses_stored_blob_and_chunks():
+    client.post("/auth/register", json={"name": "Dr. Test", "role": "doctor"})
+    patient_id = client.post("/doctor/patients/create", json={"name": "Dedup Patient"}).json()["patient_id"]
+    content = b"Discharge summary\nBlood Pressure: 130/85 mmHg\n" * 50
+
+    first = client.post(
+        f"/doctor/patients/{patient_id}/upload_report",
+        files={"file": ("summary.txt", io.BytesIO(content), "text/plain")}
+    ).json()
+    second = client.post(
+        f"/doctor/patients/{patient_id}/upload_report",
+        files={"file": ("summary-copy.txt", io.BytesIO(content), "text/plain")}
+    ).json()
+
+    assert "deduplicated" not in first
+    assert second["deduplicated"] is True
+    assert second["chunks"] == first["chunks"]
+    assert second["document_id"] != first["document_id"]
+    assert second["report_id"] != first["report_id"]
+
+def test_deleting_reports_releases_their_blob():
+    from sqlmodel import select
+
+    client.post("/auth/register", json={"name": "Dr. Test", "role": "doctor"})
+    patient_id = client.post("/doctor/patients/create", json={"name": "Delete Patient"}).json()["patient_id"]
+    content = b"Lipid panel\nLDL: 162 mg/dL\nHeart Rate: 66 bpm\n" * 40
+    first, second = (client.post(
+        f"/doctor/patients/{patient_id}/upload_report",
+        files={"file": (name, io.BytesIO(content), "text/plain")}
+    ).json() for name in ("lipids.txt", "lipids-copy.txt"))
+    assert second["deduplicated"] is True
+    with backend.Session(backend.engine) as session:
+        digest = session.get(backend.Document, first["document_id"]).content_sha256
+        path = session.get(backend.Blob, digest).path
+
+    assert client.delete(f"/doctor/reports/{first['report_id']}").status_code == 200
+    assert client.get(f"/patient/reports/search/{first['report_id']}").status_code == 404
+    with backend.Session(backend.engine) as session:
+        assert backend.count_chunks(session, first["document_id"]) == 0
+        assert session.exec(select(backend.Vital).where(backend.Vital.document_id == first["document_id"])).all() == []
+        assert session.get(backend.Blob, digest).refcount == 1
+    assert os.path.exists(path)
+    assert backend.retrieve_relevant_chunks(second["document_id"], "LDL", top_k=1)
+
+    assert client.delete(f"/doctor/reports/{second['report_id']}").status_code == 200
+    assert client.delete(f"/doctor/reports/{second['report_id']}").status_code == 404
+    with backend.Session(backend.engine) as session:
+        assert session.get(backend.Blob, digest).refcount == 0
+    # files are only unlinked by the sweep, after the row's deletion committed, and not
+    # while an upload of the same bytes may be about to reference them again
+    assert backend.sweep_blobs() == 0 and os.path.exists(path)
+    orphan = backend.store_upload(io.BytesIO(b"upload that failed before its report was saved"), "o.txt")
+    os.utime(orphan.path, (0, 0))
+    os.utime(path, (0, 0))
+    assert backend.sweep_blobs() >= 2
+    with backend.Session(backend.engine) as session:
+        assert session.get(backend.Blob, digest) is None
+    assert not os.path.exists(path) and not os.path.exists(orphan.path)
+
+    # a re-upload resolving to a file swept meanwhile fails instead of referencing a missing file
+    again = backend.store_upload(io.BytesIO(content), "lipids.txt")
+    os.remove(again.path)
+    with backend.Session(backend.engine) as session, pytest.raises(RuntimeError):
+        backend.acquire_blob(session, again)
+
+def test_near_duplicate_rescan_links_chunks_and_retrieval_collapses_copies(monkeypatch):
+    import numpy as np
+
+    client.post("/auth/register", json={"name": "Dr. Test", "role": "doctor"})
+    patient_id = client.post("/doctor/patients/create", json={"name": "Rescan Patient"}).json()["patient_id"]
+    page = ("Cardiology follow-up. Blood Pressure: 142/91 mmHg. Heart Rate: 88 bpm. Creatinine 1.3 mg/dL. "
+            "Patient reports exertional dyspnea; continue lisinopril and recheck renal panel in four weeks. ")
+    original = (page * 8).encode()
+    rescan = original.replace(b"dyspnea", b"dyspnoa", 3).replace(b"lisinopril", b"lisinoprii", 2)
+    relabelled = original.replace(b"142/91", b"128/79")
+
+    def upload(name, content):
+        return client.post(
+            f"/doctor/patients/{patient_id}/upload_report",
+            files={"file": (name, io.BytesIO(content), "text/plain")}
+        ).json()
+
+    first = upload("cardio.txt", original)
+    assert "near_duplicate_of" not in first
+
+    def no_embeddings(*args, **kwargs):
+        raise AssertionError("a rescan must reuse the chunks of the original")
+    monkeypatch.setattr(backend, "create_embeddings", no_embeddings)
+    second = upload("cardio-fax.txt", rescan)
+    assert second["deduplicated"] is True and second["chunks"] == first["chunks"]
+    assert second["near_duplicate_of"]["document_id"] == first["document_id"]
+    assert second["near_duplicate_of"]["linked"] is True
+    monkeypatch.undo()
+
+    # same template, different readings: flagged but embedded on its own
+    third = upload("cardio-next-visit.txt", relabelled)
+    assert "deduplicated" not in third
+    assert third["near_duplicate_of"]["linked"] is False
+
+    texts = [page, page.replace("dyspnea", "dyspnoa"), "HbA1c: 8.2% with poor glycemic control."]
+    vectors = np.array([[1.0, 0.0], [0.99, 0.05], [0.98, 0.1]], dtype=np.float32)
+    assert backend.collapse_near_duplicate_chunks(vectors, texts, 2) == [0, 2]
+
+def test_linked_upload_commits_document_and_chunks_together(monkeypatch):
+    from sqlmodel import select
+
+    page = "Renal panel. Creatinine 1.4 mg/dL. Potassium 4.9 mmol/L. Repeat in two weeks. " * 8
+    first = client.post(
+        "/documents/upload", files={"file": ("renal.txt", io.BytesIO(page.encode()), "text/plain")}
+    ).json()
+
+    def copy_fails(*args, **kwargs):
+        raise RuntimeError("disk full")
+    monkeypatch.setattr(backend, "copy_chunks", copy_fails)
+    with pytest.raises(RuntimeError):
+        client.post(
+            "/documents/upload",
+            files={"file": ("renal-rescan.txt", io.BytesIO(page.replace("Repeat", "Rep eat").encode()), "text/plain")}
+        )
+    with backend.Session(backend.engine) as session:
+        assert session.exec(select(backend.Document).where(backend.Document.filename == "renal-rescan.txt")).all() == []
+    monkeypatch.undo()
+
+    second = client.post(
+        "/documents/upload",
+        files={"file": ("renal-rescan.txt", io.BytesIO(page.replace("Repeat", "Rep eat").encode()), "text/plain")}
+    ).json()
+    assert second["deduplicated"] is True and second["chunks"] == first["chunks"]
+
+def test_minhash_buckets_are_stored_as_bigint():
+    import near_duplicates
+    from sqlalchemy.dialects import postgresql
+
+    column = backend.DocumentMinHashBand.__table__.c.bucket
+    assert column.type.compile(dialect=postgresql.dialect()) == "BIGINT"
+    buckets = near_duplicates.band_buckets(near_duplicates.signature("Ferritin 12 ng/mL, low. " * 20))
+    assert max(abs(b) for b in buckets) > 2 ** 31
+    backend.ensure_db()
+    with backend.Session(backend.engine) as session:
+        backend.index_minhash(session, 10 ** 6, near_duplicates.signature("Ferritin 12 ng/mL, low. " * 20))
+        stored = session.exec(backend.select(backend.DocumentMinHashBand.bucket)
+                              .where(backend.DocumentMinHashBand.document_id == 10 ** 6)).all()
+        session.rollback()
+    assert sorted(stored) == sorted(buckets)
+
+def test_async_sessions_hold_connections_only_while_writing(tmp_path):
+    import asyncio
+    import async_db
+    from observability import trace_id_var
+    from sqlalchemy import create_engine
+
+    # one connection, no overflow: a session keeping it after a read would time out the others
+    small = create_engine(f"sqlite:///{tmp_path}/pool.db", pool_size=1, max_overflow=0, pool_timeout=1,
+                          connect_args={"check_same_thread": False})
+    backend.SQLModel.metadata.create_all(small, tables=[backend.Patient.__table__])
+
+    async def scenario():
+        readers = [async_db.AsyncSession(backend.Session(small)) for _ in range(3)]
+        for session in readers:
+            assert (await session.exec(backend.select(backend.Patient))).all() == []
+            assert not session.in_transaction()
+        writer = async_db.AsyncSession(backend.Session(small))
+        writer.add(backend.Patient(name="Pool Patient"))
+        await writer.flush()
+        assert writer.in_transaction() and small.pool.checkedout() == 1
+        await writer.commit()
+        assert small.pool.checkedout() == 0
+
+        trace_id_var.set("trace-pool")
+        assert await async_db.run(trace_id_var.get) == "trace-pool"
+
+    asyncio.run(scenario())
+    small.dispose()
+
+def test_ocr_normalizes_phone_photos_and_caches_results(monkeypatch):
+    import pytesseract
+    from PIL import Image
+    import ocr_pipeline
+
+    # sideways 4000x3000 colour photo of a page, upright only through its EXIF flag
+    photo = Image.new("RGB", (4000, 3000), "white")
+    exif = photo.getexif()
+    exif[ocr_pipeline.EXIF_ORIENTATION] = 6
+    buf = io.BytesIO()
+    photo.save(buf, "JPEG", exif=exif)
+    content = buf.getvalue()
+
+    image = ocr_pipeline.preprocess(content, target_dpi=150)
+    assert image.mode == "L"
+    assert image.height > image.width  # rotated upright
+    assert max(image.size) == round(4000 * 150 / (4000 / ocr_pipeline.PAGE_LONG_SIDE_INCHES))
+
+    calls = []
+    def fake_ocr(image, lang=None):
+        calls.append(image.size)
+        return "Heart Rate: 64 bpm"
+    monkeypatch.setattr(pytesseract, "image_to_string", fake_ocr)
+    monkeypatch.setattr(ocr_pipeline, "detect_rotation", lambda image: 0)
+    for name in ("photo.jpg", "photo-retry.jpg"):
+        response = client.post("/documents/upload", files={"file": (name, io.BytesIO(content), "image/jpeg")})
+        assert response.status_code == 200
+    assert len(calls) == 1
+    assert max(calls[0]) <= 300 * ocr_pipeline.PAGE_LONG_SIDE_INCHES + 1
+
+def test_local_embedding_provider_is_deterministic_and_tagged():
+    import numpy as np
+    from embedding_providers import get_provider
+
+    provider = get_provider("local", dim=256)
+    assert provider.key == "local:hash-ngram-v1@256"
+
+    a, b, c = provider.embed([
+        "Blood pressure 120/80 mmHg, heart rate 72 bpm",
+        "blood pressure reading 118/79 mmHg",
+        "HbA1c 8.2% with poor glycemic control",
+    ])
+    assert len(a) == 256
+    assert a == provider.embed(["Blood pressure 120/80 mmHg, heart rate 72 bpm"])[0]
+    assert np.dot(a, b) > np.dot(a, c)
+    assert provider.embed([""])[0] == [0.0] * 256
+
+def test_metrics_endpoint_reports_stages_and_trace_id():
+    client.post("/auth/register", json={"name": "Dr. Test", "role": "doctor"})
+    patient_id = client.post("/doctor/patients/create", json={"name": "Metrics Patient"}).json()["patient_id"]
+    upload = client.post(
+        f"/doctor/patients/{patient_id}/upload_report",
+        files={"file": ("metrics.txt", io.BytesIO(b"Heart Rate: 64 bpm"), "text/plain")}
+    )
+    qa = client.post(
+        "/documents/qa",
+        json={"document_id": upload.json()["document_id"], "question": "Is the heart rate normal?"},
+        headers={"X-Trace-Id": "trace-abc123"}
+    )
+    assert qa.headers["X-Trace-Id"] == "trace-abc123"
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    body = response.text
+    for stage in ("extract", "chunk", "embed_batch", "db_write", "retrieve", "llm_call"):
+        assert f'smartemr_stage_seconds_count{{stage="{stage}"}}' in body
+    assert 'smartemr_llm_tokens_total{endpoint="qa",kind="prompt"}' in body
+    assert 'route="/documents/qa"' in body
+
+def test_profiler_on_request_header():
+    client.post("/auth/register", json={"name": "Dr. Test", "role": "doctor"})
+    unprofiled = client.get("/doctor/patients")
+    assert "X-Profile-Id" not in unprofiled.headers
+
+    profiled = client.get("/doctor/patients", headers={"X-Profile": "1"})
+    assert profiled.status_code == 200
+    assert profiled.headers["X-Profile-Id"].endswith(".collapsed")
+
+    summary = client.get("/debug/profiles").json()
+    assert summary["routes"]["GET /doctor/patients"]["profiles"] >= 1
+    assert os.path.exists(os.path.join(summary["directory"], profiled.headers["X-Profile-Id"]))
+
+def test_profiler_not_installed_unless_enabled(monkeypatch):
+    import profiling
+    from fastapi import FastAPI
+
+    monkeypatch.setattr(profiling, "PROFILE_HEADER_ENABLED", False)
+    monkeypatch.setattr(profiling, "PROFILE_SAMPLE_RATE", 0.0)
+    bare = FastAPI()
+    assert profiling.install_profiler(bare) is None
+    assert TestClient(bare).get("/debug/profiles").status_code == 404
+
+def test_vector_store_append_link_recover_and_compact(tmp_path):
+    import numpy as np
+    from vector_store import VectorStore, compact_all
+
+    writer = VectorStore(str(tmp_path), "local:hash-ngram-v1@4", 4)
+    reader = VectorStore(str(tmp_path), "local:hash-ngram-v1@4", 4)
+    assert reader.get(1) is None
+
+    writer.append(1, np.ones((3, 4)))
+    writer.append(2, np.full((2, 4), 2.0))
+    writer.link(3, 2)
+    view = reader.get(2)
+    assert view.shape == (2, 4) and not view.flags.owndata and not view.flags.writeable
+    assert np.array_equal(reader.get(3), view)
+
+    # A crash between writing rows and publishing their index record leaves garbage
+    # behind; readers ignore it and the next append overwrites it.
+    generation = open(os.path.join(writer.dir, "CURRENT")).read()
+    with open(os.path.join(writer.dir, generation, "vectors.f32"), "ab") as f:
+        f.write(b"\xff" * 40)
+    with open(os.path.join(writer.dir, generation, "index.bin"), "ab") as f:
+        f.write(b"\x01" * 20)
+    assert 4 not in reader
+    writer.append(4, np.full((1, 4), 4.0))
+    assert np.array_equal(reader.get(4), np.full((1, 4), 4.0, dtype=np.float32))
+
+    writer.delete(1)
+    result = writer.compact()
+    assert result == {"documents": 3, "rows_before": 6, "rows_after": 3}
+    assert reader.get(1) is None
+    assert np.array_equal(reader.get(3), np.full((2, 4), 2.0, dtype=np.float32))
+    assert np.array_equal(reader.get(4), np.full((1, 4), 4.0, dtype=np.float32))
+
+    # the CLI compacts every space found under the root, including ones without a DIM file
+    legacy = VectorStore(str(tmp_path), "openai:text-embedding-3-small@3", 3)
+    legacy.append(1, np.ones((2, 3)))
+    legacy.delete(1)
+    os.remove(os.path.join(legacy.dir, "DIM"))
+    writer.delete(4)
+    assert compact_all(str(tmp_path)) == {
+        "local_hash-ngram-v1_4": {"documents": 2, "rows_before": 3, "rows_after": 2},
+        "openai_text-embedding-3-small_3": {"documents": 0, "rows_before": 2, "rows_after": 0},
+    }
+    assert reader.get(4) is None and np.array_equal(reader.get(3), np.full((2, 4), 2.0, dtype=np.float32))
+
+def test_qa_retrieval_reads_shared_vector_store():
+    client.post("/auth/register", json={"name": "Dr. Test", "role": "doctor"})
+    patient_id = client.post("/doctor/patients/create", json={"name": "Vector Patient"}).json()["patient_id"]
+    upload = client.post(
+        f"/doctor/patients/{patient_id}/upload_report",
+        files={"file": ("vectors.txt", io.BytesIO(b"Creatinine 1.1 mg/dL. " * 200), "text/plain")}
+    ).json()
+
+    store = backend.get_vector_store()
+    assert store.get(upload["document_id"]).shape[0] == upload["chunks"]
+    qa = client.post("/documents/qa", json={"document_id": upload["document_id"], "question": "Is the creatinine stable?"})
+    assert qa.status_code == 200
+
+def test_int8_first_pass_with_rescoring_matches_full_precision(tmp_path, monkeypatch):
+    import numpy as np
+    from embedding_providers import get_provider
+    from vector_store import VectorStore, quantize_int8, dequantize_int8
+
+    rng = np.random.default_rng(7)
+    vectors = rng.standard_normal((300, 64)).astype(np.float32)
+    q, scales = quantize_int8(vectors)
+    unit = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    assert q.dtype == np.int8 and np.abs(dequantize_int8(q, scales) - unit).max() < 0.01
+
+    store = VectorStore(str(tmp_path), "local:test@64", 64)
+    store.append(1, vectors)
+    q8, stored_scales = store.get_quantized(1)
+    assert np.array_equal(q8, q) and np.array_equal(stored_scales, scales)
+
+    # retrieval over a document larger than the rescoring shortlist
+    monkeypatch.setattr(backend, "RESCORE_CANDIDATES", 8)
+    monkeypatch.setattr(backend, "QUANTIZED_SEARCH", True)
+    client.post("/auth/register", json={"name": "Dr. Test", "role": "doctor"})
+    patient_id = client.post("/doctor/patients/create", json={"name": "Quantized Patient"}).json()["patient_id"]
+    text = "".join(f"Visit {i}: potassium {3 + i % 20 / 10:.1f} mmol/L, sodium {130 + i % 15} mmol/L. " for i in range(400))
+    doc_id = client.post(
+        f"/doctor/patients/{patient_id}/upload_report",
+        files={"file": ("labs.txt", io.BytesIO(text.encode()), "text/plain")}
+    ).json()["document_id"]
+    quantized = backend.retrieve_relevant_chunks(doc_id, "potassium 4.2 mmol/L", top_k=3)
+    monkeypatch.setattr(backend, "QUANTIZED_SEARCH", False)
+    exact = backend.retrieve_relevant_chunks(doc_id, "potassium 4.2 mmol/L", top_k=3)
+    assert quantized == exact
+
+    # reduced dimensions are requested from the embeddings API
+    assert get_provider("openai", dim=256).request_kwargs == {"dimensions": 256}
+    assert get_provider("openai", dim=1536).request_kwargs == {}
+    with pytest.raises(ValueError):
+        get_provider("openai", model="text-embedding-ada-002", dim=256)
+
+def test_reembed_job_switches_documents_and_resumes():
+    import reembed
+    from embedding_providers import get_provider
+
+    client.post("/auth/register", json={"name": "Dr. Test", "role": "doctor"})
+    patient_id = client.post("/doctor/patients/create", json={"name": "Reembed Patient"}).json()["patient_id"]
+    doc_ids = [
+        client.post(
+            f"/doctor/patients/{patient_id}/upload_report",
+            files={"file": (f"r{i}.txt", io.BytesIO(f"Report {i}: ferritin {20 + i} ng/mL. ".encode() * 40), "text/plain")}
+        ).json()["document_id"]
+        for i in range(3)
+    ]
+    target = get_provider("local", dim=64)
+
+    # first run stops after one document; the rest stay on the old vectors until resumed
+    job = reembed.run_job(backend, target, texts_per_minute=0, max_documents=1)
+    assert job.status == "running" and job.documents_done == 1
+    with backend.Session(backend.engine) as session:
+        first = session.get(backend.Document, job.last_document_id)
+        assert first.embedding_model == target.key
+        assert session.get(backend.Document, doc_ids[-1]).embedding_model == backend.embedding_provider.key
+    assert backend.retrieve_relevant_chunks(first.id, "ferritin", top_k=1)
+
+    job = reembed.run_job(backend, target, job_id=job.id, texts_per_minute=0)
+    assert job.status == "done" and job.last_document_id >= doc_ids[-1]
+    with backend.Session(backend.engine) as session:
+        chunks = session.exec(backend.select(backend.DocumentChunk).where(
+            backend.DocumentChunk.document_id.in_(doc_ids))).all()
+    assert {c.embedding_model for c in chunks} == {target.key}
+    assert all(c.embedding_scale > 0 for c in chunks)
+    assert backend.get_vector_store(target).get(doc_ids[-1]).shape == (len(chunks) // 3, 64)
+    results = backend.retrieve_relevant_chunks(doc_ids[-1], "ferritin level", top_k=2)
+    assert results and "ferritin" in results[0][0]
+
+    # a zero vector left by the embedding fallback makes the document stale again
+    with backend.Session(backend.engine) as session:
+        session.execute(backend.update(backend.DocumentChunk).where(
+            backend.DocumentChunk.id == chunks[0].id).values(embedding_json="[" + "0.0, " * 63 + "0.0]", embedding_scale=0.0))
+        session.commit()
+    job = reembed.run_job(backend, target, texts_per_minute=0)
+    assert job.documents_done == 1 and job.chunks_embedded == 1
+
+def test_llm_scheduler_priorities_fairness_and_rejection(monkeypatch):
+    import asyncio
+    from admission import AdmissionRejected, LLMScheduler
+
+    async def scenario():
+        scheduler = LLMScheduler(max_concurrent=1, max_queue=5, queue_timeout_s=1.0, batch_queue_timeout_s=1.0)
+        order = []
+
+        async def call(user, priority):
+            async with scheduler.slot(user, priority):
+                order.append((user, priority))
+                await asyncio.sleep(0.01)
+
+        blocker = asyncio.create_task(call("first", "doctor_interactive"))
+        await asyncio.sleep(0)
+        tasks = [asyncio.create_task(call(u, p)) for u, p in [
+            ("p1", "patient_batch"), ("p2", "patient_interactive"), ("d1", "doctor_interactive"),
+            ("d1", "doctor_interactive"), ("d2", "doctor_interactive"),
+        ]]
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as full:
+            await scheduler.acquire("p3", "patient_interactive")
+        assert full.value.reason == "queue_full" and full.value.retry_after >= 1
+        await asyncio.gather(blocker, *tasks)
+        assert order[1:] == [
+            ("d1", "doctor_interactive"), ("d2", "doctor_interactive"), ("d1", "doctor_interactive"),
+            ("p2", "patient_interactive"), ("p1", "patient_batch"),
+        ]
+
+        await scheduler.acquire("slow", "doctor_interactive")
+        scheduler.timeouts["patient_interactive"] = 0.01
+        with pytest.raises(AdmissionRejected) as timed_out:
+            await scheduler.acquire("p4", "patient_interactive")
+        assert timed_out.value.reason == "queue_timeout" and scheduler.depth == 0
+        scheduler.release()
+
+    asyncio.run(scenario())
+
+    # over capacity, the endpoint fails fast with 429 and Retry-After
+    monkeypatch.setattr(backend, "llm_scheduler", LLMScheduler(0, 10, 0.01, 0.01))
+    client.post("/auth/register", json={"name": "Dr. Test", "role": "doctor"})
+    patient_id = client.post("/doctor/patients/create", json={"name": "Busy Patient"}).json()["patient_id"]
+    doc_id = client.post(
+        f"/doctor/patients/{patient_id}/upload_report",
+        files={"file": ("busy.txt", io.BytesIO(b"Sodium 140 mmol/L"), "text/plain")}
+    ).json()["document_id"]
+    response = client.post("/documents/qa", json={"document_id": doc_id, "question": "Sodium?"},
+                           headers={"X-Priority": "batch"})
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    body = client.get("/metrics").text
+    assert 'smartemr_llm_rejected_total{priority="doctor_batch",reason="queue_timeout"} 1' in body
+    assert "smartemr_llm_queue_wait_seconds_count" in body
+
+def test_identical_concurrent_qa_requests_share_one_chat_call(monkeypatch):
+    import asyncio
+    import time
+    import httpx
+    from singleflight import COALESCED, SingleFlight
+
+    client.post("/auth/register", json={"name": "Dr. Test", "role": "doctor"})
+    patient_id = client.post("/doctor/patients/create", json={"name": "Coalesce Patient"}).json()["patient_id"]
+    doc_id = client.post(
+        f"/doctor/patients/{patient_id}/upload_report",
+        files={"file": ("cbc.txt", io.BytesIO(b"WBC 6.1, Hemoglobin 13.9 g/dL"), "text/plain")}
+    ).json()["document_id"]
+
+    calls = []
+    def slow_chat(endpoint, system_prompt, user_prompt, max_tokens):
+        calls.append(endpoint)
+        time.sleep(0.2)
+        return '{"answer": "13.9 g/dL", "evidence": [], "confidence": "high"}'
+    monkeypatch.setattr(backend, "call_chat_completion", slow_chat)
+    before = COALESCED.value(endpoint="qa")
+
+    async def burst():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            questions = ["What is the hemoglobin?", "what is the  hemoglobin", "WHAT IS THE HEMOGLOBIN?!", "What is the WBC?"]
+            return await asyncio.gather(*(
+                http.post("/documents/qa", json={"document_id": doc_id, "question": q}) for q in questions
+            ), http.post("/documents/qa", json={"document_id": doc_id, "question": questions[0]},
+                         headers={"X-Priority": "batch"}))  # another admission class: its own flight
+
+    responses = asyncio.run(burst())
+    assert [r.status_code for r in responses] == [200] * 5
+    assert all(r.json()["answer"] == "13.9 g/dL" for r in responses)
+    assert calls == ["qa", "qa", "qa"]
+    for top_k in (0, -1, 10 ** 6):
+        assert client.post("/documents/qa", json={"document_id": doc_id, "question": "x", "top_k": top_k}).status_code == 422
+        assert client.post("/documents/analyze", json={"document_id": doc_id, "top_k": top_k}).status_code == 422
+    assert COALESCED.value(endpoint="qa") - before == 2
+
+    async def failing():
+        flights = SingleFlight("test")
+        async def boom():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("upstream down")
+        results = await asyncio.gather(flights.do("k", boom), flights.do("k", boom), return_exceptions=True)
+        assert [str(r) for r in results] == ["upstream down", "upstream down"]
+        assert len(flights) == 0
+
+    asyncio.run(failing())
+
+def test_handlers_overlap_database_waits_of_concurrent_requests():
+    import asyncio
+    import time
+    import httpx
+    from sqlalchemy import event
+
+    client.post("/auth/register", json={"name": "Dr. Test", "role": "doctor"})
+    patient_id = client.post("/doctor/patients/create", json={"name": "Portal Patient"}).json()["patient_id"]
+
+    def slow_statement(*_):
+        time.sleep(0.1)  # a read waiting on the disk
+    event.listen(backend.engine, "before_cursor_execute", slow_statement)
+
+    async def burst():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            start = time.perf_counter()
+            responses = await asyncio.gather(*(
+                http.get(f"/patients/{patient_id}/timeline", params={"limit": 5}) for _ in range(8)
+            ))
+            return responses, time.perf_counter() - start
+
+    try:
+        responses, elapsed = asyncio.run(burst())
+    finally:
+        event.remove(backend.engine, "before_cursor_execute", slow_statement)
+    assert [r.status_code for r in responses] == [200] * 8
+    # each request runs 4+ statements (0.4s+); one at a time the burst would take 3.2s+
+    assert elapsed < 2.0
+
+def test_context_packing_merges_overlap_and_respects_budget():
+    from context_packing import count_tokens, pack_context
+
+    text = " ".join(f"Line {i}: glucose {90 + i} mg/dL on day {i}." for i in range(200))
+    chunks = backend.chunk_text(text)
+    scored = [(i, chunk, 1.0 - i / 100) for i, chunk in enumerate(chunks[:3])]
+
+    packed = pack_context(scored, budget=10_000)
+    assert packed.text == text[:len(packed.text)]  # overlap removed, nothing repeated
+    assert packed.chunk_indexes == [0, 1, 2] and packed.passages == 1 and packed.dropped == 0
+
+    gapped = pack_context([(0, chunks[0], 0.9), (5, chunks[5], 0.8)], budget=10_000)
+    assert gapped.passages == 2 and "---" in gapped.text
+
+    budget = count_tokens(chunks[0]) + 50
+    tight = pack_context(scored, budget=budget)
+    assert tight.tokens <= budget and tight.chunk_indexes[0] == 0 and tight.dropped >= 1
+    assert pack_context(scored, budget=20).tokens <= 20
+
+def test_qa_reports_prompt_tokens():
+    client.post("/auth/register", json={"name": "Dr. Test", "role": "doctor"})
+    patient_id = client.post("/doctor/patients/create", json={"name": "Token Patient"}).json()["patient_id"]
+    doc_id = client.post(
+        f"/doctor/patients/{patient_id}/upload_report",
+        files={"file": ("long.txt", io.BytesIO(b"Lipase 52 U/L. " * 600), "text/plain")}
+    ).json()["document_id"]
+    response = client.post("/documents/qa", json={"document_id": doc_id, "question": "Lipase?", "top_k": 20})
+    assert response.status_code == 200
+    assert 0 < int(response.headers["X-Prompt-Tokens"]) <= backend.CONTEXT_TOKEN_BUDGET + 500
+    assert 'smartemr_prompt_tokens_count{endpoint="qa"}' in client.get("/metrics").text
+
+def test_ingest_extracts_vitals_and_qa_answers_them_without_llm(monkeypatch):
+    from vitals_extraction import extract_vitals, match_question
+
+    rows = extract_vitals("- HbA1c: 8.2% (HIGH) [Target: <7.0%]\nBP 150/90\nPulse: 72 bpm\nDate: 2025-01-15")
+    assert [(r["name"], r["value"], r["unit"]) for r in rows] == [
+        ("hba1c", 8.2, "%"), ("blood_pressure_systolic", 150.0, "mmHg"),
+        ("blood_pressure_diastolic", 90.0, "mmHg"), ("heart_rate", 72.0, "bpm"),
+    ]
+    assert match_question("What's the patient's HbA1c level?") == "hba1c"
+    assert match_question("Is the blood pressure controlled?") is None
+
+    client.post("/auth/register", json={"name": "Dr. Test", "role": "doctor"})
+    patient_id = client.post("/doctor/patients/create", json={"name": "Vitals QA Patient"}).json()["patient_id"]
+    report = b"LABORATORY RESULTS - Date: 2025-01-15\nBlood Pressure: 120/80 mmHg / Heart Rate: 72 bpm\n"
+    doc_id = client.post(
+        f"/doctor/patients/{patient_id}/upload_report",
+        files={"file": ("vitals.txt", io.BytesIO(report), "text/plain")}
+    ).json()["document_id"]
+
+    series = client.get(f"/patients/{patient_id}/vitals", params={"name": "heart_rate"}).json()
+    assert series["count"] == 1 and series["buckets"][0]["last"] == 72.0
+    assert series["buckets"][0]["start"].startswith("2025-01-15")
+
+    def no_chat(*args, **kwargs):
+        raise AssertionError("structured questions must not reach the LLM")
+    monkeypatch.setattr(backend, "call_chat_completion", no_chat)
+    response = client.post("/documents/qa", json={"document_id": doc_id, "question": "What is the blood pressure reading?"})
+    assert response.headers["X-Answer-Source"] == "vitals"
+    assert response.json()["answer"] == "Blood pressure: 120/80 mmHg."
+
+    # nothing extracted for this topic: falls back to RAG
+    monkeypatch.undo()
+    response = client.post("/documents/qa", json={"document_id": doc_id, "question": "What is the HbA1c?"})
+    assert response.headers["X-Answer-Source"] == "rag"
+
+def test_patient_export_streams_resumes_and_compresses(monkeypatch):
+    import gzip
+    import json
+    import zlib
+
+    monkeypatch.setattr(backend, "EXPORT_PAGE_ROWS", 2)
+    client.post("/auth/register", json={"name": "Dr. Test", "role": "doctor"})
+    patient_id = client.post("/doctor/patients/create", json={"name": "Export Patient"}).json()["patient_id"]
+    for i in range(3):
+        client.post(
+            f"/doctor/patients/{patient_id}/upload_report",
+            files={"file": (f"r{i}.txt", io.BytesIO(f"Visit {i}\nHeart Rate: {70 + i} bpm".encode()), "text/plain")}
+        )
+
+    response = client.get(f"/patients/{patient_id}/export")
+    assert response.status_code == 200
+    records = [json.loads(l) for l in response.text.splitlines()]
+    assert [r["type"] for r in records] == ["patient"] + ["report"] * 3 + ["document"] * 3 + ["visit"] * 3 + ["vital"] * 3 + ["end"]
+    assert records[-1]["data"]["counts"] == {"report": 3, "document": 3, "visit": 3, "vital": 3}
+    assert records[5]["data"]["content_text"].startswith("Visit 1")
+
+    # resume after the second document: no header, no rows already received
+    resumed = client.get(f"/patients/{patient_id}/export", params={"cursor": records[5]["cursor"]})
+    resumed_records = [json.loads(l) for l in resumed.text.splitlines()]
+    assert resumed_records[:-1] == records[6:-1]
+    resumed = client.get(f"/patients/{patient_id}/export", params={"cursor": records[10]["cursor"]})
+    assert [json.loads(l) for l in resumed.text.splitlines()][:-1] == records[11:-1]
+    assert client.get(f"/patients/{patient_id}/export", params={"cursor": "blob:1"}).status_code == 400
+
+    compressed = client.get(f"/patients/{patient_id}/export", params={"compress": "true"})
+    assert compressed.headers["content-type"] == "application/gzip"
+    lines = gzip.decompress(compressed.content).splitlines()
+    assert [json.loads(l)["type"] for l in lines[1:]] == [r["type"] for r in records[1:]]
+    # a transfer cut mid-stream still decodes (pages are sync-flushed); only the last line may be partial
+    partial = zlib.decompressobj(31).decompress(compressed.content[:len(compressed.content) // 2])
+    complete = partial.split(b"\n")[:-1]
+    assert len(complete) >= 3 and all(json.loads(l) for l in complete)
+
+def test_patient_timeline_pages_with_fixed_query_count():
+    from sqlalchemy import event
+
+    client.post("/auth/register", json={"name": "Dr. Test", "role": "doctor"})
+    patient_id = client.post("/doctor/patients/create", json={"name": "Timeline Patient"}).json()["patient_id"]
+
+    def upload(i, body):
+        client.post(f"/doctor/patients/{patient_id}/upload_report",
+                    files={"file": (f"t{i}.txt", io.BytesIO(body.encode()), "text/plain")})
+
+    statements = []
+    def count(*args):
+        statements.append(1)
+
+    def timeline(**params):
+        statements.clear()
+        event.listen(backend.engine, "before_cursor_execute", count)
+        try:
+            return client.get(f"/patients/{patient_id}/timeline", params=params), len(statements)
+        finally:
+            event.remove(backend.engine, "before_cursor_execute", count)
+
+    for i in range(3):
+        upload(i, f"Date: 2025-0{i + 1}-10\nHeart Rate: {70 + i} bpm")
+    upload(9, "Referral letter without readings")
+    response, small_history = timeline(limit=2)
+    page = response.json()
+    assert [item["type"] for item in page["items"]] == ["report", "visit"]
+    visit = page["items"][1]
+    assert visit["date"].startswith("2025-03-10") and visit["vitals"][0]["value"] == 72.0
+    assert visit["reports"][0]["filename"] == "t2.txt"
+
+    rest = client.get(f"/patients/{patient_id}/timeline",
+                      params={"limit": 2, "cursor": page["next_cursor"], "fields": "visit.notes,vital.value"}).json()
+    assert [item["date"][:10] for item in rest["items"]] == ["2025-02-10", "2025-01-10"]
+    assert rest["items"][0]["vitals"] == [{"value": 71.0}] and "reports" not in rest["items"][0]
+    assert rest["next_cursor"] is None
+
+    ranged = client.get(f"/patients/{patient_id}/timeline", params={"start": "2025-02-01", "end": "2025-02-28"}).json()
+    assert [item["id"] for item in ranged["items"]] == [rest["items"][0]["id"]]
+    assert client.get(f"/patients/{patient_id}/timeline", params={"fields": "visit.secret"}).status_code == 400
+
+    for i in range(10, 25):
+        upload(i, f"Date: 2024-06-{i:02d}\nHeart Rate: {60 + i} bpm")
+    _, long_history = timeline(limit=2)
+    assert long_history == small_history <= 6
+
+def test_shard_migration_and_routing(tmp_path, monkeypatch):
+    import sharding
+    import shard_migrate
+    from sqlalchemy import create_engine
+
+    client.post("/auth/register", json={"name": "Dr. Test", "role": "doctor"})
+    old_patient = client.post("/doctor/patients/create", json={"name": "Pre-shard Patient"}).json()["patient_id"]
+    old_upload = client.post(
+        f"/doctor/patients/{old_patient}/upload_report",
+        files={"file": ("old.txt", io.BytesIO(b"Date: 2024-03-01\nHeart Rate: 66 bpm\n"), "text/plain")}
+    ).json()
+
+    router = sharding.ShardRouter(
+        create_engine(f"sqlite:///{tmp_path}/directory.db"), str(tmp_path / "shards"), {},
+        backend.DIRECTORY_TABLES, prepare=backend.prepare_shard
+    )
+    result = shard_migrate.migrate(backend, str(backend.engine.url), router)
+    assert result["tables"]["document"]["copied"] >= 1
+    assert router.shard_for_doctor("dev-user") in result["shards"]
+    monkeypatch.setattr(backend, "shards", router)
+
+    # migrated rows are found through the directory
+    qa = client.post("/documents/qa", json={"document_id": old_upload["document_id"], "question": "What is the heart rate?"})
+    assert qa.json()["answer"] == "Heart rate: 66 bpm."
+    assert client.get(f"/patient/reports/search/{old_upload['report_id']}").json()["patient_id"] == old_patient
+
+    # new rows go to the doctor's shard with directory-allocated ids
+    patient_id = client.post("/doctor/patients/create", json={"name": "Sharded Patient"}).json()["patient_id"]
+    assert patient_id > old_patient
+    upload = client.post(
+        f"/doctor/patients/{patient_id}/upload_report",
+        files={"file": ("new.txt", io.BytesIO(b"Date: 2025-02-01\nSpO2: 97%\n"), "text/plain")}
+    ).json()
+    assert upload["document_id"] > old_upload["document_id"]
+    batch = client.post(
+        f"/doctor/patients/{patient_id}/upload_reports",
+        files=[("files", ("batch.txt", io.BytesIO(b"Weight: 70 kg"), "text/plain"))]
+    ).json()
+    assert batch["succeeded"] == 1
+    timeline = client.get(f"/patients/{patient_id}/timeline").json()
+    assert [item["type"] for item in timeline["items"]].count("visit") == 2
+    own = client.post("/documents/upload", files={"file": ("notes.txt", io.BytesIO(b"Follow-up notes"), "text/plain")})
+    assert client.post("/documents/analyze", json={"document_id": own.json()["document_id"]}).status_code == 200
+
+    shard = router.shard_for_doctor("dev-user")
+    with router.session(shard) as session:
+        assert session.get(backend.Document, upload["document_id"]).patient_id == patient_id
+    with router.session() as session:
+        assert session.get(backend.DocumentShard, upload["document_id"]).shard == shard
+        with pytest.raises(sharding.ShardNotSelected):
+            session.get(backend.Document, upload["document_id"])
+    assert client.get("/patients/999999999/timeline").status_code == 404
+    router.dispose()
+
+def test_shard_writers_do_not_queue_on_the_directory(tmp_path, monkeypatch):
+    import threading
+    import sharding
+    import blob_store
+    from sqlalchemy import create_engine
+
+    router = sharding.ShardRouter(
+        create_engine(f"sqlite:///{tmp_path}/directory.db", connect_args={"timeout": 1}), str(tmp_path / "shards"),
+        {"doctor-a": "clinic-a", "doctor-b": "clinic-b"}, backend.DIRECTORY_TABLES, prepare=backend.prepare_shard
+    )
+    backend.SQLModel.metadata.create_all(router.directory, tables=backend.database_tables(directory=True))
+    monkeypatch.setattr(backend, "shards", router)
+    blob = blob_store.put(str(tmp_path / "blobs"), io.BytesIO(b"Heart Rate: 70 bpm"))
+
+    def save(uid):
+        with router.session(router.shard_for_doctor(uid)) as session:
+            return backend.save_report_document(session, 1, uid, "r.txt", blob, "Heart Rate: 70 bpm", [], [])
+
+    # doctor A's shard transaction stays open while doctor B writes to another shard
+    in_shard_write, release = threading.Event(), threading.Event()
+    extract_vitals = backend.save_extracted_vitals
+    def held_vitals(session, report, doc, text):
+        if report.doctor_uid == "doctor-a":
+            in_shard_write.set()
+            release.wait(5)
+        return extract_vitals(session, report, doc, text)
+    monkeypatch.setattr(backend, "save_extracted_vitals", held_vitals)
+    first = []
+    writer = threading.Thread(target=lambda: first.append(save("doctor-a")))
+    writer.start()
+    try:
+        assert in_shard_write.wait(5)
+        _, doc_b = save("doctor-b")  # "database is locked" if A still held the directory
+    finally:
+        release.set()
+        writer.join()
+    _, doc_a = first[0]
+    with router.session() as session:
+        assert session.get(backend.DocumentShard, doc_b.id).shard == "clinic-b"
+        assert session.get(backend.Blob, blob.digest).refcount == 2
+
+    # a failed shard write leaves no directory rows behind
+    def failing_vitals(session, report, doc, text):
+        raise RuntimeError("disk full")
+    monkeypatch.setattr(backend, "save_extracted_vitals", failing_vitals)
+    with pytest.raises(RuntimeError):
+        save("doctor-b")
+    with router.session() as session:
+        assert session.exec(backend.select(backend.func.count()).select_from(backend.DocumentShard)).one() == 2
+        assert session.exec(backend.select(backend.func.count()).select_from(backend.ReportShard)).one() == 2
+        assert session.get(backend.Blob, blob.digest).refcount == 2
+
+    # deleting a report drops its directory rows and its blob reference
+    with router.session("clinic-a") as session:
+        report = session.exec(backend.select(backend.Report).where(backend.Report.report_id == doc_a.report_id)).one()
+        backend.delete_report(session, report)
+    with router.session() as session:
+        assert session.get(backend.DocumentShard, doc_a.id) is None
+        assert session.get(backend.ReportShard, doc_a.report_id) is None
+        assert session.get(backend.Blob, blob.digest).refcount == 1
+    router.dispose()
+
+def test_text_is_stored_compressed_with_trained_dictionary(tmp_path, monkeypatch):
+    import zstandard
+    import text_codec
+    from sqlalchemy import text as sql_text
+
+    client.post("/auth/register", json={"name": "Dr. Test", "role": "doctor"})
+    patient_id = client.post("/doctor/patients/create", json={"name": "Compressed Patient"}).json()["patient_id"]
+    report = "".join(
+        f"VISIT {i}: Blood Pressure: {120 + i % 9}/{80 + i % 5} mmHg. Heart Rate: {60 + i % 20} bpm. "
+        f"Assessment: hypertension follow-up, continue current medication, recheck in {i % 6 + 2} weeks.\n"
+        for i in range(300)
+    )
+    doc_id = client.post(
+        f"/doctor/patients/{patient_id}/upload_report",
+        files={"file": ("long.txt", io.BytesIO(report.encode()), "text/plain")}
+    ).json()["document_id"]
+
+    with backend.engine.connect() as conn:
+        stored = conn.execute(sql_text("SELECT content_text FROM document WHERE id = :id"), {"id": doc_id}).scalar()
+        chunk = conn.execute(sql_text("SELECT text FROM documentchunk WHERE document_id = :id"), {"id": doc_id}).first()[0]
+    assert isinstance(stored, bytes) and len(stored) < len(report) / 4
+    assert isinstance(chunk, bytes)
+    with backend.Session(backend.engine) as session:
+        assert session.get(backend.Document, doc_id).content_text == report
+
+    original_root = text_codec._root
+    monkeypatch.setattr(backend, "TEXT_DICT_DIR", str(tmp_path))
+    monkeypatch.setattr(backend, "TEXT_DICT_MIN_SAMPLES", 10)
+    try:
+        dict_id = backend.train_text_dictionary()
+        assert dict_id and text_codec.current_dictionary() == dict_id
+        assert backend.recompress_text() > 0
+        with backend.engine.connect() as conn:
+            chunk = conn.execute(sql_text("SELECT text FROM documentchunk WHERE document_id = :id"), {"id": doc_id}).first()[0]
+        assert zstandard.get_frame_parameters(chunk).dict_id == dict_id
+        qa = client.post("/documents/qa", json={"document_id": doc_id, "question": "Is the hypertension controlled?"})
+        assert qa.status_code == 200 and qa.headers["X-Answer-Source"] == "rag"
+    finally:
+        text_codec.configure(original_root, backend.TEXT_ZSTD_LEVEL)
+    # frames written with the dictionary stay readable; plain rows too
+    with backend.Session(backend.engine) as session:
+        assert session.get(backend.Document, doc_id).content_text == report
+    assert text_codec.decompress("legacy plain text") == "legacy plain text"
+    assert client.post("/documents/qa", json={"document_id": 10 ** 9, "question": "x"}).status_code == 404
+
+def test_backend_import_defers_heavy_dependencies(tmp_path):
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+    code = (
+        "import sys, importlib.util\n"
+        "spec = importlib.util.spec_from_file_location('backend', 'smartemr-backend.py')\n"
+        "spec.loader.exec_module(importlib.util.module_from_spec(spec))\n"
+        "heavy = ['numpy', 'openai', 'PyPDF2', 'PIL', 'pytesseract', 'firebase_admin']\n"
+        "print(','.join(m for m in heavy if m in sys.modules))\n"
+    )
+    env = dict(os.environ, USE_AUTH="true", OPENAI_API_KEY="", DATABASE_URL=f"sqlite:///{tmp_path}/import.db")
+    out = subprocess.run([sys.executable, "-c", code], cwd=scripts_dir, env=env,
+                         capture_output=True, text=True, check=True)
+    assert out.stdout.strip() == ""
+    assert not os.path.exists(tmp_path / "import.db")
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
@@ -0,0 +1,200 @@
+"""
+zstd compression of document and chunk text, with a dictionary trained on stored text.
+
+Document.content_text holds a report's full text and its DocumentChunk rows hold it
+again, overlapping. Clinical reports repeat the same headings, labels, units and
+phrasing, which generic compression of a single 1 KB chunk cannot exploit; a zstd
+dictionary trained on earlier chunks supplies that shared context, so even short
+chunks compress several-fold.
+
+CompressedText is the column type: on SQLite, values of MIN_COMPRESS_CHARS or more are
+stored as zstd frames (BLOBs in the TEXT column), and frames are decompressed only
+when the column is actually selected. Rows written before, short values and other
+databases keep plain text, which reads back unchanged.
+
+Dictionaries live in a directory shared by all workers:
+
+    {root}/CURRENT            dict id used to compress new text
+    {root}/{dict_id}.zdict    one file per trained dictionary; never delete one that
+                              stored frames still reference (their header names it)
+
+Frames record their dictionary id, so text written with an older dictionary stays
+readable after retraining. Workers pick up a new CURRENT within RELOAD_INTERVAL_S.
+
+    python text_codec.py train               # train from stored chunks, make it CURRENT
+    python text_codec.py train --recompress  # and rewrite stored text with it
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import threading
+from typing import Dict, List, Optional, Union
+
+import zstandard
+from sqlalchemy.types import Text, TypeDecorator
+
+from backend_loader import load_backend
+from observability import Counter
+
+MIN_COMPRESS_CHARS = 64  # below this the frame header outweighs the savings
+DICT_SIZE = 112 * 1024
+RELOAD_INTERVAL_S = 30.0
+CURRENT_FILE = "CURRENT"
+DICT_SUFFIX = ".zdict"
+
+TEXT_BYTES = Counter("smartemr_text_bytes_total", "Text written to the database, before and after compression",
+                     ["stage"])
+
+_root: Optional[str] = None
+_level = 3
+_dicts: Dict[int, zstandard.ZstdCompressionDict] = {}
+_current: Optional[int] = None
+_checked_at = 0.0
+_current_mtime = None
+_lock = threading.Lock()
+_local = threading.local()  # zstd (de)compressor objects are not thread-safe
+
+
+def configure(root: Optional[str], level: int = 3) -> None:
+    global _root, _level, _checked_at
+    _root, _level, _checked_at = root, level, 0.0
+
+
+def dict_path(root: str, dict_id: int) -> str:
+    return os.path.join(root, f"{dict_id}{DICT_SUFFIX}")
+
+
+def load_dictionary(dict_id: int) -> zstandard.ZstdCompressionDict:
+    d = _dicts.get(dict_id)
+    if d is None:
+        if not _root:
+            raise RuntimeError(f"text was compressed with zstd dictionary {dict_id} but no dictionary directory is set")
+        with open(dict_path(_root, dict_id), "rb") as f:
+            d = zstandard.ZstdCompressionDict(f.read())
+        _dicts[dict_id] = d
+    return d
+
+
+def current_dictionary() -> Optional[int]:
+    """Dict id named by CURRENT, re-read at most every RELOAD_INTERVAL_S."""
+    global _current, _checked_at, _current_mtime
+    now = time.monotonic()
+    if _root and now - _checked_at >= RELOAD_INTERVAL_S:
+        with _lock:
+            _checked_at = now
+            path = os.path.join(_root, CURRENT_FILE)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                _current = _current_mtime = None
+            else:
+                if mtime != _current_mtime:
+                    with open(path) as f:
+                        _current, _current_mtime = int(f.read().strip()), mtime
+    return _current
+
+
+def _compressor(dict_id: Optional[int]) -> zstandard.ZstdCompressor:
+    cache = _local.__dict__.setdefault("compressors", {})
+    key = (dict_id, _level)
+    if key not in cache:
+        d = load_dictionary(dict_id) if dict_id else None
+        cache[key] = zstandard.ZstdCompressor(level=_level, dict_data=d)
+    return cache[key]
+
+
+def _decompressor(dict_id: int) -> zstandard.ZstdDecompressor:
+    cache = _local.__dict__.setdefault("decompressors", {})
+    if dict_id not in cache:
+        d = load_dictionary(dict_id) if dict_id else None
+        cache[dict_id] = zstandard.ZstdDecompressor(dict_data=d)
+    return cache[dict_id]
+
+
+def compress(text: str) -> Union[str, bytes]:
+    """A zstd frame of `text`, or `text` itself when it is too short to gain."""
+    if len(text) < MIN_COMPRESS_CHARS:
+        return text
+    raw = text.encode("utf-8")
+    frame = _compressor(current_dictionary()).compress(raw)
+    TEXT_BYTES.inc(len(raw), stage="raw")
+    TEXT_BYTES.inc(len(frame), stage="stored")
+    return frame
+
+
+def decompress(value: Union[str, bytes, None]) -> Optional[str]:
+    if not isinstance(value, (bytes, memoryview)):
+        return value
+    value = bytes(value)
+    dict_id = zstandard.get_frame_parameters(value).dict_id
+    return _decompressor(dict_id).decompress(value).decode("utf-8")
+
+
+class CompressedText(TypeDecorator):
+    """TEXT column whose values are stored as zstd frames on SQLite (see module docstring)."""
+
+    impl = Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None or dialect.name != "sqlite":
+            return value
+        return compress(value)
+
+    def process_result_value(self, value, dialect):
+        return decompress(value)
+
+
+def train(samples: List[str], size: int = DICT_SIZE) -> zstandard.ZstdCompressionDict:
+    return zstandard.train_dictionary(size, [s.encode("utf-8") for s in samples if s])
+
+
+def save_dictionary(root: str, d: zstandard.ZstdCompressionDict) -> int:
+    """Store a trained dictionary and make it CURRENT; returns its dict id."""
+    os.makedirs(root, exist_ok=True)
+    dict_id = d.dict_id()
+    path = dict_path(root, dict_id)
+    if not os.path.exists(path):
+        _write_atomic(root, path, d.as_bytes())
+    _write_atomic(root, os.path.join(root, CURRENT_FILE), str(dict_id).encode())
+    return dict_id
+
+
+def _write_atomic(root: str, path: str, data: bytes) -> None:
+    fd, tmp_path = tempfile.mkstemp(dir=root, prefix=".incoming-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Train the zstd dictionary for stored document text")
+    parser.add_argument("command", choices=["train"])
+    parser.add_argument("--samples", type=int, default=20000, help="chunk texts to train on")
+    parser.add_argument("--recompress", action="store_true", help="rewrite stored text with the new dictionary")
+    args = parser.parse_args(argv)
+    backend = load_backend()
+    backend.ensure_db()
+    dict_id = backend.train_text_dictionary(args.samples)
+    if dict_id is None:
+        print("not enough stored text to train a dictionary", file=sys.stderr)
+        return 1
+    result = {"dict_id": dict_id}
+    if args.recompress:
+        result["rows"] = backend.recompress_text()
+    print(json.dumps(result))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,349 @@
+"""
+Append-only, memory-mapped embedding store shared by all worker processes.
+
+Ingestion appends each document's chunk vectors as float32 rows; every worker maps
+the file read-only, so retrieval slices a document's matrix without copying and the
+OS page cache holds one copy for all workers. Layout, one directory per embedding
+space (provider key):
+
+    {root}/{space}/CURRENT               name of the live generation, e.g. "gen-000002"
+    {root}/{space}/DIM                   values per row, for tools that open every space
+    {root}/{space}/gen-000002/vectors.f32  float32 rows, `dim` values each
+    {root}/{space}/gen-000002/vectors.i8   the same rows L2-normalised and int8-quantised
+    {root}/{space}/gen-000002/scales.f32   one float32 dequantisation scale per row
+    {root}/{space}/gen-000002/index.bin    32-byte records: document_id, first row,
+                                           row count, flags, crc32
+    {root}/{space}/.lock                   flock held by writers (append/link/delete/compact)
+
+Crash safety: rows are written and fsynced before the index record that publishes
+them, and records carry a CRC. Readers stop at the first torn or corrupt record, and
+the next writer truncates both files back to the last valid record. Later records for
+a document replace earlier ones, and a tombstone record deletes it. compact() rewrites
+only the live rows into a new generation and switches CURRENT atomically; readers that
+still map the old generation keep working until they refresh.
+
+The int8 copy is a quarter of the size, so a first pass over it (quantized_scores)
+touches a quarter of the pages; callers rescore the shortlist from the float32 rows.
+
+    python vector_store.py compact ./uploads/vectors
+"""
+
+import os
+import re
+import sys
+import zlib
+import fcntl
+import shutil
+import struct
+import threading
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+RECORD = struct.Struct("<qqqII")  # document_id, start_row, row_count, flags, crc32
+FLAG_TOMBSTONE = 1
+VECTORS_FILE = "vectors.f32"
+QUANTIZED_FILE = "vectors.i8"
+SCALES_FILE = "scales.f32"
+ROW_FILES = (VECTORS_FILE, QUANTIZED_FILE, SCALES_FILE)
+INDEX_FILE = "index.bin"
+CURRENT_FILE = "CURRENT"
+DIM_FILE = "DIM"
+
+
+def _space_dirname(space: str) -> str:
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", space)
+
+
+def _pack(document_id: int, start: int, count: int, flags: int) -> bytes:
+    body = struct.pack("<qqqI", document_id, start, count, flags)
+    return body + struct.pack("<I", zlib.crc32(body))
+
+
+def quantize_int8(vectors) -> Tuple[np.ndarray, np.ndarray]:
+    """Symmetric per-vector int8 quantisation of the L2-normalised rows.
+
+    Returns (q, scales) with unit_row ~= q * scale; zero rows get scale 0.
+    """
+    matrix = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    unit = np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+    scales = (np.abs(unit).max(axis=1, initial=0.0) / 127.0).astype(np.float32)
+    q = np.divide(unit, scales[:, None], out=np.zeros_like(unit), where=scales[:, None] > 0)
+    return np.rint(q).astype(np.int8), scales
+
+
+def dequantize_int8(q: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    return q.astype(np.float32) * np.asarray(scales, dtype=np.float32)[:, None]
+
+
+def quantized_scores(q: np.ndarray, scales: np.ndarray, query: np.ndarray, block: int = 256) -> np.ndarray:
+    """Approximate cosine similarity of every int8 row with `query`, scanned in blocks."""
+    query = np.asarray(query, dtype=np.float32)
+    norm = np.linalg.norm(query)
+    out = np.zeros(len(q), dtype=np.float32)
+    if norm == 0:
+        return out
+    query = query / norm
+    for start in range(0, len(q), block):
+        stop = start + block
+        out[start:stop] = (q[start:stop].astype(np.float32) @ query) * scales[start:stop]
+    return out
+
+
+def _fsync_dir(path: str) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class VectorStore:
+    def __init__(self, root: str, space: str, dim: int):
+        self.dir = os.path.join(root, _space_dirname(space))
+        self.space = space
+        self.dim = dim
+        self._lock = threading.Lock()
+        self._reset(None)
+
+    def _reset(self, generation: Optional[str]) -> None:
+        self._generation = generation
+        self._index: Dict[int, Tuple[int, int]] = {}
+        self._index_pos = 0
+        self._rows = 0
+        self._matrix: Optional[np.memmap] = None
+        self._quantized: Optional[Tuple[np.memmap, np.memmap]] = None
+
+    # ---------------- Paths and locking ----------------
+    def _path(self, generation: str, name: str) -> str:
+        return os.path.join(self.dir, generation, name)
+
+    def _read_current(self) -> Optional[str]:
+        try:
+            with open(os.path.join(self.dir, CURRENT_FILE)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _publish_generation(self, generation: str) -> None:
+        tmp = os.path.join(self.dir, CURRENT_FILE + ".tmp")
+        with open(tmp, "w") as f:
+            f.write(generation)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.dir, CURRENT_FILE))
+        _fsync_dir(self.dir)
+
+    def _create_generation(self, number: int) -> str:
+        generation = f"gen-{number:06d}"
+        os.makedirs(os.path.join(self.dir, generation), exist_ok=True)
+        for name in ROW_FILES + (INDEX_FILE,):
+            open(self._path(generation, name), "ab").close()
+        return generation
+
+    @contextmanager
+    def _writer(self):
+        """Exclusive cross-process write lock; yields with the in-memory view refreshed."""
+        os.makedirs(self.dir, exist_ok=True)
+        with open(os.path.join(self.dir, ".lock"), "a+") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with self._lock:
+                    if self._read_current() is None:
+                        with open(os.path.join(self.dir, DIM_FILE), "w") as f:
+                            f.write(str(self.dim))
+                        self._publish_generation(self._create_generation(0))
+                    self._refresh()
+                    yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # ---------------- Reading ----------------
+    def _refresh(self) -> None:
+        """Apply index records appended (by any process) since the last refresh."""
+        generation = self._read_current()
+        if generation != self._generation:
+            self._reset(generation)
+        if generation is None:
+            return
+        try:
+            with open(self._path(generation, INDEX_FILE), "rb") as f:
+                f.seek(self._index_pos)
+                data = f.read()
+        except FileNotFoundError:  # compacted away between reading CURRENT and opening
+            self._reset(None)
+            return
+        for offset in range(0, len(data) - RECORD.size + 1, RECORD.size):
+            document_id, start, count, flags, crc = RECORD.unpack_from(data, offset)
+            if zlib.crc32(data[offset:offset + RECORD.size - 4]) != crc:
+                break  # torn write: everything after it is ignored
+            if flags & FLAG_TOMBSTONE:
+                self._index.pop(document_id, None)
+            else:
+                self._index[document_id] = (start, count)
+                self._rows = max(self._rows, start + count)
+            self._index_pos += RECORD.size
+
+    def _remap(self) -> None:
+        path = self._path(self._generation, VECTORS_FILE)
+        rows = os.path.getsize(path) // (self.dim * 4)
+        self._matrix = np.memmap(path, dtype=np.float32, mode="r", shape=(rows, self.dim)) if rows else None
+
+    def _remap_quantized(self) -> None:
+        q_path = self._path(self._generation, QUANTIZED_FILE)
+        s_path = self._path(self._generation, SCALES_FILE)
+        rows = min(os.path.getsize(q_path) // self.dim, os.path.getsize(s_path) // 4)
+        self._quantized = (
+            np.memmap(q_path, dtype=np.int8, mode="r", shape=(rows, self.dim)),
+            np.memmap(s_path, dtype=np.float32, mode="r", shape=(rows,)),
+        ) if rows else None
+
+    def get(self, document_id: int) -> Optional[np.ndarray]:
+        """Return a read-only (rows, dim) view of a document's vectors, or None."""
+        with self._lock:
+            self._refresh()
+            location = self._index.get(document_id)
+            if location is None:
+                return None
+            start, count = location
+            if self._matrix is None or self._matrix.shape[0] < start + count:
+                self._remap()
+            return self._matrix[start:start + count]
+
+    def get_quantized(self, document_id: int) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Return read-only views of a document's int8 rows and their scales, or None."""
+        with self._lock:
+            self._refresh()
+            location = self._index.get(document_id)
+            if location is None:
+                return None
+            start, count = location
+            if self._quantized is None or self._quantized[1].shape[0] < start + count:
+                self._remap_quantized()
+                if self._quantized is None or self._quantized[1].shape[0] < start + count:
+                    return None
+            q, scales = self._quantized
+            return q[start:start + count], scales[start:start + count]
+
+    def __contains__(self, document_id: int) -> bool:
+        with self._lock:
+            self._refresh()
+            return document_id in self._index
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            self._refresh()
+            live_rows = sum(count for _, count in set(self._index.values()))
+            return {"documents": len(self._index), "rows": self._rows, "live_rows": live_rows}
+
+    # ---------------- Writing ----------------
+    def _append_record(self, document_id: int, start: int, count: int, flags: int = 0) -> None:
+        with open(self._path(self._generation, INDEX_FILE), "r+b") as f:
+            f.truncate(self._index_pos)  # drop a torn record left by a crashed writer
+            f.seek(self._index_pos)
+            f.write(_pack(document_id, start, count, flags))
+            f.flush()
+            os.fsync(f.fileno())
+        self._refresh()
+
+    def append(self, document_id: int, vectors) -> None:
+        """Store `vectors` (rows ordered by chunk_index) as the document's embeddings."""
+        matrix = np.ascontiguousarray(vectors, dtype=np.float32)
+        if matrix.ndim != 2 or matrix.shape[1] != self.dim:
+            raise ValueError(f"expected (n, {self.dim}) vectors for {self.space}, got {matrix.shape}")
+        q, scales = quantize_int8(matrix)
+        with self._writer():
+            for name, data in zip(ROW_FILES, (matrix, q, scales)):
+                row_bytes = data.itemsize * (data.shape[1] if data.ndim == 2 else 1)
+                with open(self._path(self._generation, name), "r+b") as f:
+                    f.truncate(self._rows * row_bytes)  # drop rows from an unpublished append
+                    f.seek(self._rows * row_bytes)
+                    f.write(data.tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+            self._append_record(document_id, self._rows, len(matrix))
+
+    def link(self, document_id: int, source_document_id: int) -> bool:
+        """Point `document_id` at the rows of `source_document_id` without copying them."""
+        with self._writer():
+            location = self._index.get(source_document_id)
+            if location is None:
+                return False
+            self._append_record(document_id, *location)
+            return True
+
+    def delete(self, document_id: int) -> None:
+        with self._writer():
+            if document_id in self._index:
+                self._append_record(document_id, 0, 0, FLAG_TOMBSTONE)
+
+    def compact(self) -> Dict[str, int]:
+        """Rewrite live rows into a new generation, dropping deleted and superseded rows."""
+        with self._writer():
+            before = self._rows
+            number = int(self._generation.split("-")[1]) + 1
+            generation = self._create_generation(number)
+            self._remap()
+            moved: Dict[Tuple[int, int], int] = {}
+            next_row = 0
+            with open(self._path(generation, VECTORS_FILE), "wb") as vf, \
+                    open(self._path(generation, QUANTIZED_FILE), "wb") as qf, \
+                    open(self._path(generation, SCALES_FILE), "wb") as sf, \
+                    open(self._path(generation, INDEX_FILE), "wb") as xf:
+                for document_id, (start, count) in sorted(self._index.items()):
+                    if (start, count) not in moved:  # linked documents keep sharing rows
+                        moved[(start, count)] = next_row
+                        rows = np.ascontiguousarray(self._matrix[start:start + count])
+                        q, scales = quantize_int8(rows)
+                        for f, data in ((vf, rows), (qf, q), (sf, scales)):
+                            f.write(data.tobytes())
+                        next_row += count
+                    xf.write(_pack(document_id, moved[(start, count)], count, 0))
+                for f in (vf, qf, sf, xf):
+                    f.flush()
+                    os.fsync(f.fileno())
+            previous = self._generation
+            self._publish_generation(generation)
+            for name in os.listdir(self.dir):
+                if name.startswith("gen-") and name not in (generation, previous):
+                    shutil.rmtree(os.path.join(self.dir, name), ignore_errors=True)
+            self._refresh()
+            return {"documents": len(self._index), "rows_before": before, "rows_after": self._rows}
+
+
+def space_dim(path: str) -> Optional[int]:
+    """Row width of the space stored in directory `path`, None if it cannot be told.
+
+    Spaces created before DIM files existed are named after a provider key ending in
+    "@<dim>", which the directory name keeps as "_<dim>".
+    """
+    try:
+        with open(os.path.join(path, DIM_FILE)) as f:
+            return int(f.read().strip())
+    except (FileNotFoundError, ValueError):
+        match = re.search(r"_(\d+)$", os.path.basename(path))
+        return int(match.group(1)) if match else None
+
+
+def compact_all(root: str) -> Dict[str, Dict[str, int]]:
+    """Compact every embedding space under `root`."""
+    results = {}
+    for name in sorted(os.listdir(root)):
+        path = os.path.join(root, name)
+        if not os.path.isfile(os.path.join(path, CURRENT_FILE)):
+            continue
+        dim = space_dim(path)
+        if dim is None:
+            print(f"skipping {name}: unknown vector dimension", file=sys.stderr)
+            continue
+        results[name] = VectorStore(root, name, dim).compact()  # directory names map to themselves
+    return results
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "compact":
+        sys.exit("usage: python vector_store.py compact <VECTOR_STORE_DIR>")
+    for space, result in compact_all(sys.argv[2]).items():
+        print(space, result)